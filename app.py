@@ -1,4 +1,5 @@
 """ Bot App """
+import asyncio
 import json
 import sys
 import time
@@ -14,24 +15,30 @@ from aiohttp.web_fileresponse import FileResponse
 from botbuilder.core import (
     BotFrameworkAdapterSettings,
     TurnContext,
-    BotFrameworkAdapter,
 )
-from botbuilder.schema import Activity, ActivityTypes
+from botbuilder.schema import Activity, ActivityTypes, DeliveryModes
 from marshmallow import EXCLUDE, ValidationError
 
 from bots.messaging_extension_action_preview_bot import \
     TeamsMessagingExtensionsActionPreviewBot
 from bots.exceptions import ConversationNotFound, DataParsingError
-from config import AppConfig, COSMOS_CLIENT, TeamsAppConfig, TOKEN_HELPER, \
-    CosmosDBConfig
+from bots.pooled_adapter import PooledBotFrameworkAdapter
+from config import AppConfig, STORAGE_CLIENT, TeamsAppConfig, TOKEN_HELPER, \
+    NotificationConfig, WriteBehindConfig, MetricsConfig, ProjectorConfig, \
+    RetentionConfig, DeliveryConfig, OutboundConfig, HttpConfig, FlowConfig, \
+    TurnConfig
 from entities.json.admin_user import AdminUser
-from entities.json.notification import Notification
+from entities.json.notification import Notification, NotificationBatch
+from entities.json.notification_summary import NotificationSummary
 from entities.json.pa_message import PAMessage
-from utils.cosmos_client import ItemNotFound
+from utils.delivery_queue import DeliveryQueueFull, Priority
+from utils.storage_backend import ItemNotFound
 from utils.functions import quote_b64encode_str_safe, quote_b64decode_str_safe
 from utils.json_func import json_loads, json_dumps
 from utils.log import Log, init_logging
+from utils.outbound_limiter import OutboundLimiter, parse_limits
 from utils.teams_app_generator import TeamsAppGenerator
+from utils.turn_dispatcher import TurnQueueFull
 
 app_config = AppConfig()
 
@@ -40,10 +47,21 @@ app_config = AppConfig()
 app_settings = BotFrameworkAdapterSettings(app_config.APP_ID,
                                            app_config.APP_PASSWORD)
 
-ADAPTER = BotFrameworkAdapter(app_settings)
+ADAPTER = PooledBotFrameworkAdapter(app_settings)
 BOT = TeamsMessagingExtensionsActionPreviewBot(app_settings, ADAPTER)
 TAG = __name__
 
+# Startup phases in ms since app_factory() was called
+STARTUP_TIMINGS: Dict[str, float] = {}
+STARTUP_START = time.perf_counter()
+
+
+def record_startup_timing(phase: str) -> None:
+    """ Remember when the startup phase finished """
+    STARTUP_TIMINGS[phase] = round(
+        (time.perf_counter() - STARTUP_START) * 1000, 3
+    )
+
 
 # noinspection PyShadowingNames
 async def on_error(context: TurnContext, error: Exception):
@@ -101,12 +119,10 @@ async def v1_get_initiations(request: Request) -> Response:
         notification_id = request.match_info.get('notification_id')
         Log.d(TAG, "v1_get_initiations::notification_id: "
                    "{}".format(notification_id))
-        init_items, paging_token = await COSMOS_CLIENT.get_initiation_items(
-            notification_id, token
-        )
-        data = dict(initiators=[dict(initiator=i.initiator,
-                                     timestamp=i.timestamp,
-                                     id=i.id) for i in init_items])
+        init_items, paging_token = \
+            await STORAGE_CLIENT.get_initiation_records(notification_id,
+                                                        token)
+        data = dict(initiators=[i._asdict() for i in init_items])
         Log.d(TAG, "v1_get_initiations::paging_token: {}".format(paging_token))
         if paging_token is not None:
             token_encoded = quote_b64encode_str_safe(paging_token)
@@ -124,18 +140,45 @@ async def v1_get_initiations(request: Request) -> Response:
 
 @TOKEN_HELPER.is_auth
 async def v1_get_notification(request: Request) -> Response:
-    """ Get Notification by ID """
+    """ Get Notification by ID, acknowledges are paginated """
+    try:
+        limit = int(request.query.get("limit",
+                                      NotificationConfig.ACKS_PAGE_SIZE))
+    except ValueError:
+        return Response(status=HTTPStatus.BAD_REQUEST, reason="Bad limit")
+    limit = min(max(limit, 1), NotificationConfig.ACKS_MAX_PAGE_SIZE)
     # noinspection PyBroadException
     try:
+        query_token = request.query.get("token")
+        token = quote_b64decode_str_safe(query_token)
         notification_id = request.match_info['notification_id']
-        notification = await COSMOS_CLIENT.get_notification(notification_id)
-        acks = await COSMOS_CLIENT.get_acknowledge_items(notification_id)
+        # an unknown id answers 404 without spending the other three reads
+        notification = await STORAGE_CLIENT.get_notification(notification_id)
+        delivery, summary, (acks, paging_token) = \
+            await asyncio.gather(
+                STORAGE_CLIENT.get_notification_delivery(notification_id),
+                STORAGE_CLIENT.get_notification_summary(notification_id),
+                STORAGE_CLIENT.get_acknowledge_records(notification_id,
+                                                       token, limit)
+            )
+        # acknowledges and initiations imply the delivery, until then the
+        # delivery tells PENDING / FAILED / DELIVERED
+        status = (delivery.status if summary is None and delivery is not None
+                  else None)
+        summary = summary or NotificationSummary.build(notification_id, 0,
+                                                       None, None, 0)
         data = dict(data=dict(
             timestamp=notification.timestamp,
-            status="DELIVERED",  # TODO(s1z): insert a real status value pls!
-            acknowledged=[dict(username=ack.username,
-                               timestamp=ack.timestamp) for ack in acks],
+            status=status or summary.status,
+            ackCount=summary.ack_count,
+            firstAckTimestamp=summary.first_ack_timestamp,
+            lastAckTimestamp=summary.last_ack_timestamp,
+            initiationCount=summary.initiation_count,
+            acknowledged=[ack._asdict() for ack in acks],
         ))
+        if paging_token is not None:
+            token_encoded = quote_b64encode_str_safe(paging_token)
+            data["data"].update(dict(paging=dict(token=token_encoded)))
         return Response(body=json.dumps(data), status=HTTPStatus.OK)
     except ItemNotFound as e:
         Log.e(TAG, "v1_get_notification::item not found", e)
@@ -153,6 +196,16 @@ async def v1_post_notification(request: Request) -> Response:
         request_body = await request.text()
         schema = Notification.get_schema(unknown=EXCLUDE)
         notification = schema.load(json_loads(request_body, {})).to_db()
+        if request.query.get("mode") == "async":
+            # queued, the delivery status is in GET /notification
+            notification_id = await BOT.send_notification(
+                notification, Priority.NORMAL, wait=False
+            )
+            data = dict(notificationId=notification_id)
+            body = dict(status=dict(message="Accepted", code=202),
+                        data=data)
+            return Response(body=json.dumps(body),
+                            status=HTTPStatus.ACCEPTED)
         notification_id = await BOT.send_notification(notification)
         data = dict(notificationId=notification_id)
         body = dict(status=dict(message="OK", code=200), data=data)
@@ -160,6 +213,9 @@ async def v1_post_notification(request: Request) -> Response:
     except ConversationNotFound:
         return Response(status=HTTPStatus.NOT_FOUND,
                         reason="Conversation not found")
+    except DeliveryQueueFull as e:
+        return Response(status=HTTPStatus.SERVICE_UNAVAILABLE,
+                        reason=e.message)
     except DataParsingError:
         return Response(status=HTTPStatus.BAD_REQUEST,
                         reason="Bad data structure")
@@ -168,6 +224,39 @@ async def v1_post_notification(request: Request) -> Response:
         return Response(status=HTTPStatus.INTERNAL_SERVER_ERROR)
 
 
+@TOKEN_HELPER.is_auth
+async def v1_post_notifications_batch(request: Request) -> Response:
+    """ Notify many channels at once.
+        Body is either a list of notifications or one notification with
+        the "destinations" list """
+    # noinspection PyBroadException
+    try:
+        body = json_loads(await request.text(), {})
+        if isinstance(body, list):
+            schema = Notification.get_schema(unknown=EXCLUDE)
+            notifications = [n.to_db() for n in schema.load(body, many=True)]
+        else:
+            schema = NotificationBatch.get_schema(unknown=EXCLUDE)
+            notifications = schema.load(body).to_db()
+    except ValidationError:
+        return Response(status=HTTPStatus.BAD_REQUEST,
+                        reason="Bad data structure")
+    if len(notifications) > NotificationConfig.BATCH_MAX_SIZE:
+        return Response(status=HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                        reason="Too many destinations")
+    # noinspection PyBroadException
+    try:
+        results = await BOT.send_notifications(
+            notifications, NotificationConfig.BATCH_CONCURRENCY
+        )
+        data = dict(notifications=results)
+        body = dict(status=dict(message="OK", code=200), data=data)
+        return Response(body=json.dumps(body), status=HTTPStatus.OK)
+    except Exception:
+        Log.e(TAG, exc_info=sys.exc_info())
+        return Response(status=HTTPStatus.INTERNAL_SERVER_ERROR)
+
+
 async def v1_messages(request: Request) -> Response:
     """ messages endpoint """
     start = time.time()
@@ -180,6 +269,11 @@ async def v1_messages(request: Request) -> Response:
     auth_header = (request.headers["Authorization"]
                    if "Authorization" in request.headers else "")
 
+    if (BOT.turn_dispatcher is not None
+            and activity.type != ActivityTypes.invoke
+            and activity.delivery_mode != DeliveryModes.expect_replies):
+        return await dispatch_activity(activity, auth_header)
+
     invoke_response = await ADAPTER.process_activity(
         activity, auth_header, BOT.on_turn
     )
@@ -191,10 +285,35 @@ async def v1_messages(request: Request) -> Response:
     return Response(status=HTTPStatus.OK)
 
 
+async def dispatch_activity(activity: Activity, auth_header: str)\
+        -> Response:
+    """ Authenticate, queue the turn and answer 200 right away.
+        The turns of a conversation are processed in the arrival order """
+    try:
+        identity = await ADAPTER.authenticate(activity, auth_header)
+    except PermissionError:
+        return Response(status=HTTPStatus.UNAUTHORIZED)
+
+    async def job() -> None:
+        """ Run the turn, the errors go to ADAPTER.on_turn_error """
+        await ADAPTER.process_activity_with_identity(activity, identity,
+                                                     BOT.on_turn)
+
+    conversation_id = (activity.conversation.id
+                       if activity.conversation is not None else "")
+    try:
+        await BOT.turn_dispatcher.submit(conversation_id, job)
+    except TurnQueueFull as e:
+        Log.w(TAG, f"dispatch_activity::{conversation_id}: {e.message}")
+        return Response(status=HTTPStatus.SERVICE_UNAVAILABLE,
+                        reason=e.message)
+    return Response(status=HTTPStatus.OK)
+
+
 async def v1_get_health_check(_request: Request) -> Response:
     """ Health check """
     try:
-        # _container = await COSMOS_CLIENT.get_conversations_container()
+        # _container = await STORAGE_CLIENT.get_conversations_container()
         # _data = (await KEY_VAULT_CLIENT.get_secret("adminLogin")).value
         # key = await KEY_VAULT_CLIENT.create_key("pumpalot")
         # encrypted_data = await KEY_VAULT_CLIENT.encrypt(key, b"hello")
@@ -206,6 +325,25 @@ async def v1_get_health_check(_request: Request) -> Response:
         raise
 
 
+@TOKEN_HELPER.is_auth
+async def v1_get_metrics(_request: Request) -> Response:
+    """ In-process metrics """
+    data = dict(startup=STARTUP_TIMINGS, storage=STORAGE_CLIENT.stats(),
+                delivery=(BOT.delivery_queue.stats()
+                          if BOT.delivery_queue is not None else None),
+                outbound=(BOT.outbound_limiter.stats()
+                          if BOT.outbound_limiter is not None else None),
+                http=(BOT.http_sessions.stats()
+                      if BOT.http_sessions is not None else None),
+                flows=(BOT.flow_dispatcher.stats()
+                       if BOT.flow_dispatcher is not None else None),
+                turns=(BOT.turn_dispatcher.stats()
+                       if BOT.turn_dispatcher is not None else None),
+                adapter=ADAPTER.stats())
+    body = dict(status=dict(message="OK", code=200), data=data)
+    return Response(body=json_dumps(body), status=HTTPStatus.OK)
+
+
 async def v1_get_app_zip(_request: Request) -> FileResponse:
     """ Get zip file """
     from config import APP_VERSION
@@ -215,6 +353,15 @@ async def v1_get_app_zip(_request: Request) -> FileResponse:
     return FileResponse(path=TeamsAppConfig.zip_file, headers=headers)
 
 
+@web.middleware
+async def startup_timing_middleware(request, handler):
+    """ Record time to the first request """
+    if "firstRequest" not in STARTUP_TIMINGS:
+        record_startup_timing("firstRequest")
+        Log.i(TAG, f"startup_timing_middleware::timings: {STARTUP_TIMINGS}")
+    return await handler(request)
+
+
 @web.middleware
 async def error_middleware(request, handler):
     """ Error handler """
@@ -286,48 +433,89 @@ async def v1_pa_authorize(request: Request) -> Response:
 
 
 async def init_db_containers():
-    """ To speed up the process we have to create containers first """
-    await COSMOS_CLIENT.create_db(CosmosDBConfig.Conversations.DATABASE)
-    await COSMOS_CLIENT.create_container(
-        CosmosDBConfig.Conversations.DATABASE,
-        CosmosDBConfig.Conversations.CONTAINER,
-        CosmosDBConfig.Conversations.PARTITION_KEY
-    )
-    await COSMOS_CLIENT.create_container(
-        CosmosDBConfig.Notifications.DATABASE,
-        CosmosDBConfig.Notifications.CONTAINER,
-        CosmosDBConfig.Notifications.PARTITION_KEY
-    )
-    await COSMOS_CLIENT.create_container(
-        CosmosDBConfig.Acknowledges.DATABASE,
-        CosmosDBConfig.Acknowledges.CONTAINER,
-        CosmosDBConfig.Acknowledges.PARTITION_KEY
-    )
-    await COSMOS_CLIENT.create_container(
-        CosmosDBConfig.Initiations.DATABASE,
-        CosmosDBConfig.Initiations.CONTAINER,
-        CosmosDBConfig.Initiations.PARTITION_KEY
-    )
-    await COSMOS_CLIENT.create_container(
-        CosmosDBConfig.Flows.DATABASE,
-        CosmosDBConfig.Flows.CONTAINER,
-        CosmosDBConfig.Flows.PARTITION_KEY
-    )
+    """ To speed up the process we have to create containers first.
+        Container handles are resolved here once and served from the
+        registry afterwards """
+    await STORAGE_CLIENT.init_storage()
+
+
+async def on_app_startup(_app: web.Application) -> None:
+    """ Start background workers """
+    STORAGE_CLIENT.start_metrics_reporter(MetricsConfig.LOG_INTERVAL)
+    BOT.start_http_sessions(limit=HttpConfig.LIMIT,
+                            limit_per_host=HttpConfig.LIMIT_PER_HOST,
+                            dns_ttl=HttpConfig.DNS_TTL,
+                            keepalive_timeout=HttpConfig.KEEPALIVE_TIMEOUT,
+                            timeout=HttpConfig.TIMEOUT)
+    await BOT.start_flow_dispatcher(FlowConfig.QUEUE_PATH,
+                                    workers=FlowConfig.WORKERS,
+                                    max_retries=FlowConfig.MAX_RETRIES,
+                                    base_delay=FlowConfig.BASE_DELAY,
+                                    max_delay=FlowConfig.MAX_DELAY)
+    BOT.start_delivery_queue(workers=DeliveryConfig.WORKERS,
+                             max_size=DeliveryConfig.MAX_SIZE,
+                             drain_timeout=DeliveryConfig.DRAIN_TIMEOUT)
+    if TurnConfig.FAST_ACK:
+        BOT.start_turn_dispatcher(shards=TurnConfig.SHARDS,
+                                  shard_max_size=TurnConfig.SHARD_MAX_SIZE,
+                                  put_timeout=TurnConfig.PUT_TIMEOUT,
+                                  drain_timeout=TurnConfig.DRAIN_TIMEOUT)
+    if WriteBehindConfig.ENABLED:
+        STORAGE_CLIENT.start_write_buffer(
+            max_size=WriteBehindConfig.MAX_SIZE,
+            batch_size=WriteBehindConfig.BATCH_SIZE,
+            flush_interval=WriteBehindConfig.FLUSH_INTERVAL,
+            max_retries=WriteBehindConfig.MAX_RETRIES
+        )
+    if ProjectorConfig.ENABLED:
+        STORAGE_CLIENT.start_status_projector(
+            poll_interval=ProjectorConfig.POLL_INTERVAL,
+            max_item_count=ProjectorConfig.MAX_ITEM_COUNT
+        )
+    if RetentionConfig.ARCHIVE_ENABLED:
+        STORAGE_CLIENT.start_archiver(
+            path=RetentionConfig.ARCHIVE_PATH,
+            interval=RetentionConfig.ARCHIVE_INTERVAL,
+            lead=RetentionConfig.ARCHIVE_LEAD,
+            page_size=RetentionConfig.ARCHIVE_PAGE_SIZE
+        )
+    record_startup_timing("workers")
+    Log.i(TAG, f"on_app_startup::timings: {STARTUP_TIMINGS}")
+
+
+async def on_app_cleanup(_app: web.Application) -> None:
+    """ Drain background workers and release DB connections on shutdown """
+    # queued turns and sends still need the storage and the connections
+    await BOT.stop_turn_dispatcher()
+    await BOT.stop_delivery_queue()
+    await BOT.stop_flow_dispatcher()
+    await BOT.close_http_sessions()
+    await ADAPTER.close()
+    await STORAGE_CLIENT.close()
 
 
 async def app_factory(bot):
     """ Create the app """
+    global STARTUP_START
 
+    STARTUP_START = time.perf_counter()
     await init_db_containers()
+    record_startup_timing("storage")
 
-    app = web.Application(middlewares=[error_middleware])
+    app = web.Application(middlewares=[startup_timing_middleware,
+                                       error_middleware])
+    app.on_startup.append(on_app_startup)
+    app.on_cleanup.append(on_app_cleanup)
     app.router.add_post("/api/v1/messages", v1_messages)
     app.router.add_post("/api/v1/notification", v1_post_notification)
+    app.router.add_post("/api/v1/notifications/batch",
+                        v1_post_notifications_batch)
     app.router.add_get("/api/v1/notification/{notification_id}",
                        v1_get_notification)
     app.router.add_get("/api/v1/initiations/{notification_id}",
                        v1_get_initiations)
     app.router.add_get("/api/v1/health-check", v1_get_health_check)
+    app.router.add_get("/api/v1/metrics", v1_get_metrics)
     app.router.add_get("/{}".format(TeamsAppConfig.zip_name), v1_get_app_zip)
     app.router.add_post("/api/v1/auth", v1_post_auth)
 
@@ -335,7 +523,14 @@ async def app_factory(bot):
     app.router.add_post("/api/pa/v1/message", v1_pa_message)
     app.router.add_post("/api/pa/v1/authorize", v1_pa_authorize)
     bot.add_web_app(app)
-    bot.add_cosmos_client(COSMOS_CLIENT)
+    bot.add_storage_client(STORAGE_CLIENT)
+    bot.add_outbound_limiter(OutboundLimiter(
+        conversation_limits=parse_limits(OutboundConfig.CONVERSATION_LIMITS),
+        global_limits=parse_limits(OutboundConfig.GLOBAL_LIMITS),
+        burst=OutboundConfig.BURST,
+        max_retries=OutboundConfig.MAX_RETRIES
+    ))
+    record_startup_timing("app")
 
     return app
 
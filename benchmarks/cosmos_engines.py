@@ -0,0 +1,123 @@
+""" Threaded vs aio Cosmos engine benchmark.
+
+    Runs the same burst of point reads and creates through CosmosClient with
+    each engine against a scratch container and prints throughput and
+    latency percentiles.
+
+    Usage:
+        ACCOUNT_HOST=... COSMOS_KEY=... python -m benchmarks.cosmos_engines \\
+            --requests 2000 --concurrency 200
+"""
+import argparse
+import asyncio
+import os
+import time
+import uuid
+from typing import List, Dict, Any
+
+from azure.cosmos import PartitionKey
+
+from utils.cosmos_client import CosmosClient
+from utils.cosmos_engines import Engines
+
+
+DATABASE = "bench"
+CONTAINER = "engines"
+PARTITION_KEY = PartitionKey(path="/pk")
+
+
+def percentile(values: List[float], p: float) -> float:
+    """ Nearest-rank percentile """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))
+    return values[index]
+
+
+async def run_burst(client: CosmosClient, container, op: str, total: int,
+                    concurrency: int, ids: List[str]) -> Dict[str, Any]:
+    """ Run `total` operations with at most `concurrency` in flight """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(i: int) -> None:
+        """ Single operation """
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                if op == "read":
+                    item_id = ids[i % len(ids)]
+                    await client.get_item(container, item_id, item_id)
+                else:
+                    item_id = uuid.uuid4().__str__()
+                    await client.create_item(container, dict(id=item_id,
+                                                             pk=item_id))
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(total)])
+    took = time.perf_counter() - start
+    return dict(op=op, total=total, errors=errors, seconds=took,
+                rps=total / took if took else 0.0,
+                p50=percentile(latencies, 50) * 1000,
+                p95=percentile(latencies, 95) * 1000,
+                p99=percentile(latencies, 99) * 1000)
+
+
+async def bench_engine(engine: str, host: str, key: str, total: int,
+                       concurrency: int) -> List[Dict[str, Any]]:
+    """ Benchmark one engine """
+    client = CosmosClient(host, key, engine=engine, pool_size=concurrency)
+    try:
+        await client.create_db(DATABASE)
+        container = await client.create_container(DATABASE, CONTAINER,
+                                                  PARTITION_KEY)
+        ids = []
+        for _ in range(min(total, 50)):
+            item_id = uuid.uuid4().__str__()
+            await client.create_item(container, dict(id=item_id, pk=item_id))
+            ids.append(item_id)
+        results = []
+        for op in ("read", "create"):
+            result = await run_burst(client, container, op, total,
+                                     concurrency, ids)
+            result.update(dict(engine=engine))
+            results.append(result)
+        return results
+    finally:
+        await client.close()
+
+
+def main():
+    """ Entry point """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default=os.environ.get("ACCOUNT_HOST"))
+    parser.add_argument("--key", default=os.environ.get("COSMOS_KEY"))
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--engines", nargs="+",
+                        default=[Engines.THREADED, Engines.AIO])
+    args = parser.parse_args()
+
+    line = "{engine:>9} {op:>7} {total:>7} {errors:>6} {rps:>9.1f} " \
+           "{p50:>8.1f} {p95:>8.1f} {p99:>8.1f}"
+    print("{:>9} {:>7} {:>7} {:>6} {:>9} {:>8} {:>8} {:>8}".format(
+        "engine", "op", "total", "errors", "req/s", "p50 ms", "p95 ms",
+        "p99 ms"
+    ))
+    for engine in args.engines:
+        results = asyncio.get_event_loop().run_until_complete(
+            bench_engine(engine, args.host, args.key, args.requests,
+                         args.concurrency)
+        )
+        for result in results:
+            print(line.format(**result))
+
+
+if __name__ == "__main__":
+    main()
@@ -15,3 +15,10 @@ class ConversationNotFound(BotException):
 class DataParsingError(BotException):
     """ Data Parsing Error """
     pass
+
+
+class SendThrottled(BotException):
+    """ The connector has answered 429, the send is to be re-queued """
+    def __init__(self, error: Exception):
+        super().__init__("Send throttled")
+        self.error = error
@@ -4,7 +4,7 @@ import sys
 import time
 import uuid
 from asyncio import Future
-from typing import Optional, Dict, Union, List
+from typing import Optional, Dict, Union, List, Any, Awaitable, Callable
 from urllib.parse import urlparse, parse_qsl, urlencode, unquote
 
 import aiohttp
@@ -12,7 +12,7 @@ from aiohttp.web_app import Application
 from botbuilder.core import (TurnContext, CardFactory, BotFrameworkAdapter,
                              BotFrameworkAdapterSettings, MessageFactory)
 from botbuilder.schema import Activity, ActivityTypes, ResourceResponse, \
-    AttachmentLayoutTypes
+    AttachmentLayoutTypes, ConversationReference
 from botbuilder.schema.teams import (TaskModuleContinueResponse,
                                      TaskModuleTaskInfo, TaskModuleResponse,
                                      TaskModuleRequest)
@@ -20,14 +20,21 @@ from botbuilder.core.teams import TeamsActivityHandler
 from botframework.connector import Channels
 from marshmallow import EXCLUDE
 
-from bots.exceptions import ConversationNotFound
+from bots.exceptions import BotException, ConversationNotFound, \
+    SendThrottled
 from config import TaskModuleConfig, AppConfig
 from entities.json.medx import MedX, MXTypes
 from entities.json.notification import NotificationCosmos
+from entities.json.notification_summary import NotificationStatus
 from utils.card_helper import CardHelper
-from utils.cosmos_client import CosmosClient, ItemNotFound
+from utils.delivery_queue import DeliveryQueue, DeliveryQueueFull, Priority
+from utils.flow_dispatcher import FlowDispatcher
+from utils.storage_backend import StorageBackend, ItemNotFound, ItemExists
 from utils.functions import get_i18n
+from utils.http_sessions import HttpSessionPool
 from utils.log import Log
+from utils.outbound_limiter import OutboundLimiter, TOO_MANY_REQUESTS
+from utils.turn_dispatcher import TurnDispatcher
 
 
 TAG = __name__
@@ -39,25 +46,88 @@ class TeamsMessagingExtensionsActionPreviewBot(TeamsActivityHandler):
     settings: BotFrameworkAdapterSettings
     adapter: BotFrameworkAdapter
     app: Application
-    cosmos_client: CosmosClient
+    storage: StorageBackend
 
     def __init__(self, settings: BotFrameworkAdapterSettings,
                  adapter: BotFrameworkAdapter):
         self.settings = settings
         self.adapter = adapter
+        self.delivery_queue: Optional[DeliveryQueue] = None
+        self.outbound_limiter: Optional[OutboundLimiter] = None
+        self.http_sessions: Optional[HttpSessionPool] = None
+        self.flow_dispatcher: Optional[FlowDispatcher] = None
+        self.turn_dispatcher: Optional[TurnDispatcher] = None
+        # notification sends by id, not settled by their callback yet
+        self.queued_notifications: Dict[str, NotificationCosmos] = {}
 
     def add_web_app(self, app):
         """ Add web app instance """
         self.app = app
 
-    def add_cosmos_client(self, cosmos_client: CosmosClient):
-        """ Add cosmos client to the bot """
-        self.cosmos_client = cosmos_client
+    def add_storage_client(self, storage: StorageBackend):
+        """ Add storage client to the bot """
+        self.storage = storage
 
     def add_adapter(self, adapter):
         """ Add bot adapter instance """
         self.adapter = adapter
 
+    def add_outbound_limiter(self, limiter: OutboundLimiter):
+        """ Pace the proactive sends with the limiter """
+        self.outbound_limiter = limiter
+
+    def start_http_sessions(self, **kwargs) -> HttpSessionPool:
+        """ Open the shared outbound HTTP session,
+            kwargs are passed to HttpSessionPool """
+        if self.http_sessions is None:
+            self.http_sessions = HttpSessionPool(**kwargs)
+        # create the session within the event loop, before the first call
+        _ = self.http_sessions.session
+        return self.http_sessions
+
+    async def close_http_sessions(self) -> None:
+        """ Close the shared outbound HTTP session """
+        if self.http_sessions is not None:
+            await self.http_sessions.close()
+            self.http_sessions = None
+
+    def get_http_session(self) -> aiohttp.ClientSession:
+        """ Shared outbound HTTP session """
+        if self.http_sessions is None:
+            return self.start_http_sessions().session
+        return self.http_sessions.session
+
+    async def start_flow_dispatcher(self, path: str, **kwargs)\
+            -> FlowDispatcher:
+        """ Start the flow dispatch workers,
+            kwargs are passed to FlowDispatcher """
+        if self.flow_dispatcher is None:
+            dispatcher = FlowDispatcher(path, self.get_http_session,
+                                        **kwargs)
+            await dispatcher.start()
+            self.flow_dispatcher = dispatcher
+        return self.flow_dispatcher
+
+    async def stop_flow_dispatcher(self) -> None:
+        """ Stop the flow dispatch workers, the queued calls are kept """
+        if self.flow_dispatcher is not None:
+            await self.flow_dispatcher.stop()
+            self.flow_dispatcher = None
+
+    async def send_proactive_activity(self, turn_context: TurnContext,
+                                      activity: Activity)\
+            -> Optional[ResourceResponse]:
+        """ Send activity of a deliver() callback. Raises SendThrottled on
+            a 429 when the sends are rate limited, deliver() re-queues the
+            send """
+        try:
+            return await turn_context.send_activity(activity)
+        except Exception as e:
+            if (self.outbound_limiter is not None
+                    and OutboundLimiter.get_status(e) == TOO_MANY_REQUESTS):
+                raise SendThrottled(e)
+            raise
+
     @staticmethod
     def get_mx(turn_context: TurnContext) -> Optional[MedX]:
         """ Get Medx data """
@@ -83,102 +153,277 @@ class TeamsMessagingExtensionsActionPreviewBot(TeamsActivityHandler):
             mx = turn_context.activity.value.get("mx", {})
             return mx.get("notificationId", None)
 
-    def send_message(self,
-                     conversation_id: str,
-                     tenant_id: str, text: str = None,
-                     card: Optional[Dict[any, any]] = None,
-                     cards: Optional[List[Dict[any, any]]] = None
-                     ) -> Future[ResourceResponse]:
-        """ Send message as a bot """
-        io_loop = asyncio.get_event_loop()
-        future = Future()
-
-        async def routine():
-            """ async routine """
+    async def get_conversation_reference(self, conversation_id: str,
+                                         tenant_id: Optional[str] = None)\
+            -> ConversationReference:
+        """ Get conversation reference, raises ConversationNotFound """
+        try:
+            return await self.storage.get_conversation(conversation_id,
+                                                       tenant_id)
+        except ItemNotFound:
+            raise ConversationNotFound("not found")
+
+    def start_delivery_queue(self, **kwargs) -> DeliveryQueue:
+        """ Start outbound delivery workers,
+            kwargs are passed to DeliveryQueue """
+        if self.delivery_queue is None:
+            self.delivery_queue = DeliveryQueue(**kwargs)
+            self.delivery_queue.start()
+        return self.delivery_queue
+
+    async def stop_delivery_queue(self) -> None:
+        """ Drain and stop outbound delivery workers """
+        if self.delivery_queue is not None:
+            await self.delivery_queue.stop()
+            self.delivery_queue = None
+        # the sends dropped by stop(), before the storage closes
+        dropped = list(self.queued_notifications.values())
+        self.queued_notifications.clear()
+        for notification in dropped:
+            await self.set_notification_status(notification,
+                                               NotificationStatus.FAILED)
+
+    def start_turn_dispatcher(self, **kwargs) -> TurnDispatcher:
+        """ Start inbound turn workers,
+            kwargs are passed to TurnDispatcher """
+        if self.turn_dispatcher is None:
+            self.turn_dispatcher = TurnDispatcher(**kwargs)
+            self.turn_dispatcher.start()
+        return self.turn_dispatcher
+
+    async def stop_turn_dispatcher(self) -> None:
+        """ Drain and stop inbound turn workers """
+        if self.turn_dispatcher is not None:
+            await self.turn_dispatcher.stop()
+            self.turn_dispatcher = None
+
+    def deliver(self, reference: ConversationReference,
+                callback: Callable[[TurnContext], Awaitable],
+                result: Future, priority: int) -> None:
+        """ Queue continue_conversation with the callback that settles
+            `result`. The send is scheduled for its outbound slot, a
+            throttled send is re-queued. Raises DeliveryQueueFull """
+        service_url = reference.service_url
+        conversation_id = reference.conversation.id
+        attempt = 0
+        throttled: Optional[SendThrottled] = None
+
+        async def logic(turn_context: TurnContext) -> None:
+            """ Catch the 429 before the turn error handler does """
+            nonlocal throttled
+            try:
+                await callback(turn_context)
+            except SendThrottled as e:
+                throttled = e
+
+        async def job() -> None:
+            """ Send on a delivery worker """
+            nonlocal attempt, throttled
+            throttled = None
             try:
-                reference = await self.cosmos_client.get_conversation(
-                    conversation_id, tenant_id
+                await self.adapter.continue_conversation(
+                    reference, logic, self.settings.app_id
                 )
-            except ItemNotFound:
-                future.set_exception(ConversationNotFound("not found"))
-                return
-            except Exception as e:
-                future.set_exception(e)
+            except Exception as exception:
+                if not result.done():
+                    result.set_exception(exception)
+                raise
+            if throttled is not None:
+                attempt += 1
+                error = throttled.error
+                if self.outbound_limiter.throttle(service_url,
+                                                  conversation_id, error,
+                                                  attempt):
+                    try:
+                        submit()
+                        return
+                    except DeliveryQueueFull as e:
+                        error = e
+                if not result.done():
+                    result.set_exception(error)
                 return
+            if not result.done():
+                # the turn error handler has swallowed the error
+                result.set_exception(BotException("Message not sent"))
+
+        def on_dropped(queued: Future) -> None:
+            """ stop() has cancelled the queued send """
+            if queued.cancelled() and not result.done():
+                result.cancel()
+
+        def submit() -> None:
+            """ Queue the job for its outbound slot """
+            if self.delivery_queue is None:
+                raise DeliveryQueueFull("Delivery queue is not running")
+            delay = (self.outbound_limiter.reserve(service_url,
+                                                   conversation_id)
+                     if self.outbound_limiter is not None else 0.0)
+            self.delivery_queue.submit(job, priority, delay)\
+                .add_done_callback(on_dropped)
+
+        submit()
+
+    async def send_message(self,
+                           conversation_id: str,
+                           tenant_id: str, text: str = None,
+                           card: Optional[Dict[any, any]] = None,
+                           cards: Optional[List[Dict[any, any]]] = None
+                           ) -> Optional[ResourceResponse]:
+        """ Send message as a bot """
+        reference = await self.get_conversation_reference(conversation_id,
+                                                          tenant_id)
+        future = asyncio.get_event_loop().create_future()
 
-            async def callback(turn_context: TurnContext) -> None:
-                """ Turn Context callback. Kinda awful syntax, I know """
-                try:
-                    attachments = None
-                    if cards is not None:
-                        Log.i(TAG, f"send_message::cards: {cards}")
-                        attachments = [
-                            CardFactory.adaptive_card(x) for x in cards
-                        ]
-                    elif card is not None:
-                        # TODO(s1z): create parase for all card types
-                        attachments = [CardFactory.adaptive_card(card)]
-
-                    activity = Activity(type=ActivityTypes.message,
-                                        text=text, attachments=attachments)
-                    if len(attachments) > 1:
-                        activity.attachment_layout = (
-                            AttachmentLayoutTypes.carousel
-                        )
-                    response = await turn_context.send_activity(activity)
-                    if response:
-                        future.set_result(response)
-                except Exception as exception:
-                    future.set_exception(exception)
-
-            await self.adapter.continue_conversation(reference, callback,
-                                                     self.settings.app_id)
-        io_loop.create_task(routine())
-        return future
-
-    def send_notification(self, notification: NotificationCosmos)\
-            -> Future[str]:
-        """ Notify conversation that there's a message waiting in portal """
-        io_loop = asyncio.get_event_loop()
-        future = Future()
+        async def callback(turn_context: TurnContext) -> None:
+            """ Turn Context callback. Kinda awful syntax, I know """
+            try:
+                attachments = None
+                if cards is not None:
+                    Log.i(TAG, f"send_message::cards: {cards}")
+                    attachments = [
+                        CardFactory.adaptive_card(x) for x in cards
+                    ]
+                elif card is not None:
+                    # TODO(s1z): create parase for all card types
+                    attachments = [CardFactory.adaptive_card(card)]
 
+                activity = Activity(type=ActivityTypes.message,
+                                    text=text, attachments=attachments)
+                if len(attachments) > 1:
+                    activity.attachment_layout = (
+                        AttachmentLayoutTypes.carousel
+                    )
+                future.set_result(await self.send_proactive_activity(
+                    turn_context, activity
+                ))
+            except SendThrottled:
+                # deliver() re-queues the send or fails the future
+                raise
+            except Exception as exception:
+                future.set_exception(exception)
+
+        self.deliver(reference, callback, future, Priority.HIGH)
+        return await future
+
+    async def send_notification(self, notification: NotificationCosmos,
+                                priority: int = Priority.HIGH,
+                                wait: bool = True) -> str:
+        """ Notify conversation that there's a message waiting in portal.
+            The notification and its PENDING delivery are saved before the
+            send is queued. With wait=False returns the notification id
+            once the send is queued, the delivery status tells how it
+            went """
         # reset parameters
         notification.id = uuid.uuid4().__str__()
         notification.tenant_id = AppConfig.TENANT_ID
 
-        async def routine():
-            """ async routine """
+        reference = await self.get_conversation_reference(
+            notification.destination
+        )
+        saved_notification = \
+            await self.storage.create_notification(notification)
+        future = asyncio.get_event_loop().create_future()
+
+        async def callback(turn_context: TurnContext) -> None:
+            """ Turn Context callback. Kinda awful syntax, I know """
             try:
-                reference = await self.cosmos_client.get_conversation(
-                    notification.destination
+                card = CardHelper.create_notification_card(
+                    saved_notification
                 )
-            except ItemNotFound:
-                future.set_exception(ConversationNotFound("not found"))
-                return
-            except Exception as e:
-                future.set_exception(e)
+                attachments = [CardFactory.adaptive_card(card)]
+                message = Activity(type=ActivityTypes.message,
+                                   attachments=attachments)
+                await self.send_proactive_activity(turn_context, message)
+            except SendThrottled:
+                # deliver() re-queues the send or fails the future
+                raise
+            except Exception as exception:
+                self.queued_notifications.pop(notification.id, None)
+                await self.set_notification_status(
+                    notification, NotificationStatus.FAILED
+                )
+                future.set_exception(exception)
                 return
+            self.queued_notifications.pop(notification.id, None)
+            await self.set_notification_status(
+                notification, NotificationStatus.DELIVERED
+            )
+            future.set_result(notification.id)
+
+        def on_done(_future: Future) -> None:
+            """ The send has failed outside the callback """
+            if self.queued_notifications.pop(notification.id, None):
+                asyncio.ensure_future(self.set_notification_status(
+                    notification, NotificationStatus.FAILED
+                ))
+
+        try:
+            self.deliver(reference, callback, future, priority)
+        except DeliveryQueueFull:
+            await self.set_notification_status(notification,
+                                               NotificationStatus.FAILED)
+            raise
+        self.queued_notifications[notification.id] = notification
+        future.add_done_callback(on_done)
+        if not wait:
+            future.add_done_callback(self.log_send_error)
+            return notification.id
+        return await future
 
-            async def callback(turn_context: TurnContext) -> None:
-                """ Turn Context callback. Kinda awful syntax, I know """
+    @staticmethod
+    def log_send_error(future: Future) -> None:
+        """ Log the error of a send nobody waits for """
+        if future.cancelled() or future.exception() is None:
+            return
+        exception = future.exception()
+        Log.e(TAG, "log_send_error::send error",
+              (type(exception), exception, exception.__traceback__))
+
+    async def set_notification_status(self, notification: NotificationCosmos,
+                                      status: str) -> None:
+        """ Update the delivery status, errors are logged and ignored:
+            the message has been sent (or not) already """
+        # noinspection PyBroadException
+        try:
+            await self.storage.set_notification_status(
+                notification.id, status, notification.tenant_id
+            )
+        except Exception:
+            Log.e(TAG, f"set_notification_status::{notification.id} "
+                       f"{status} error", sys.exc_info())
+
+    async def send_notifications(self,
+                                 notifications: List[NotificationCosmos],
+                                 concurrency: int = 20)\
+            -> List[Dict[str, Any]]:
+        """ Fan out notifications with at most `concurrency` sends in flight.
+            Returns per-destination results in the same order """
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+        async def send(notification: NotificationCosmos) -> Dict[str, Any]:
+            """ Send one notification and catch its error """
+            result = dict(destination=notification.destination,
+                          messageId=notification.message_id,
+                          notificationId=None, error=None)
+            async with semaphore:
+                # noinspection PyBroadException
                 try:
-                    card = CardHelper.create_notification_card(
-                        await self.cosmos_client.create_notification(
-                            notification
+                    result.update(dict(
+                        notificationId=await self.send_notification(
+                            notification, Priority.LOW
                         )
-                    )
-                    attachments = [CardFactory.adaptive_card(card)]
-                    message = Activity(type=ActivityTypes.message,
-                                       attachments=attachments)
-                    await turn_context.send_activity(message)
-                    future.set_result(notification.id)
-                except Exception as exception:
-                    future.set_exception(exception)
-
-            await self.adapter.continue_conversation(reference, callback,
-                                                     self.settings.app_id)
-        io_loop.create_task(routine())
-        return future
+                    ))
+                except ConversationNotFound:
+                    result.update(dict(error="Conversation not found"))
+                except DeliveryQueueFull:
+                    result.update(dict(error="Delivery queue is full"))
+                except Exception:
+                    Log.e(TAG, "send_notifications::error", sys.exc_info())
+                    result.update(dict(error="Send error"))
+            return result
+
+        return list(await asyncio.gather(*[send(notification)
+                                           for notification in notifications]))
 
     @staticmethod
     def generate_url(url: str, channel_id: str) -> str:
@@ -192,7 +437,7 @@ class TeamsMessagingExtensionsActionPreviewBot(TeamsActivityHandler):
     async def on_conversation_update_activity(self, turn_context: TurnContext):
         """ On update conversation """
         i18n = get_i18n(turn_context)
-        await self.cosmos_client.create_conversation_reference(turn_context)
+        await self.storage.create_conversation_reference(turn_context)
         if turn_context.activity.channel_id == Channels.ms_teams:
             members = []
             for member in turn_context.activity.members_added:
@@ -223,15 +468,12 @@ class TeamsMessagingExtensionsActionPreviewBot(TeamsActivityHandler):
         if mx.type == MXTypes.ACKNOWLEDGE:
             try:
                 account = turn_context.activity.from_property
-                ack_objects = await self.cosmos_client.get_acknowledge_items(
-                    mx.notification_id
-                )
-                if len(ack_objects) > 0:
+                if await self.storage.has_acknowledge(mx.notification_id):
                     return
 
-                await self.cosmos_client.create_acknowledge(mx.notification_id,
-                                                            account)
-                notification = await self.cosmos_client.get_notification(
+                await self.storage.create_acknowledge(mx.notification_id,
+                                                      account)
+                notification = await self.storage.get_notification(
                     mx.notification_id
                 )
                 card = CardHelper.create_notification_card(
@@ -246,6 +488,9 @@ class TeamsMessagingExtensionsActionPreviewBot(TeamsActivityHandler):
             except ItemNotFound:
                 # DO NOTHING, Notification not found!
                 pass
+            except ItemExists:
+                # DO NOTHING, acknowledged already
+                pass
             return
         await turn_context.send_activity(i18n.t("unknown_request"))
 
@@ -259,7 +504,7 @@ class TeamsMessagingExtensionsActionPreviewBot(TeamsActivityHandler):
             return
 
         # save conversation reference
-        reference = await self.cosmos_client.create_conversation_reference(
+        reference = await self.storage.create_conversation_reference(
             turn_context
         )
 
@@ -369,7 +614,7 @@ class TeamsMessagingExtensionsActionPreviewBot(TeamsActivityHandler):
             _, cmd, url = params
             # noinspection PyBroadException
             try:
-                _ = await self.cosmos_client.create_flow(cmd, url)
+                _ = await self.storage.create_flow(cmd, url)
                 await turn_context.send_activity("Flow cmd saved")
                 return
             except Exception:
@@ -382,18 +627,24 @@ class TeamsMessagingExtensionsActionPreviewBot(TeamsActivityHandler):
         async def request():
             """ request """
             try:
-                flow = await self.cosmos_client.get_flow(message)
+                flow = await self.storage.find_flow(message)
+                if flow is None:
+                    return False
                 Log.e(TAG, f"on_message_activity::flow.url:{flow.url}")
-                async with aiohttp.ClientSession() as session:
-                    # TODO(s1z): string bot's @mention if needed.
-                    data = dict(reference=reference, message=message)
-                    async with session.post(flow.url, json=data) as resp:
-                        Log.e(TAG, f"on_message_activity::response.status:"
-                                   f"{resp.status}")
-                        rest_text = await resp.text()
-                        Log.e(TAG, f"on_message_activity::"
-                                   f"response.text: {rest_text}")
-                        return True
+                # TODO(s1z): string bot's @mention if needed.
+                data = dict(reference=reference, message=message)
+                if self.flow_dispatcher is not None:
+                    # the turn ends once the call is persisted
+                    await self.flow_dispatcher.enqueue(flow.url, data)
+                    return True
+                session = self.get_http_session()
+                async with session.post(flow.url, json=data) as resp:
+                    Log.e(TAG, f"on_message_activity::response.status:"
+                               f"{resp.status}")
+                    rest_text = await resp.text()
+                    Log.e(TAG, f"on_message_activity::"
+                               f"response.text: {rest_text}")
+                    return True
             except Exception:
                 Log.e(TAG, f"on_message_activity::get_flow:error", sys.exc_info())
             return False
@@ -413,7 +664,7 @@ class TeamsMessagingExtensionsActionPreviewBot(TeamsActivityHandler):
             -> TaskModuleResponse:
         """ On MX Task fetch Notification URL """
         try:
-            notification = await self.cosmos_client.get_notification(
+            notification = await self.storage.get_notification(
                 notification_id=notification_id
             )
             link = notification.url.link
@@ -465,8 +716,8 @@ class TeamsMessagingExtensionsActionPreviewBot(TeamsActivityHandler):
             # 1. save action to DB
             # 2. return URL
             initiator = turn_context.activity.from_property.name
-            await self.cosmos_client.create_initiation(initiator,
-                                                       mx.notification_id)
+            await self.storage.create_initiation(initiator,
+                                                 mx.notification_id)
             return await self.on_mx_task_notification_url(turn_context,
                                                           mx.notification_id)
         return await self.on_mx_task_default(turn_context)
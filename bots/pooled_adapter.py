@@ -0,0 +1,64 @@
+""" Bot Framework adapter counting and closing the connector clients """
+import sys
+from typing import Any, Dict
+
+from botbuilder.core import BotFrameworkAdapter, BotFrameworkAdapterSettings
+from botbuilder.schema import Activity
+from botframework.connector.aio import ConnectorClient
+from botframework.connector.auth import AppCredentials, ClaimsIdentity
+
+from utils.log import Log
+
+
+TAG = __name__
+
+
+class PooledBotFrameworkAdapter(BotFrameworkAdapter):
+    """ Counts and closes the connector clients cached by the SDK.
+
+        BotFrameworkAdapter keeps one ConnectorClient per (service URL,
+        app id, OAuth scope) in _connector_client_cache. The cache is left
+        to the SDK, the clients are counted here and closed by close() on
+        the app cleanup. """
+
+    def __init__(self, settings: BotFrameworkAdapterSettings):
+        super().__init__(settings)
+        self.connector_clients_created = 0
+        self.connector_clients_reused = 0
+
+    def _get_or_create_connector_client(self, service_url: str,
+                                        credentials: AppCredentials)\
+            -> ConnectorClient:
+        """ SDK cache lookup, counted """
+        cached = len(self._connector_client_cache)
+        client = super()._get_or_create_connector_client(service_url,
+                                                         credentials)
+        if len(self._connector_client_cache) > cached:
+            self.connector_clients_created += 1
+        else:
+            self.connector_clients_reused += 1
+        return client
+
+    async def authenticate(self, activity: Activity, auth_header: str)\
+            -> ClaimsIdentity:
+        """ Validate the request token, raises PermissionError.
+            Pass the identity to process_activity_with_identity() """
+        return await self._authenticate_request(activity, auth_header or "")
+
+    async def close(self) -> None:
+        """ Close the cached connector clients """
+        clients = list(self._connector_client_cache.values())
+        self._connector_client_cache.clear()
+        for client in clients:
+            # noinspection PyBroadException
+            try:
+                await client.close()
+            except Exception:
+                Log.w(TAG, "close::connector client close error",
+                      sys.exc_info())
+
+    def stats(self) -> Dict[str, Any]:
+        """ Connector clients counters """
+        return dict(connectorClients=len(self._connector_client_cache),
+                    connectorClientsCreated=self.connector_clients_created,
+                    connectorClientsReused=self.connector_clients_reused)
@@ -1,10 +1,17 @@
 """ Config """
 import os
+from typing import Optional
 
 from azure.cosmos import PartitionKey
 
 from utils.azure_key_vault_client import AzureKeyVaultClient
 from utils.cosmos_client import CosmosClient
+from utils.cosmos_engines import Engines
+from utils.indexing_policies import ASCENDING, make_policy
+from utils.partition_keys import PartitionKeyStrategy
+from utils.rate_governor import RateGovernor
+from utils.sqlite_client import SQLiteClient
+from utils.storage_backend import StorageBackend, StorageBackends
 from utils.token_helper import TokenHelper
 
 PROJECT_ROOT_PATH = os.path.dirname(os.path.abspath("__file__"))
@@ -16,6 +23,12 @@ STRINGS_PATH = os.path.join(ASSETS_PATH, "strings")
 APP_VERSION = "1.1.188"
 
 
+def get_ttl(name: str) -> Optional[int]:
+    """ Retention in seconds from the env, None - keep forever """
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
 class Auth:
     """ Auth type """
     class Types:
@@ -81,24 +94,201 @@ class AppConfig:
     )
 
 
+class NotificationConfig:
+    """ Notification endpoints """
+    BATCH_MAX_SIZE = int(os.environ.get("NOTIFICATION_BATCH_MAX_SIZE", 1000))
+    BATCH_CONCURRENCY = int(os.environ.get("NOTIFICATION_BATCH_CONCURRENCY",
+                                           20))
+    ACKS_PAGE_SIZE = 20
+    ACKS_MAX_PAGE_SIZE = 100
+
+
+class DeliveryConfig:
+    """ Outbound delivery queue, see DeliveryQueue """
+    WORKERS = int(os.environ.get("DELIVERY_WORKERS", 16))
+    MAX_SIZE = int(os.environ.get("DELIVERY_QUEUE_MAX_SIZE", 10000))
+    # seconds to wait for the queued sends on shutdown
+    DRAIN_TIMEOUT = float(os.environ.get("DELIVERY_DRAIN_TIMEOUT", 30))
+
+
+class TurnConfig:
+    """ Inbound turns processed after the 200, see TurnDispatcher.
+        Invoke activities are always processed inline """
+    FAST_ACK = os.environ.get("TURN_FAST_ACK", "0") == "1"
+    SHARDS = int(os.environ.get("TURN_SHARDS", 16))
+    SHARD_MAX_SIZE = int(os.environ.get("TURN_SHARD_MAX_SIZE", 100))
+    # seconds to wait for a slot of a full shard before the 503
+    PUT_TIMEOUT = float(os.environ.get("TURN_PUT_TIMEOUT", 5))
+    # seconds to wait for the queued turns on shutdown
+    DRAIN_TIMEOUT = float(os.environ.get("TURN_DRAIN_TIMEOUT", 30))
+
+
+class OutboundConfig:
+    """ Proactive sends rate limits, see OutboundLimiter.
+        "<messages>/<seconds>,..." """
+    CONVERSATION_LIMITS = os.environ.get("OUTBOUND_CONVERSATION_LIMITS",
+                                         "7/1,8/2,60/30,1800/3600")
+    GLOBAL_LIMITS = os.environ.get("OUTBOUND_GLOBAL_LIMITS", "50/1")
+    # share of every window sent at once, the rest is paced
+    BURST = float(os.environ.get("OUTBOUND_BURST", 0.25))
+    MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", 3))
+
+
+class HttpConfig:
+    """ Shared outbound HTTP session, see HttpSessionPool """
+    LIMIT = int(os.environ.get("HTTP_POOL_LIMIT", 100))
+    LIMIT_PER_HOST = int(os.environ.get("HTTP_POOL_LIMIT_PER_HOST", 10))
+    DNS_TTL = int(os.environ.get("HTTP_DNS_TTL", 300))
+    KEEPALIVE_TIMEOUT = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", 30))
+    TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 30))
+
+
+class FlowConfig:
+    """ Power Automate flow dispatch queue, see FlowDispatcher """
+    # kept out of the app directory, which a deploy replaces. On App
+    # Service $HOME (/home) is the persistent storage
+    QUEUE_PATH = os.environ.get(
+        "FLOW_QUEUE_PATH",
+        os.path.join(os.environ.get("HOME", PROJECT_ROOT_PATH), "data",
+                     "flows.db")
+    )
+    WORKERS = int(os.environ.get("FLOW_WORKERS", 4))
+    MAX_RETRIES = int(os.environ.get("FLOW_MAX_RETRIES", 8))
+    # backoff in seconds: base * 2 ^ attempt capped at max, with jitter
+    BASE_DELAY = float(os.environ.get("FLOW_RETRY_BASE_DELAY", 1))
+    MAX_DELAY = float(os.environ.get("FLOW_RETRY_MAX_DELAY", 300))
+
+
+class WriteBehindConfig:
+    """ Write-behind buffer for initiations and acknowledges """
+    ENABLED = os.environ.get("WRITE_BEHIND_ENABLED", "1") == "1"
+    MAX_SIZE = int(os.environ.get("WRITE_BEHIND_MAX_SIZE", 10000))
+    BATCH_SIZE = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", 100))
+    FLUSH_INTERVAL = float(os.environ.get("WRITE_BEHIND_FLUSH_INTERVAL", 0.2))
+    MAX_RETRIES = int(os.environ.get("WRITE_BEHIND_MAX_RETRIES", 5))
+
+
+class MetricsConfig:
+    """ In-process metrics """
+    # Cosmos metrics summary log interval in seconds, 0 - disabled
+    LOG_INTERVAL = float(os.environ.get("METRICS_LOG_INTERVAL", 300))
+
+
+class RetentionConfig:
+    """ Archival of the documents before their TTL expires, see
+        CosmosDBConfig.*.DEFAULT_TTL """
+    ARCHIVE_ENABLED = os.environ.get("ARCHIVE_ENABLED", "0") == "1"
+    ARCHIVE_PATH = os.environ.get("ARCHIVE_PATH",
+                                  os.path.join(PROJECT_ROOT_PATH, "archive"))
+    # run interval in seconds, must be well below ARCHIVE_LEAD
+    ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", 3600))
+    # archive documents this many seconds before they expire
+    ARCHIVE_LEAD = int(os.environ.get("ARCHIVE_LEAD", 86400))
+    ARCHIVE_PAGE_SIZE = int(os.environ.get("ARCHIVE_PAGE_SIZE", 500))
+
+
+class ProjectorConfig:
+    """ Notification status projection from the change feed """
+    ENABLED = os.environ.get("STATUS_PROJECTOR_ENABLED", "1") == "1"
+    POLL_INTERVAL = float(os.environ.get("STATUS_PROJECTOR_POLL_INTERVAL",
+                                         1.0))
+    MAX_ITEM_COUNT = int(os.environ.get("STATUS_PROJECTOR_MAX_ITEM_COUNT",
+                                        100))
+
+
+class CacheConfig:
+    """ In-process caches """
+    CONVERSATIONS_SIZE = int(os.environ.get("CONVERSATIONS_CACHE_SIZE", 1024))
+    CONVERSATIONS_TTL = float(os.environ.get("CONVERSATIONS_CACHE_TTL", 300))
+    REFERENCE_INDEX_SIZE = int(os.environ.get("REFERENCE_INDEX_SIZE", 10000))
+    FLOWS_SIZE = int(os.environ.get("FLOWS_CACHE_SIZE", 1024))
+    FLOWS_TTL = float(os.environ.get("FLOWS_CACHE_TTL", 60))
+
+
+class ThrottlingConfig:
+    """ Cosmos DB adaptive throttling, see RateGovernor """
+    INITIAL_LIMIT = int(os.environ.get("COSMOS_INITIAL_CONCURRENCY", 32))
+    MIN_LIMIT = int(os.environ.get("COSMOS_MIN_CONCURRENCY", 1))
+    MAX_LIMIT = int(os.environ.get("COSMOS_MAX_CONCURRENCY", 256))
+    MAX_RETRIES = int(os.environ.get("COSMOS_THROTTLE_MAX_RETRIES", 8))
+    # 429 retries done by the SDK itself before the governor sees the error
+    SDK_RETRIES = int(os.environ.get("COSMOS_SDK_THROTTLE_RETRIES", 0))
+
+
+class StorageConfig:
+    """ Storage backend """
+    # "cosmos" - Azure Cosmos DB, "sqlite" - embedded SQLite file
+    BACKEND = os.environ.get("STORAGE_BACKEND", StorageBackends.COSMOS)
+    SQLITE_PATH = os.environ.get("SQLITE_PATH",
+                                 os.path.join(PROJECT_ROOT_PATH, "bot.db"))
+
+
+class PartitionConfig:
+    """ Synthetic partition keys, see PartitionKeyStrategy.
+        0 - partition by /tenantId """
+    NOTIFICATIONS_BUCKETS = int(os.environ.get(
+        "NOTIFICATIONS_PARTITION_BUCKETS", 0
+    ))
+    FLOWS_BUCKETS = int(os.environ.get("FLOWS_PARTITION_BUCKETS", 0))
+
+
+# acknowledges and initiations are listed by notificationId ordered by _ts
+NOTIFICATION_ITEMS_POLICY = make_policy(
+    included=("/notificationId/?", "/timestamp/?", "/_ts/?"),
+    composite=[[("/notificationId", ASCENDING), ("/_ts", ASCENDING)]]
+)
+
+
 class CosmosDBConfig:
     """ Cosmos Databases """
     HOST = os.environ.get("ACCOUNT_HOST", "host")
     KEY = os.environ.get("COSMOS_KEY", "key")
+    # "aio" - native asyncio SDK, "threaded" - sync SDK on a thread pool
+    ENGINE = os.environ.get("COSMOS_ENGINE", Engines.AIO)
+    POOL_SIZE = int(os.environ.get("COSMOS_POOL_SIZE", 100))
+    POOL_SIZE_PER_HOST = int(os.environ.get("COSMOS_POOL_SIZE_PER_HOST", 0))
+    # skip container creation on startup if the marker matches the
+    # definitions, the marker is written after every provisioning
+    VERIFY_ONLY = os.environ.get("COSMOS_VERIFY_ONLY", "0") == "1"
+    PROVISIONING_MARKER = os.environ.get(
+        "COSMOS_PROVISIONING_MARKER",
+        os.path.join(PROJECT_ROOT_PATH, ".cosmos-provisioned")
+    )
+    # "1" - replace the indexing policy of the existing containers if it
+    # drifted from INDEXING_POLICY, "0" - only report the drift. Opt-in:
+    # reindexing an existing container consumes RUs until it's done
+    APPLY_INDEXING_POLICY = os.environ.get(
+        "COSMOS_APPLY_INDEXING_POLICY", "0"
+    ) == "1"
 
+    # DEFAULT_TTL - container default TTL in seconds applied on startup,
+    # None - not managed (a TTL set earlier stays as it is)
+    # INDEXING_POLICY - only the filtered and ordered paths are indexed,
+    # /_ts is needed by the Archiver
     class Conversations:
         """ Conversation DB """
         DATABASE = "bot"
         CONTAINER = "conversations"
         PK = "id"
         PARTITION_KEY = PartitionKey(path="/conversation/tenantId")
+        DEFAULT_TTL = None
+        INDEXING_POLICY = make_policy(included=("/_ts/?",))
 
     class Notifications:
         """ Notifications DB """
+        PARTITION_STRATEGY = PartitionKeyStrategy(
+            PartitionConfig.NOTIFICATIONS_BUCKETS
+        )
         DATABASE = "bot"
-        CONTAINER = "notifications"
+        CONTAINER = PARTITION_STRATEGY.container_name("notifications")
+        LEGACY_CONTAINER = PARTITION_STRATEGY.legacy_container_name(
+            "notifications"
+        )
         PK = "id"
-        PARTITION_KEY = PartitionKey(path="/tenantId")
+        PARTITION_KEY = PartitionKey(path=PARTITION_STRATEGY.path)
+        DEFAULT_TTL = get_ttl("NOTIFICATIONS_TTL")
+        # message, card and the rest of the body are never filtered on
+        INDEXING_POLICY = make_policy(included=("/tenantId/?", "/_ts/?"))
 
     class Acknowledges:
         """ Acknowledges"""
@@ -106,6 +296,8 @@ class CosmosDBConfig:
         CONTAINER = "acknowledges"
         PK = "id"
         PARTITION_KEY = PartitionKey(path="/notificationId")
+        DEFAULT_TTL = get_ttl("ACKNOWLEDGES_TTL")
+        INDEXING_POLICY = NOTIFICATION_ITEMS_POLICY
 
     class Initiations:
         """ Initiations """
@@ -113,16 +305,70 @@ class CosmosDBConfig:
         CONTAINER = "initiations"
         PK = "id"
         PARTITION_KEY = PartitionKey(path="/notificationId")
+        DEFAULT_TTL = get_ttl("INITIATIONS_TTL")
+        INDEXING_POLICY = NOTIFICATION_ITEMS_POLICY
 
     class Flows:
         """ Flows """
+        PARTITION_STRATEGY = PartitionKeyStrategy(
+            PartitionConfig.FLOWS_BUCKETS
+        )
+        DATABASE = "bot"
+        CONTAINER = PARTITION_STRATEGY.container_name("flows")
+        LEGACY_CONTAINER = PARTITION_STRATEGY.legacy_container_name("flows")
+        PK = "id"
+        PARTITION_KEY = PartitionKey(path=PARTITION_STRATEGY.path)
+        DEFAULT_TTL = None
+        INDEXING_POLICY = make_policy(included=("/tenantId/?", "/_ts/?"))
+
+    class Summaries:
+        """ Notification summaries, see StatusProjector """
+        DATABASE = "bot"
+        CONTAINER = "summaries"
+        PK = "id"
+        PARTITION_KEY = PartitionKey(path="/notificationId")
+        DEFAULT_TTL = get_ttl("NOTIFICATIONS_TTL")
+        INDEXING_POLICY = make_policy(included=("/_ts/?",))
+
+    class Leases:
+        """ Change feed continuations """
         DATABASE = "bot"
-        CONTAINER = "flows"
+        CONTAINER = "leases"
         PK = "id"
-        PARTITION_KEY = PartitionKey(path="/tenantId")
+        PARTITION_KEY = PartitionKey(path="/id")
+        DEFAULT_TTL = None
+        INDEXING_POLICY = make_policy()
+
+    # Containers created and registered on startup
+    CONTAINERS = [Conversations, Notifications, Acknowledges, Initiations,
+                  Flows, Summaries, Leases]
+
+
+def create_storage_client() -> StorageBackend:
+    """ Create the configured storage backend """
+    if StorageConfig.BACKEND == StorageBackends.SQLITE:
+        return SQLiteClient(StorageConfig.SQLITE_PATH)
+    if StorageConfig.BACKEND != StorageBackends.COSMOS:
+        raise ValueError(f"Unknown storage backend: '{StorageConfig.BACKEND}'")
+    return CosmosClient(
+        CosmosDBConfig.HOST, CosmosDBConfig.KEY,
+        engine=CosmosDBConfig.ENGINE,
+        conversation_cache_size=CacheConfig.CONVERSATIONS_SIZE,
+        conversation_cache_ttl=CacheConfig.CONVERSATIONS_TTL,
+        reference_index_size=CacheConfig.REFERENCE_INDEX_SIZE,
+        flow_cache_size=CacheConfig.FLOWS_SIZE,
+        flow_cache_ttl=CacheConfig.FLOWS_TTL,
+        pool_size=CosmosDBConfig.POOL_SIZE,
+        pool_size_per_host=CosmosDBConfig.POOL_SIZE_PER_HOST,
+        throttle_retries=ThrottlingConfig.SDK_RETRIES,
+        governor=RateGovernor(initial_limit=ThrottlingConfig.INITIAL_LIMIT,
+                              min_limit=ThrottlingConfig.MIN_LIMIT,
+                              max_limit=ThrottlingConfig.MAX_LIMIT,
+                              max_retries=ThrottlingConfig.MAX_RETRIES)
+    )
 
 
-COSMOS_CLIENT = CosmosClient(CosmosDBConfig.HOST, CosmosDBConfig.KEY)
+STORAGE_CLIENT = create_storage_client()
 KEY_VAULT_CLIENT = AzureKeyVaultClient(AppConfig.CLIENT_ID,
                                        AppConfig.KEY_VAULT)
 TOKEN_HELPER = TokenHelper(KEY_VAULT_CLIENT)
@@ -1,10 +1,15 @@
 """ Acknowledge object """
+import uuid
 from dataclasses import dataclass, field
 from typing import Optional
 
 from entities.json.camel_case_mixin import CamelCaseMixin, uuid_factory
 
 
+# Namespace of the deterministic acknowledge ids
+ACKNOWLEDGE_NAMESPACE = uuid.UUID("6b0f4a52-3c1e-4b8e-9d5a-0c2f6e1a7d43")
+
+
 @dataclass
 class Acknowledge(CamelCaseMixin):
     """ Acknowledge """
@@ -13,3 +18,9 @@ class Acknowledge(CamelCaseMixin):
     username: Optional[str] = field(default=None)
     user_aad_id: Optional[str] = field(default=None)
     timestamp: Optional[int] = field(default=None)
+
+    @staticmethod
+    def make_id(notification_id: str) -> str:
+        """ Deterministic id of the first acknowledge of the notification:
+            the later ones conflict, the check is a point read """
+        return uuid.uuid5(ACKNOWLEDGE_NAMESPACE, notification_id).__str__()
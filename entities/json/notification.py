@@ -1,6 +1,6 @@
 """ Notification object """
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import Optional, List
 
 import marshmallow.validate
 
@@ -44,3 +44,26 @@ class NotificationCosmos(Notification):
     id: Optional[str] = field(default=None)
     tenant_id: Optional[str] = field(default=None)
     timestamp: Optional[int] = field(default_factory=timestamp_factory)
+
+
+@dataclass
+class NotificationBatch(CamelCaseMixin):
+    """ One Notification for many destinations """
+    message_id: Optional[str]
+    destinations: List[str]
+    subject: Optional[str] = field(default=None)
+    message: Optional[str] = field(default=None)
+    title: Optional[str] = field(default=None)
+    url: Optional[NotificationUrl] = field(default_factory=NotificationUrl)
+    acknowledge: Optional[bool] = field(default=False)
+
+    def to_db(self) -> List[NotificationCosmos]:
+        """ Create NotificationCosmos per destination """
+        return [NotificationCosmos(message_id=self.message_id,
+                                   destination=destination,
+                                   subject=self.subject,
+                                   message=self.message,
+                                   title=self.title,
+                                   url=self.url,
+                                   acknowledge=self.acknowledge)
+                for destination in self.destinations]
@@ -0,0 +1,22 @@
+""" Notification delivery object """
+from dataclasses import dataclass, field
+from typing import Optional
+
+from entities.json.camel_case_mixin import CamelCaseMixin, timestamp_factory
+from entities.json.notification_summary import NotificationStatus
+
+
+@dataclass
+class NotificationDelivery(CamelCaseMixin):
+    """ Delivery status of the notification, stored in the notification
+        partition and created together with the notification """
+    id: str
+    notification_id: str
+    tenant_id: Optional[str] = field(default=None)
+    status: str = field(default=NotificationStatus.PENDING)
+    timestamp: Optional[int] = field(default_factory=timestamp_factory)
+
+    @staticmethod
+    def make_id(notification_id: str) -> str:
+        """ Deterministic id, one delivery per notification """
+        return f"{notification_id}:delivery"
@@ -0,0 +1,46 @@
+""" Notification summary object """
+from dataclasses import dataclass, field
+from typing import Optional
+
+from entities.json.camel_case_mixin import CamelCaseMixin, timestamp_factory
+
+
+class NotificationStatus:
+    """ Notification statuses """
+    PENDING = "PENDING"
+    FAILED = "FAILED"
+    DELIVERED = "DELIVERED"
+    OPENED = "OPENED"
+    ACKNOWLEDGED = "ACKNOWLEDGED"
+
+
+@dataclass
+class NotificationSummary(CamelCaseMixin):
+    """ Per notification counters projected from the acknowledges and
+        initiations, id is the notification id """
+    id: str
+    notification_id: str
+    status: str = field(default=NotificationStatus.DELIVERED)
+    ack_count: int = field(default=0)
+    first_ack_timestamp: Optional[int] = field(default=None)
+    last_ack_timestamp: Optional[int] = field(default=None)
+    initiation_count: int = field(default=0)
+    timestamp: Optional[int] = field(default_factory=timestamp_factory)
+
+    @classmethod
+    def build(cls, notification_id: str, ack_count: int,
+              first_ack_timestamp: Optional[int],
+              last_ack_timestamp: Optional[int],
+              initiation_count: int) -> "NotificationSummary":
+        """ Build summary, the status is derived from the counters """
+        if ack_count > 0:
+            status = NotificationStatus.ACKNOWLEDGED
+        elif initiation_count > 0:
+            status = NotificationStatus.OPENED
+        else:
+            status = NotificationStatus.DELIVERED
+        return cls(id=notification_id, notification_id=notification_id,
+                   status=status, ack_count=ack_count,
+                   first_ack_timestamp=first_ack_timestamp,
+                   last_ack_timestamp=last_ack_timestamp,
+                   initiation_count=initiation_count)
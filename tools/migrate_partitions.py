@@ -0,0 +1,112 @@
+""" Online migration to the synthetic partition key layout.
+
+    Copies every document of the legacy /tenantId container of a definition
+    (CosmosDBConfig.Notifications, CosmosDBConfig.Flows) to the container of
+    the configured PartitionKeyStrategy. Run it after the app has been
+    deployed with the new *_PARTITION_BUCKETS: the app writes to the new
+    container and reads fall back to the legacy one until the migration is
+    done. The documents are created, never upserted: a document the app
+    has written to the new container already (409) is newer and is left
+    as is. A failed run can be resumed with the last printed continuation
+    token.
+
+    Usage:
+        ACCOUNT_HOST=... COSMOS_KEY=... NOTIFICATIONS_PARTITION_BUCKETS=16 \\
+            python -m tools.migrate_partitions --container Notifications
+"""
+import argparse
+import asyncio
+import os
+import time
+from typing import Any, Dict, Optional
+
+from config import CosmosDBConfig
+from utils.cosmos_client import CosmosClient, ItemExists
+
+
+COPIED = "copied"
+# in the new container already, migrated or written by the app
+EXISTING = "existing"
+SKIPPED = "skipped"
+
+
+async def copy_document(client: CosmosClient, target: Any, strategy: Any,
+                        document: Dict[str, Any],
+                        semaphore: asyncio.Semaphore, dry_run: bool) -> str:
+    """ Copy one document unless it exists, returns COPIED, EXISTING or
+        SKIPPED if it can't be migrated """
+    body = {key: value for key, value in document.items()
+            if not key.startswith("_")}
+    if not body.get(strategy.TENANT_FIELD) or not body.get("id"):
+        return SKIPPED
+    strategy.apply(body)
+    if not dry_run:
+        async with semaphore:
+            try:
+                await client.create_item(target, body, max_tries=1)
+            except ItemExists:
+                return EXISTING
+    return COPIED
+
+
+async def migrate(host: str, key: str, name: str, concurrency: int,
+                  page_size: int, continuation: Optional[str],
+                  dry_run: bool) -> Dict[str, Any]:
+    """ Copy the legacy container to the new layout """
+    definition = getattr(CosmosDBConfig, name)
+    strategy = definition.PARTITION_STRATEGY
+    if not strategy.is_synthetic:
+        raise SystemExit(f"{name}: partition buckets are not configured")
+    client = CosmosClient(host, key, pool_size=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    copied = existing = skipped = 0
+    start = time.perf_counter()
+    try:
+        await client.create_db(definition.DATABASE)
+        target = await client.init_container(definition)
+        source = await client.get_container(definition.DATABASE,
+                                            definition.LEGACY_CONTAINER,
+                                            None)
+        async for page in client.query_pages(source,
+                                             max_item_count=page_size,
+                                             continuation=continuation):
+            results = await asyncio.gather(*[
+                copy_document(client, target, strategy, document, semaphore,
+                              dry_run)
+                for document in page.items
+            ])
+            copied += results.count(COPIED)
+            existing += results.count(EXISTING)
+            skipped += results.count(SKIPPED)
+            print(f"{definition.LEGACY_CONTAINER} -> {definition.CONTAINER}: "
+                  f"copied: {copied}, existing: {existing}, "
+                  f"skipped: {skipped}, "
+                  f"continuation: {page.continuation_token}", flush=True)
+    finally:
+        await client.close()
+    return dict(copied=copied, existing=existing, skipped=skipped,
+                seconds=round(time.perf_counter() - start, 3))
+
+
+def main():
+    """ Entry point """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default=os.environ.get("ACCOUNT_HOST"))
+    parser.add_argument("--key", default=os.environ.get("COSMOS_KEY"))
+    parser.add_argument("--container", required=True,
+                        choices=["Notifications", "Flows"])
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--continuation", default=None)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    result = asyncio.get_event_loop().run_until_complete(
+        migrate(args.host, args.key, args.container, args.concurrency,
+                args.page_size, args.continuation, args.dry_run)
+    )
+    print(f"done: {result}")
+
+
+if __name__ == "__main__":
+    main()
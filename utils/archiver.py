@@ -0,0 +1,138 @@
+""" Archival of the documents before their TTL expires """
+import asyncio
+import gzip
+import os
+import sys
+import time
+from typing import Any, Dict, IO, List, Optional, Sequence
+
+from utils.json_func import json_dumps
+from utils.log import Log
+
+
+TAG = __name__
+
+
+class Archiver:
+    """ Streams soon-to-expire documents to gzipped NDJSON segments.
+
+        Cosmos DB deletes expired documents by itself, there is no way to
+        catch them on the way out. So every `interval` seconds the archiver
+        copies the documents whose TTL expires within `lead` seconds:
+        the window [watermark, now - ttl + lead) of _ts, ordered by _ts, to
+        <path>/<container>/<from>-<to>.ndjson.gz. The segment is written to
+        a temp file and renamed when complete, then the watermark is saved
+        as a lease, so a failed run is simply repeated. `interval` must be
+        well below `lead`. `client` is a CosmosClient. """
+
+    def __init__(self, client: Any, definitions: Sequence[Any], path: str,
+                 interval: float = 3600, lead: int = 86400,
+                 page_size: int = 500):
+        self.client = client
+        self.definitions = [definition for definition in definitions
+                            if getattr(definition, "DEFAULT_TTL", None)
+                            and definition.DEFAULT_TTL > 0]
+        self.path = path
+        self.interval = interval
+        self.lead = lead
+        self.page_size = page_size
+        self.task: Optional[asyncio.Task] = None
+        self.segments = 0
+        self.documents = 0
+        self.errors = 0
+        self.last_run: Optional[float] = None
+
+    def start(self) -> None:
+        """ Start archiving """
+        if self.task is None and self.definitions:
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        """ Stop archiving """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self) -> None:
+        """ Archive loop """
+        while True:
+            for definition in self.definitions:
+                # noinspection PyBroadException
+                try:
+                    await self.archive(definition)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self.errors += 1
+                    Log.e(TAG, f"run::{definition.__name__} archive error",
+                          sys.exc_info())
+            self.last_run = time.time()
+            await asyncio.sleep(self.interval)
+
+    @staticmethod
+    def get_lease_name(definition: Any) -> str:
+        """ Watermark lease name """
+        return f"archive:{definition.__name__}"
+
+    async def archive(self, definition: Any) -> int:
+        """ Archive one window of the container, returns documents count """
+        name = definition.__name__
+        lease_name = self.get_lease_name(definition)
+        watermark = await self.client.get_lease(lease_name)
+        ts_from = int(watermark) if watermark else 0
+        ts_to = int(time.time()) - definition.DEFAULT_TTL + self.lead
+        if ts_to <= ts_from:
+            return 0
+        directory = os.path.join(self.path, definition.CONTAINER)
+        segment = os.path.join(directory, f"{ts_from}-{ts_to}.ndjson.gz")
+        loop = asyncio.get_event_loop()
+        f = await loop.run_in_executor(None, self.open_segment_bl,
+                                       f"{segment}.tmp")
+        count = 0
+        try:
+            container = await self.client.get_registered_container(name)
+            async for page in self.client.query_pages(
+                container,
+                where="r._ts >= @ts_from AND r._ts < @ts_to",
+                parameters=[{"name": "@ts_from", "value": ts_from},
+                            {"name": "@ts_to", "value": ts_to}],
+                order_by="r._ts",
+                max_item_count=self.page_size
+            ):
+                await loop.run_in_executor(None, self.write_bl, f,
+                                           page.items)
+                count += len(page.items)
+        finally:
+            await loop.run_in_executor(None, f.close)
+        if count:
+            await loop.run_in_executor(None, os.replace, f"{segment}.tmp",
+                                       segment)
+            self.segments += 1
+            self.documents += count
+        else:
+            await loop.run_in_executor(None, os.remove, f"{segment}.tmp")
+        await self.client.save_lease(lease_name, str(ts_to))
+        Log.i(TAG, f"archive::{name} [{ts_from}, {ts_to}): {count} documents")
+        return count
+
+    @staticmethod
+    def open_segment_bl(path: str) -> IO[bytes]:
+        """ Create segment file """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return gzip.open(path, "wb")
+
+    @staticmethod
+    def write_bl(f: IO[bytes], items: List[Dict[str, Any]]) -> None:
+        """ Append documents to the segment """
+        f.write("".join(json_dumps(item) + "\n"
+                        for item in items).encode("utf-8"))
+
+    def stats(self) -> Dict[str, Any]:
+        """ Archiver counters """
+        return dict(containers=[d.__name__ for d in self.definitions],
+                    segments=self.segments, documents=self.documents,
+                    errors=self.errors, lastRun=self.last_run)
@@ -0,0 +1,59 @@
+""" Resolve-once registry of Cosmos DB database/container handles """
+import time
+from typing import Dict, Optional, Any
+
+from azure.cosmos import DatabaseProxy, ContainerProxy
+
+
+class ContainerRegistry:
+    """ Keeps DatabaseProxy/ContainerProxy handles resolved on startup.
+
+        Handles are resolved once (init_db_containers) and served
+        synchronously afterwards, counters show what's left of the per-call
+        overhead. """
+
+    def __init__(self):
+        self.databases: Dict[str, DatabaseProxy] = {}
+        self.containers: Dict[str, ContainerProxy] = {}
+        self.resolves = 0
+        self.resolve_time = 0.0
+        self.lookups = 0
+        self.misses = 0
+        self.lookup_time_ns = 0
+
+    def add_database(self, database_id: str, db: DatabaseProxy) -> None:
+        """ Register database handle """
+        self.databases[database_id] = db
+
+    def get_database(self, database_id: str) -> Optional[DatabaseProxy]:
+        """ Get registered database handle or None """
+        return self.databases.get(database_id)
+
+    def add(self, name: str, container: ContainerProxy,
+            took: float = 0.0) -> None:
+        """ Register container handle resolved in `took` seconds """
+        self.containers[name] = container
+        self.resolves += 1
+        self.resolve_time += took
+
+    def get(self, name: str) -> Optional[ContainerProxy]:
+        """ Get registered container handle or None """
+        start = time.perf_counter_ns()
+        container = self.containers.get(name)
+        self.lookups += 1
+        if container is None:
+            self.misses += 1
+        self.lookup_time_ns += time.perf_counter_ns() - start
+        return container
+
+    def stats(self) -> Dict[str, Any]:
+        """ Registry counters """
+        return dict(
+            containers=sorted(self.containers.keys()),
+            resolves=self.resolves,
+            resolveTimeMs=round(self.resolve_time * 1000, 3),
+            lookups=self.lookups,
+            misses=self.misses,
+            avgLookupNs=(self.lookup_time_ns // self.lookups
+                         if self.lookups else 0)
+        )
@@ -1,189 +1,600 @@
 """ Cosmos Client implementation """
 import asyncio
 import sys
+import time
 import uuid
-from concurrent import futures
-from typing import Any, Dict, Optional, Union, List, Tuple
+from typing import Any, Dict, Optional, Union, List, Tuple, AsyncIterator, \
+    NamedTuple, Type
 
-import azure.cosmos.cosmos_client as cosmos_client
 import azure.cosmos.exceptions as exceptions
-from azure.cosmos import DatabaseProxy, ContainerProxy, documents
-from azure.identity import ManagedIdentityCredential, DefaultAzureCredential
+from azure.cosmos import DatabaseProxy, ContainerProxy
 from botbuilder.core import TurnContext
-from botbuilder.schema import ChannelAccount
+from botbuilder.schema import ChannelAccount, \
+    ConversationReference as MSConversationReference
 from marshmallow import EXCLUDE
 
 from entities.json.acknowledge import Acknowledge
-from entities.json.acknowledge_schema import AcknowledgeSchema
-from entities.json.camel_case_mixin import timestamp_factory
-from entities.json.conversation_reference import ConversationReference
 from entities.json.flow import Flow
 from entities.json.initiation import Initiation
 from entities.json.notification import NotificationCosmos
-from utils.functions import get_first_or_none
+from entities.json.notification_delivery import NotificationDelivery
+from entities.json.notification_summary import NotificationStatus, \
+    NotificationSummary
+from utils.archiver import Archiver
+from utils import indexing_policies
+from utils.container_registry import ContainerRegistry
+from utils.cosmos_engines import CosmosEngine, Engines, create_engine
 from utils.log import Log
+from utils.lru_cache import TTLCache
+from utils.provisioning_marker import ProvisioningMarker
+from utils.reference_index import ReferenceIndex
+from utils.status_projector import StatusProjector
+from utils.storage_backend import StorageBackend, StorageBackends, \
+    AcknowledgeRecord, Containers, InitiationRecord, ItemExists, \
+    ItemNotFound, SaveConversationError, SaveItemError, \
+    StorageException as CosmosClientException
+from utils.write_behind import WriteBehindBuffer
 
 
 TAG = __name__
 
 
-class CosmosClientException(Exception):
-    """ Cosmos Client base exception """
-    def __init__(self, message: str):
-        self.message = message
+# Cosmos DB transactional batch limit
+MAX_BATCH_OPERATIONS = 100
 
 
-class ItemExists(CosmosClientException):
-    """ Item already exists in the DB """
-    pass
+__all__ = ["CosmosClient", "CosmosClientException", "Containers",
+           "ItemExists", "ItemNotFound", "QueryPage",
+           "SaveConversationError", "SaveItemError"]
 
 
-class SaveItemError(CosmosClientException):
-    """ Save Item Error """
-    pass
+class QueryPage(NamedTuple):
+    """ Query results page """
+    items: List[Any]
+    continuation_token: Optional[str]
 
 
-class SaveConversationError(CosmosClientException):
-    """ Save Conversation Error """
-    pass
-
-
-class ItemNotFound(CosmosClientException):
-    """ Item not found """
-    pass
+class CosmosClient(StorageBackend):
+    """ Cosmos Client class """
 
+    name = StorageBackends.COSMOS
 
-class CosmosClient:
-    """ Cosmos Client class """
-    def __init__(self, host: str, master_key: str):
-        self.executor = futures.ThreadPoolExecutor()
+    def __init__(self, host: str, master_key: str,
+                 engine: str = Engines.AIO,
+                 conversation_cache_size: int = 1024,
+                 conversation_cache_ttl: float = 300,
+                 reference_index_size: int = 10000,
+                 flow_cache_size: int = 1024,
+                 flow_cache_ttl: float = 60,
+                 **engine_kwargs):
         # mgmt_credentials = ManagedIdentityCredential(client_id=client_id)
         # self.client = cosmos_client.CosmosClient(
         #     host, mgmt_credentials,
         #     consistency_level=documents.ConsistencyLevel.Strong
         # )
-        self.client = cosmos_client.CosmosClient(host,
-                                                 dict(masterKey=master_key))
+        self.engine: CosmosEngine = create_engine(engine, host, master_key,
+                                                  **engine_kwargs)
+        self.metrics = self.engine.metrics
+        self.governor = self.engine.governor
+        self.registry = ContainerRegistry()
+        # (tenant_id, conversation_id) -> MS ConversationReference
+        self.conversations_cache = TTLCache(conversation_cache_size,
+                                            conversation_cache_ttl)
+        self.reference_index = ReferenceIndex(reference_index_size)
+        # tenant_id -> {cmd: Flow}, unknown commands are answered from the
+        # table as well
+        self.flows_cache = TTLCache(flow_cache_size, flow_cache_ttl)
+        self.flow_table_loads: Dict[str, asyncio.Future] = {}
+        # bumped by create_flow, a table loaded across a change isn't cached
+        self.flows_version = 0
+        self.write_buffer: Optional[WriteBehindBuffer] = None
+        self.status_projector: Optional[StatusProjector] = None
+        self.archiver: Optional[Archiver] = None
+        self.provisioning: Dict[str, Any] = {}
+        # definition name -> declared vs actual indexing policy diff
+        self.indexing_drift: Dict[str, Dict[str, Any]] = {}
+
+    async def close(self) -> None:
+        """ Close the engine """
+        await self.stop_archiver()
+        await self.stop_status_projector()
+        await self.stop_write_buffer()
+        await self.metrics.stop_reporter()
+        await self.engine.close()
+
+    async def init_storage(self) -> None:
+        """ Create every container of CosmosDBConfig.CONTAINERS.
+
+            Databases and then containers are created concurrently. In the
+            verify only mode a valid provisioning marker skips the creation
+            and the handles are resolved without any I/O. The marker isn't
+            saved while an indexing policy drift is outstanding """
+        from config import CosmosDBConfig
 
-    async def execute_blocking(self, bl, *args):
-        """ Execute blocking code """
-        return await asyncio.get_event_loop().run_in_executor(self.executor,
-                                                              bl,
-                                                              *args)
+        start = time.perf_counter()
+        definitions = CosmosDBConfig.CONTAINERS
+        marker = ProvisioningMarker(CosmosDBConfig.PROVISIONING_MARKER)
+        fingerprint = ProvisioningMarker.fingerprint(self.engine.host,
+                                                     definitions)
+        containers_ms: Dict[str, float] = {}
+
+        async def timed(name: str, coro) -> None:
+            """ Await and remember the time """
+            coro_start = time.perf_counter()
+            await coro
+            containers_ms[name] = round(
+                (time.perf_counter() - coro_start) * 1000, 3
+            )
 
-    async def get_db(self, database_id: str) -> DatabaseProxy:
-        """ Get or create DB """
+        if CosmosDBConfig.VERIFY_ONLY and marker.is_valid(fingerprint):
+            mode, databases_ms = "verify", 0.0
+            await asyncio.gather(*[
+                timed(d.__name__, self.get_registered_container(d.__name__))
+                for d in definitions
+            ])
+        else:
+            mode = "provision"
+            await asyncio.gather(*[
+                self.create_db(database_id)
+                for database_id in sorted(set(d.DATABASE for d in definitions))
+            ])
+            databases_ms = round((time.perf_counter() - start) * 1000, 3)
+            await asyncio.gather(*[timed(d.__name__, self.init_container(d))
+                                   for d in definitions])
+            if self.indexing_drift:
+                # the next start must reconcile and report the drift again
+                Log.w(TAG, "init_storage::indexing policy drift, "
+                           "the provisioning marker isn't saved")
+            else:
+                marker.save(fingerprint)
+        self.provisioning = dict(
+            mode=mode, databasesMs=databases_ms, containersMs=containers_ms,
+            totalMs=round((time.perf_counter() - start) * 1000, 3)
+        )
+        Log.i(TAG, f"init_storage::provisioning: {self.provisioning}")
+
+    def stats(self) -> Dict[str, Any]:
+        """ In-process metrics of the client """
+        return dict(
+            backend=self.name,
+            engine=self.engine.name,
+            operations=self.metrics.snapshot(),
+            governor=self.governor.stats(),
+            provisioning=self.provisioning,
+            indexingDrift=self.indexing_drift,
+            registry=self.registry.stats(),
+            conversationsCache=self.conversations_cache.stats(),
+            referenceIndex=self.reference_index.stats(),
+            flowsCache=self.flows_cache.stats(),
+            writeBuffer=(self.write_buffer.stats()
+                         if self.write_buffer is not None else None),
+            statusProjector=(self.status_projector.stats()
+                             if self.status_projector is not None else None),
+            archiver=(self.archiver.stats()
+                      if self.archiver is not None else None)
+        )
 
-        def bl() -> DatabaseProxy:
-            """ Get Notifications container blocking """
-            return self.client.get_database_client(database_id)
+    def start_metrics_reporter(self, interval: float) -> None:
+        """ Log the operations summary every `interval` seconds """
+        self.metrics.start_reporter(interval)
+
+    def start_write_buffer(self, **kwargs) -> WriteBehindBuffer:
+        """ Start write-behind buffer for initiations and acknowledges,
+            kwargs are passed to WriteBehindBuffer """
+        if self.write_buffer is None:
+            self.write_buffer = WriteBehindBuffer(self.write_records,
+                                                  **kwargs)
+            self.write_buffer.start()
+        return self.write_buffer
+
+    async def stop_write_buffer(self) -> None:
+        """ Drain and stop write-behind buffer """
+        if self.write_buffer is not None:
+            await self.write_buffer.stop()
+            self.write_buffer = None
+
+    def start_status_projector(self, **kwargs) -> StatusProjector:
+        """ Start projecting the acknowledges and initiations change feeds
+            to the notification summaries, kwargs are passed to
+            StatusProjector """
+        if self.status_projector is None:
+            self.status_projector = StatusProjector(
+                self, [Containers.ACKNOWLEDGES, Containers.INITIATIONS],
+                **kwargs
+            )
+            self.status_projector.start()
+        return self.status_projector
+
+    async def stop_status_projector(self) -> None:
+        """ Stop status projector """
+        if self.status_projector is not None:
+            await self.status_projector.stop()
+            self.status_projector = None
+
+    def start_archiver(self, **kwargs) -> Archiver:
+        """ Start archiving the containers with DEFAULT_TTL,
+            kwargs are passed to Archiver """
+        from config import CosmosDBConfig
+
+        if self.archiver is None:
+            self.archiver = Archiver(self, CosmosDBConfig.CONTAINERS,
+                                     **kwargs)
+            self.archiver.start()
+        return self.archiver
+
+    async def stop_archiver(self) -> None:
+        """ Stop archiver """
+        if self.archiver is not None:
+            await self.archiver.stop()
+            self.archiver = None
+
+    async def write_records(self, name: str, partition_key: Any,
+                            bodies: List[Dict[str, Any]])\
+            -> List[Dict[str, Any]]:
+        """ Write-behind buffer writer, writes one partition group with
+            transactional batches and returns the records that failed """
+        container = await self.get_registered_container(name)
+        chunks = [bodies[i:i + MAX_BATCH_OPERATIONS]
+                  for i in range(0, len(bodies), MAX_BATCH_OPERATIONS)]
+        results = await asyncio.gather(
+            *[self.write_batch(container, partition_key, chunk)
+              for chunk in chunks]
+        )
+        return [body for failed in results for body in failed]
+
+    async def write_batch(self, container: ContainerProxy,
+                          partition_key: Any,
+                          bodies: List[Dict[str, Any]])\
+            -> List[Dict[str, Any]]:
+        """ Create up to MAX_BATCH_OPERATIONS items of one partition in one
+            batch, returns the records that failed. A conflict fails the
+            whole batch, its items are then created one by one: the records
+            already saved by a previous attempt (409) count as written """
+        try:
+            await self.execute_batch(
+                container, [("create", (body,)) for body in bodies],
+                partition_key
+            )
+            return []
+        except ItemExists:
+            pass
+        except SaveItemError as e:
+            Log.w(TAG, f"write_batch::{container.id}/{partition_key}: {e}")
+            return bodies
+        results = await asyncio.gather(
+            *[self.create_item(container, body, max_tries=1)
+              for body in bodies],
+            return_exceptions=True
+        )
+        failed = []
+        for body, result in zip(bodies, results):
+            if isinstance(result, Exception) and \
+                    not isinstance(result, ItemExists):
+                Log.w(TAG, f"write_batch::{container.id}/{partition_key}: "
+                           f"{result}")
+                failed.append(body)
+        return failed
+
+    async def create_buffered_item(self, name: str, partition_key: Any,
+                                   body: Dict[str, Any],
+                                   **kwargs) -> Dict[str, Any]:
+        """ Submit item to the write-behind buffer or write it right away
+            if the buffer isn't running or is full """
+        if body.get("id") is None:
+            body.update(dict(id=uuid.uuid4().__str__()))
+        if self.write_buffer is not None and \
+                self.write_buffer.submit(name, partition_key, body):
+            return body
+        container = await self.get_registered_container(name)
+        return await self.create_item(container, body, **kwargs)
 
-        return await self.execute_blocking(bl)
+    async def get_db(self, database_id: str) -> DatabaseProxy:
+        """ Get or create DB """
+        db = self.registry.get_database(database_id)
+        if db is None:
+            db = await self.engine.get_db(database_id)
+            self.registry.add_database(database_id, db)
+        return db
 
     async def create_db(self, database_id: str) -> DatabaseProxy:
         """ Create DB """
-        def bl() -> DatabaseProxy:
-            """ Get Notifications container blocking """
-            try:
-                return self.client.create_database(id=database_id)
-            except exceptions.CosmosResourceExistsError:
-                return self.client.get_database_client(database_id)
-
-        return await self.execute_blocking(bl)
+        db = await self.engine.create_db(database_id)
+        self.registry.add_database(database_id, db)
+        return db
 
     async def create_container(self, database_id: str, container_id: str,
                                partition_key: Any, **kwargs) -> ContainerProxy:
         """ Create container """
         db = await self.get_db(database_id)
-
-        def bl() -> ContainerProxy:
-            """ Get Notifications container blocking """
-            try:
-                return db.create_container(container_id, partition_key,
-                                           **kwargs)
-            except exceptions.CosmosResourceExistsError:
-                return db.get_container_client(container_id)
-
-        return await self.execute_blocking(bl)
+        return await self.engine.create_container(db, container_id,
+                                                  partition_key, **kwargs)
 
     async def get_container(self, database_id: str, container_id: str,
                             partition_key: Any, **kwargs) -> ContainerProxy:
         """ Get or create container """
         db = await self.get_db(database_id)
+        return await self.engine.get_container(db, container_id)
+
+    async def init_container(self, definition: Any) -> ContainerProxy:
+        """ Create container described by the CosmosDBConfig entry
+            and register its handle """
+        start = time.perf_counter()
+        default_ttl = getattr(definition, "DEFAULT_TTL", None)
+        indexing_policy = getattr(definition, "INDEXING_POLICY", None)
+        kwargs = dict(default_ttl=default_ttl,
+                      indexing_policy=indexing_policy)
+        container = await self.create_container(
+            definition.DATABASE, definition.CONTAINER,
+            definition.PARTITION_KEY,
+            **{k: v for k, v in kwargs.items() if v is not None}
+        )
+        if default_ttl is not None or indexing_policy is not None:
+            container = await self.reconcile_container(definition, container)
+        self.registry.add(definition.__name__, container,
+                          time.perf_counter() - start)
+        return container
+
+    async def reconcile_container(self, definition: Any,
+                                  container: ContainerProxy)\
+            -> ContainerProxy:
+        """ Apply DEFAULT_TTL and INDEXING_POLICY to the container created
+            earlier. The indexing policy drift is always reported, it's
+            applied only with CosmosDBConfig.APPLY_INDEXING_POLICY since
+            the reindexing costs RUs """
+        from config import CosmosDBConfig
 
-        def bl() -> ContainerProxy:
-            """ Get Notifications container blocking """
-            return db.get_container_client(container_id)
-
-        return await self.execute_blocking(bl)
+        name = definition.__name__
+        properties = await self.engine.read_container(container)
+        default_ttl = properties.get("defaultTtl")
+        indexing_policy = properties.get("indexingPolicy")
+        changed = False
+
+        declared_ttl = getattr(definition, "DEFAULT_TTL", None)
+        if declared_ttl is not None and declared_ttl != default_ttl:
+            Log.i(TAG, f"reconcile_container::{name} default ttl: "
+                       f"{default_ttl} -> {declared_ttl}")
+            default_ttl, changed = declared_ttl, True
+
+        declared_policy = getattr(definition, "INDEXING_POLICY", None)
+        drift = (indexing_policies.diff(declared_policy, indexing_policy)
+                 if declared_policy is not None else {})
+        if drift:
+            self.indexing_drift[name] = drift
+            Log.w(TAG, f"reconcile_container::{name} indexing policy "
+                       f"drift: {drift}")
+            if CosmosDBConfig.APPLY_INDEXING_POLICY:
+                indexing_policy, changed = declared_policy, True
+        else:
+            self.indexing_drift.pop(name, None)
+
+        if not changed:
+            return container
+        db = await self.get_db(definition.DATABASE)
+        container = await self.engine.replace_container(
+            db, container, definition.PARTITION_KEY,
+            indexing_policy=indexing_policy, default_ttl=default_ttl
+        )
+        if indexing_policy is declared_policy:
+            # applied, nothing left to report
+            self.indexing_drift.pop(name, None)
+        return container
+
+    async def get_registered_container(self, name: str) -> ContainerProxy:
+        """ Get container handle by definition name.
+            Resolved once, then served from the registry without any I/O """
+        container = self.registry.get(name)
+        if container is None:
+            start = time.perf_counter()
+            definition = self.get_definition(name)
+            container = await self.get_container(definition.DATABASE,
+                                                 definition.CONTAINER,
+                                                 definition.PARTITION_KEY)
+            self.registry.add(name, container, time.perf_counter() - start)
+        return container
 
     @staticmethod
-    def get_next_page_bl(pager) -> List[Dict[any, any]]:
-        """ Get Next page items Blocking """
+    def get_definition(name: str) -> Any:
+        """ CosmosDBConfig container definition by name """
+        from config import CosmosDBConfig
+
+        return getattr(CosmosDBConfig, name)
+
+    async def get_legacy_container(self, name: str)\
+            -> Optional[ContainerProxy]:
+        """ Container of the previous partition layout, None if there's no
+            migration in progress """
+        definition = self.get_definition(name)
+        legacy_container_id = getattr(definition, "LEGACY_CONTAINER", None)
+        if legacy_container_id is None:
+            return None
+        legacy_name = f"{name}:legacy"
+        container = self.registry.get(legacy_name)
+        if container is None:
+            container = await self.get_container(definition.DATABASE,
+                                                 legacy_container_id, None)
+            self.registry.add(legacy_name, container)
+        return container
+
+    async def get_tenant_item(self, name: str, item_id: str,
+                              tenant_id: str) -> Dict[str, Any]:
+        """ Point read of a tenant scoped document (notification, flow).
+            Falls back to the legacy container while the documents are
+            being migrated to the synthetic partition key layout """
+        definition = self.get_definition(name)
+        container = await self.get_registered_container(name)
+        partition_key = definition.PARTITION_STRATEGY.value(tenant_id,
+                                                            item_id)
         try:
-            return list(pager.next())
-        except StopIteration:
-            Log.e(TAG, "get_next_page_bl:: no items found, returning '[]'",
-                  exc_info=sys.exc_info())
-        return list()
+            return await self.get_item(container, item_id, partition_key)
+        except ItemNotFound:
+            legacy_container = await self.get_legacy_container(name)
+            if legacy_container is None:
+                raise
+        return await self.get_item(legacy_container, item_id, tenant_id)
 
     async def get_initiation_items(self, notification_id,
                                    token=None) -> Tuple[List[Initiation], str]:
         """ Get Initiation Items """
         container = await self.get_initiation_container()
+        Log.d(TAG, "get_initiation_items:: init query")
+        page = QueryPage([], None)
+        async for page in self.query_pages(
+            container, notification_id,
+            where="r.notificationId=@notification_id",
+            parameters=[
+                {"name": "@notification_id", "value": notification_id},
+            ],
+            order_by="r._ts",
+            entity=Initiation,
+            max_item_count=20,
+            continuation=token
+        ):
+            break
+        Log.d(TAG, f"get_initiation_items::items: {page.items}")
+        return page.items, page.continuation_token
+
+    async def get_initiation_records(self, notification_id: str,
+                                     token: Optional[str] = None,
+                                     limit: int = 20)\
+            -> Tuple[List[InitiationRecord], Optional[str]]:
+        """ Get one page of the initiations listing """
+        container = await self.get_initiation_container()
+        return await self.get_records_page(container, notification_id,
+                                           InitiationRecord, token, limit)
 
-        def bl() -> Tuple[List[Dict[str, Any]], str]:
-            """ Potential blocking code """
-            # noinspection SqlDialectInspection,SqlNoDataSourceInspection
-            Log.d(TAG, "get_initiation_items:: init query")
-            query_iterable = container.query_items(
-                query="SELECT * FROM r "
-                      "WHERE r.notificationId=@notification_id "
-                      "ORDER BY r._ts",
-                parameters=[
-                    {"name": "@notification_id", "value": notification_id},
-                ],
-                partition_key=notification_id,
-                max_item_count=20
-            )
-            pager = (query_iterable.by_page(token) if token else
-                     query_iterable.by_page())
-            items = self.get_next_page_bl(pager)
-            Log.d(TAG, f"get_initiation_items::items: {items}")
-            return (
-                Initiation.get_schema(unknown=EXCLUDE).load(items, many=True),
-                pager.continuation_token or None
-            )
-
-        return await self.execute_blocking(bl)
-
-    async def get_acknowledge_items(self, notification_id)\
-            -> List[Acknowledge]:
-        """ Get Acknowledge Items """
+    async def iter_acknowledge_items(self, notification_id: str,
+                                     page_size: Optional[int] = None)\
+            -> AsyncIterator[Acknowledge]:
+        """ Stream Acknowledge Items page by page """
         container = await self.get_acknowledges_container()
+        async for item in self.query_items(
+            container, notification_id,
+            where="r.notificationId=@notification_id",
+            parameters=[
+                {"name": "@notification_id", "value": notification_id},
+            ],
+            order_by="r._ts",
+            entity=Acknowledge,
+            max_item_count=page_size
+        ):
+            yield item
+
+    async def get_acknowledge_page(self, notification_id: str,
+                                   token: Optional[str] = None,
+                                   limit: int = 20)\
+            -> Tuple[List[Acknowledge], Optional[str]]:
+        """ Get one page of Acknowledge Items and the next page token """
+        container = await self.get_acknowledges_container()
+        page = QueryPage([], None)
+        async for page in self.query_pages(
+            container, notification_id,
+            where="r.notificationId=@notification_id",
+            parameters=[
+                {"name": "@notification_id", "value": notification_id},
+            ],
+            order_by="r._ts",
+            entity=Acknowledge,
+            max_item_count=limit,
+            continuation=token
+        ):
+            break
+        return page.items, page.continuation_token
+
+    async def get_acknowledge_records(self, notification_id: str,
+                                      token: Optional[str] = None,
+                                      limit: int = 20)\
+            -> Tuple[List[AcknowledgeRecord], Optional[str]]:
+        """ Get one page of the acknowledges listing """
+        container = await self.get_acknowledges_container()
+        return await self.get_records_page(container, notification_id,
+                                           AcknowledgeRecord, token, limit)
+
+    async def get_records_page(self, container: ContainerProxy,
+                               notification_id: str,
+                               record: Type[NamedTuple],
+                               token: Optional[str], limit: int)\
+            -> Tuple[List[Any], Optional[str]]:
+        """ One page of the notification items in _ts order,
+            projected to `record` """
+        page = QueryPage([], None)
+        async for page in self.query_pages(
+            container, notification_id,
+            where="r.notificationId=@notification_id",
+            parameters=[
+                {"name": "@notification_id", "value": notification_id},
+            ],
+            order_by="r._ts",
+            record=record,
+            max_item_count=limit,
+            continuation=token
+        ):
+            break
+        return page.items, page.continuation_token
 
-        def bl() -> List[Dict[str, Any]]:
-            """ Potential blocking code """
-            # noinspection SqlDialectInspection,SqlNoDataSourceInspection
-            items = []
-            for item in container.query_items(
-                query="SELECT * FROM r "
-                      "WHERE r.notificationId=@notification_id "
-                      "ORDER BY r._ts",
-                parameters=[
-                    {"name": "@notification_id", "value": notification_id},
-                ],
-                partition_key=notification_id
-            ):
-                items.append(item)
-            return Acknowledge.get_schema(unknown=EXCLUDE).load(items,
-                                                                many=True)
-
-        return await self.execute_blocking(bl)
-
-    async def query_items(self, partition_key, **kwargs):
-        """ Query items """
-        # TODO(s1z): IMPL ME
+    @staticmethod
+    def build_query(fields: Optional[List[str]] = None,
+                    where: Optional[str] = None,
+                    order_by: Optional[str] = None) -> str:
+        """ Build 'SELECT ... FROM r [WHERE ...] [ORDER BY ...]' query,
+            `fields` is a projection of top level document fields """
+        # noinspection SqlDialectInspection,SqlNoDataSourceInspection
+        query = "SELECT {} FROM r".format(
+            ", ".join(f"r.{field}" for field in fields) if fields else "*"
+        )
+        if where:
+            query += f" WHERE {where}"
+        if order_by:
+            query += f" ORDER BY {order_by}"
+        return query
+
+    async def query_pages(self, container: ContainerProxy,
+                          partition_key: Any = None,
+                          where: Optional[str] = None,
+                          parameters: Optional[List[Dict[str, Any]]] = None,
+                          order_by: Optional[str] = None,
+                          fields: Optional[List[str]] = None,
+                          entity: Optional[Any] = None,
+                          max_item_count: Optional[int] = None,
+                          continuation: Optional[str] = None,
+                          query: Optional[str] = None,
+                          record: Optional[Type[NamedTuple]] = None)\
+            -> AsyncIterator[QueryPage]:
+        """ Query items page by page.
+
+            Every page is fetched when the previous one has been consumed, so
+            the memory use doesn't depend on the result set size. Pages carry
+            the continuation token to resume the query from the next page.
+            `entity` is a CamelCaseMixin dataclass to load the items into,
+            raw dicts are returned if it's None. `record` is a NamedTuple
+            whose field names are document fields: only they are selected
+            and the items are returned as records, no schema is involved.
+            Without `partition_key` the query runs cross-partition. `query`
+            overrides where/order_by/fields. """
+        if record is not None:
+            fields = fields or list(record._fields)
+        query = query or self.build_query(fields, where, order_by)
+        schema = (entity.get_schema(unknown=EXCLUDE)
+                  if entity is not None else None)
+        async for items, token in self.engine.query_pages(
+            container, query, parameters=parameters,
+            partition_key=partition_key, max_item_count=max_item_count,
+            continuation=continuation
+        ):
+            if record is not None:
+                items = [record._make(map(item.get, record._fields))
+                         for item in items]
+            elif schema is not None:
+                items = schema.load(items, many=True)
+            yield QueryPage(items, token)
+
+    async def query_items(self, container: ContainerProxy,
+                          partition_key: Any = None, **kwargs)\
+            -> AsyncIterator[Any]:
+        """ Query items one by one, see query_pages for kwargs """
+        async for page in self.query_pages(container, partition_key,
+                                           **kwargs):
+            for item in page.items:
+                yield item
 
     async def get_item(self,
                        container: ContainerProxy,
@@ -193,20 +604,32 @@ class CosmosClient:
                        post_trigger_include: Optional[str] = None,
                        **kwargs: Any) -> Dict[str, str]:
         """ Get Item """
-
-        def bl() -> Dict[str, str]:
-            """ Potential blocking code """
-            try:
-                return container.read_item(
-                    item=item,
-                    partition_key=partition_key,
-                    populate_query_metrics=populate_query_metrics,
-                    post_trigger_include=post_trigger_include,
-                    **kwargs)
-            except exceptions.CosmosHttpResponseError as e:
-                # raise
-                raise ItemNotFound(e.http_error_message)
-        return await self.execute_blocking(bl)
+        if populate_query_metrics is not None:
+            kwargs.update(dict(populate_query_metrics=populate_query_metrics))
+        if post_trigger_include is not None:
+            kwargs.update(dict(post_trigger_include=post_trigger_include))
+        try:
+            return await self.engine.read_item(container, item,
+                                               partition_key, **kwargs)
+        except exceptions.CosmosHttpResponseError as e:
+            # raise
+            raise ItemNotFound(e.http_error_message)
+
+    async def execute_batch(self, container: ContainerProxy,
+                            operations: List[Tuple[Any, ...]],
+                            partition_key: Any) -> List[Dict[str, Any]]:
+        """ Transactional batch, raises ItemExists if a create conflicts,
+            SaveItemError on other errors """
+        try:
+            return await self.engine.execute_batch(container, operations,
+                                                   partition_key)
+        except exceptions.CosmosBatchOperationError as e:
+            response = e.operation_responses[e.error_index]
+            if response.get("statusCode") == 409:
+                raise ItemExists(e.message)
+            raise SaveItemError(e.message)
+        except exceptions.CosmosHttpResponseError as e:
+            raise SaveItemError(e.http_error_message)
 
     async def create_item(self, container: ContainerProxy,
                           body: Dict[str, Any],
@@ -216,17 +639,11 @@ class CosmosClient:
                           indexing_directive: Optional[Any] = None,
                           **kwargs: Any) -> Dict[str, str]:
         """ Create an item in DB """
-
-        def bl() -> Dict[str, str]:
-            """ Potential blocking code """
-            return container.create_item(
-                body=body,
-                populate_query_metrics=populate_query_metrics,
-                pre_trigger_include=pre_trigger_include,
-                post_trigger_include=post_trigger_include,
-                indexing_directive=indexing_directive,
-                **kwargs
-            )
+        options = dict(populate_query_metrics=populate_query_metrics,
+                       pre_trigger_include=pre_trigger_include,
+                       post_trigger_include=post_trigger_include,
+                       indexing_directive=indexing_directive)
+        options = {k: v for k, v in options.items() if v is not None}
         tries = 0
         max_tries = max(kwargs.pop("max_tries", 3), 1)
 
@@ -234,9 +651,12 @@ class CosmosClient:
         if item_id is None:
             body.update(dict(id=uuid.uuid4().__str__()))
 
+        options.update(kwargs)
+
         while tries < max_tries:
             try:
-                return await self.execute_blocking(bl)
+                return await self.engine.create_item(container, body,
+                                                     **options)
             except exceptions.CosmosHttpResponseError as e:
                 tries += 1
                 if e.status_code == 409:  # Already exists
@@ -249,167 +669,342 @@ class CosmosClient:
 
     async def get_conversations_container(self) -> ContainerProxy:
         """ Get Conversation container """
-        from config import CosmosDBConfig
-
-        return await self.get_container(
-                CosmosDBConfig.Conversations.DATABASE,
-                CosmosDBConfig.Conversations.CONTAINER,
-                CosmosDBConfig.Conversations.PARTITION_KEY
-            )
+        return await self.get_registered_container(Containers.CONVERSATIONS)
 
     async def create_notification(self, notification: NotificationCosmos)\
             -> NotificationCosmos:
         """ Crete notification to the DB """
-        notification.id = uuid.uuid4().__str__()
+        from config import AppConfig
+
+        notification.id = notification.id or uuid.uuid4().__str__()
+        notification.tenant_id = notification.tenant_id or AppConfig.TENANT_ID
         schema = NotificationCosmos.get_schema(unknown=EXCLUDE)
+        body = schema.dump(notification)
+        delivery = self.make_delivery(notification.id,
+                                      NotificationStatus.PENDING,
+                                      notification.tenant_id)
+        strategy = self.get_definition(Containers.NOTIFICATIONS)\
+            .PARTITION_STRATEGY
+        partition_key = strategy.apply(body)
+        strategy.apply(delivery)
+        container = await self.get_notifications_container()
+        results = await self.execute_batch(
+            container, [("create", (body,)), ("create", (delivery,))],
+            partition_key
+        )
+        return schema.load(results[0]["resourceBody"])
+
+    async def get_notification_delivery(self, notification_id: str,
+                                        tenant_id: Optional[str] = None)\
+            -> Optional[NotificationDelivery]:
+        """ Get notification delivery, it shares the notification partition
+            and is never in the legacy container """
+        from config import AppConfig
+
+        strategy = self.get_definition(Containers.NOTIFICATIONS)\
+            .PARTITION_STRATEGY
+        container = await self.get_notifications_container()
+        try:
+            item = await self.get_item(
+                container, NotificationDelivery.make_id(notification_id),
+                strategy.value(tenant_id or AppConfig.TENANT_ID,
+                               notification_id)
+            )
+        except ItemNotFound:
+            return None
+        return NotificationDelivery.get_schema(unknown=EXCLUDE).load(item)
+
+    async def set_notification_status(self, notification_id: str,
+                                      status: str,
+                                      tenant_id: Optional[str] = None)\
+            -> None:
+        """ Update the delivery status """
+        delivery = self.make_delivery(notification_id, status, tenant_id)
+        self.get_definition(Containers.NOTIFICATIONS)\
+            .PARTITION_STRATEGY.apply(delivery)
         container = await self.get_notifications_container()
-        saved_item = container.create_item(body=schema.dump(notification))
-        return schema.load(saved_item)
+        await self.engine.upsert_item(container, delivery)
+
+    async def get_summaries_container(self) -> ContainerProxy:
+        """ Get Notification Summaries container """
+        return await self.get_registered_container(Containers.SUMMARIES)
+
+    async def get_leases_container(self) -> ContainerProxy:
+        """ Get change feed Leases container """
+        return await self.get_registered_container(Containers.LEASES)
 
     async def get_acknowledges_container(self) -> ContainerProxy:
         """ get_acknowledges_container """
-        from config import CosmosDBConfig
-
-        return await self.get_container(
-            CosmosDBConfig.Acknowledges.DATABASE,
-            CosmosDBConfig.Acknowledges.CONTAINER,
-            CosmosDBConfig.Acknowledges.PARTITION_KEY
-        )
+        return await self.get_registered_container(Containers.ACKNOWLEDGES)
 
     async def get_notifications_container(self) -> ContainerProxy:
         """ Get Notifications container """
-        from config import CosmosDBConfig
-
-        return await self.get_container(
-            CosmosDBConfig.Notifications.DATABASE,
-            CosmosDBConfig.Notifications.CONTAINER,
-            CosmosDBConfig.Notifications.PARTITION_KEY
-        )
+        return await self.get_registered_container(Containers.NOTIFICATIONS)
 
     async def get_messages_container(self) -> ContainerProxy:
         """ Get Messages container """
-        from config import CosmosDBConfig
-
-        return await self.get_container(
-            CosmosDBConfig.Notifications.DATABASE,
-            CosmosDBConfig.Notifications.CONTAINER,
-            CosmosDBConfig.Notifications.PARTITION_KEY
-        )
+        return await self.get_registered_container(Containers.NOTIFICATIONS)
 
     async def get_initiation_container(self) -> ContainerProxy:
         """ Get Initiation container """
-        from config import CosmosDBConfig
-
-        return await self.get_container(
-            CosmosDBConfig.Initiations.DATABASE,
-            CosmosDBConfig.Initiations.CONTAINER,
-            CosmosDBConfig.Initiations.PARTITION_KEY
-        )
+        return await self.get_registered_container(Containers.INITIATIONS)
 
     async def get_flow_container(self) -> ContainerProxy:
         """ Get Flow container """
-        from config import CosmosDBConfig
-
-        return await self.get_container(
-            CosmosDBConfig.Flows.DATABASE,
-            CosmosDBConfig.Flows.CONTAINER,
-            CosmosDBConfig.Flows.PARTITION_KEY
-        )
+        return await self.get_registered_container(Containers.FLOWS)
 
     async def create_acknowledge(self, notification_id: str,
                                  account: ChannelAccount) -> Dict[str, Any]:
-        """ Add acknowledge to the DB """
+        """ Add the first acknowledge of the notification to the DB.
+            Raises ItemExists if it's been acknowledged already, unless the
+            write is buffered: the writer drops the conflicting one """
+        acknowledge = self.make_acknowledge(notification_id, account)
+        return await self.create_buffered_item(Containers.ACKNOWLEDGES,
+                                               notification_id, acknowledge,
+                                               max_tries=1)
+
+    async def has_acknowledge(self, notification_id: str) -> bool:
+        """ Has anybody acknowledged the notification. A point read of the
+            first acknowledge, then a TOP 1 query of the partition for the
+            acknowledges saved with random ids """
+        ack_id = Acknowledge.make_id(notification_id)
+        if self.write_buffer is not None and \
+                self.write_buffer.is_pending(Containers.ACKNOWLEDGES, ack_id):
+            return True
         container = await self.get_acknowledges_container()
-        notification = AcknowledgeSchema().dump(dict(
-            notification_id=notification_id,
-            username=account.name,
-            user_aad_id=account.aad_object_id,
-            timestamp=timestamp_factory()
+        try:
+            await self.get_item(container, ack_id, notification_id)
+            return True
+        except ItemNotFound:
+            pass
+        # noinspection SqlDialectInspection,SqlNoDataSourceInspection
+        item = await self.get_first_item(
+            container, notification_id,
+            query=("SELECT TOP 1 VALUE r.id FROM r "
+                   "WHERE r.notificationId=@notification_id"),
+            parameters=[{"name": "@notification_id",
+                         "value": notification_id}]
+        )
+        return item is not None
+
+    async def read_change_feed(self, name: str,
+                               continuation: Optional[str] = None,
+                               max_item_count: Optional[int] = None)\
+            -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """ Read one change feed page of the container """
+        container = await self.get_registered_container(name)
+        return await self.engine.read_change_feed(container, continuation,
+                                                  max_item_count)
+
+    async def get_lease(self, name: str) -> Optional[str]:
+        """ Get saved change feed continuation of the container """
+        container = await self.get_leases_container()
+        try:
+            item = await self.get_item(container, name, name)
+        except ItemNotFound:
+            return None
+        return item.get("continuation")
+
+    async def save_lease(self, name: str, continuation: Optional[str]) -> None:
+        """ Save change feed continuation of the container """
+        container = await self.get_leases_container()
+        await self.engine.upsert_item(container, dict(
+            id=name, continuation=continuation
         ))
-        return await self.create_item(container, notification)
 
-    async def get_acknowledge(self, notification_id: str)\
-            -> Optional[Acknowledge]:
-        """ Get Acknowledge object """
+    async def get_first_item(self, container: ContainerProxy,
+                             partition_key: Any = None,
+                             **kwargs) -> Optional[Any]:
+        """ First query result or None, see query_pages for kwargs """
+        async for item in self.query_items(container, partition_key,
+                                           **kwargs):
+            return item
+        return None
+
+    async def refresh_notification_summary(self, notification_id: str)\
+            -> NotificationSummary:
+        """ Recompute notification summary from its acknowledges and
+            initiations, two single partition aggregate queries """
+        parameters = [{"name": "@notification_id", "value": notification_id}]
+        acks_container, initiations_container = await asyncio.gather(
+            self.get_acknowledges_container(),
+            self.get_initiation_container()
+        )
+        # noinspection SqlDialectInspection,SqlNoDataSourceInspection
+        acks, initiations = await asyncio.gather(
+            self.get_first_item(
+                acks_container, notification_id,
+                query=("SELECT COUNT(1) AS ackCount, "
+                       "MIN(r.timestamp) AS firstAckTimestamp, "
+                       "MAX(r.timestamp) AS lastAckTimestamp "
+                       "FROM r WHERE r.notificationId=@notification_id"),
+                parameters=parameters
+            ),
+            self.get_first_item(
+                initiations_container, notification_id,
+                query=("SELECT VALUE COUNT(1) FROM r "
+                       "WHERE r.notificationId=@notification_id"),
+                parameters=parameters
+            )
+        )
+        acks = acks or {}
+        summary = NotificationSummary.build(
+            notification_id, acks.get("ackCount", 0),
+            acks.get("firstAckTimestamp"), acks.get("lastAckTimestamp"),
+            initiations or 0
+        )
+        container = await self.get_summaries_container()
+        await self.engine.upsert_item(
+            container, NotificationSummary.get_schema().dump(summary)
+        )
+        return summary
+
+    async def get_notification_summary(self, notification_id: str)\
+            -> Optional[NotificationSummary]:
+        """ Get notification summary with a point read """
+        container = await self.get_summaries_container()
         try:
-            container = await self.get_acknowledges_container()
-            items = await self.query_items(container, notification_id)
-            return Acknowledge.get_schema(unknown=EXCLUDE).load(items)
+            item = await self.get_item(container, notification_id,
+                                       notification_id)
         except ItemNotFound:
             return None
+        return NotificationSummary.get_schema(unknown=EXCLUDE).load(item)
 
     async def get_conversation(self, conversation_id: str,
-                               tenant_id: str = None) -> ConversationReference:
-        """ Get Conversation Reference """
+                               tenant_id: str = None)\
+            -> MSConversationReference:
+        """ Get Conversation Reference.
+            The result is shared with the cache, do not modify it """
         from config import AppConfig
 
+        tenant_id = tenant_id or AppConfig.TENANT_ID
+        reference = self.conversations_cache.get((tenant_id, conversation_id))
+        if reference is not None:
+            return reference
         container = await self.get_conversations_container()
-        item = await self.get_item(container, conversation_id,
-                                   tenant_id or AppConfig.TENANT_ID)
-        return ConversationReference.get_schema(unknown=EXCLUDE)\
-                                    .load(item).to_ms_reference()
+        item = await self.get_item(container, conversation_id, tenant_id)
+        return self.cache_conversation(item)
+
+    def cache_conversation(self, item: Dict[str, Any])\
+            -> MSConversationReference:
+        """ Convert stored conversation reference and put it to the cache """
+        reference = self.load_conversation(item)
+        key = (reference.conversation.tenant_id, reference.conversation.id)
+        self.conversations_cache.put(key, reference)
+        return reference
 
     async def get_notification(self, notification_id: str)\
             -> NotificationCosmos:
         """ Get Notification """
         from config import AppConfig
 
-        container = await self.get_notifications_container()
-        item = await self.get_item(container, notification_id,
-                                   AppConfig.TENANT_ID)
+        item = await self.get_tenant_item(Containers.NOTIFICATIONS,
+                                          notification_id,
+                                          AppConfig.TENANT_ID)
         return NotificationCosmos.get_schema(unknown=EXCLUDE).load(item)
 
     async def create_conversation_reference(self, turn_context: TurnContext)\
             -> Dict[str, Any]:
-        """ Save Conversation Regerence """
-        from config import CosmosDBConfig
+        """ Save Conversation Regerence.
+            Writes only if the reference is new or has changed """
+        key, reference_json = self.make_conversation_reference(turn_context)
+        tenant_id, _ = key
+        digest = ReferenceIndex.digest(reference_json)
+        if self.reference_index.is_stored(key, digest):
+            return reference_json
 
         Log.i(__name__, "create_conversation_reference")
-        activity = turn_context.activity
-        reference = TurnContext.get_conversation_reference(activity)
-        reference_json = ConversationReference.get_schema().dump(reference)
         container = await self.get_conversations_container()
-        reference_json.update({
-            CosmosDBConfig.Conversations.PK: reference.conversation.id
-        })
-
-        def bl() -> Dict[str, str]:
-            """ Potential blocking code """
-            return container.create_item(body=reference_json)
+        if not self.reference_index.is_seen(key):
+            # first time in this process, a point read is way cheaper
+            # than a write if it's already there
+            try:
+                stored = await self.get_item(container, reference_json["id"],
+                                             tenant_id)
+                if ReferenceIndex.digest(stored) == digest:
+                    self.reference_index.add(key, digest)
+                    self.cache_conversation(stored)
+                    return stored
+            except ItemNotFound:
+                pass
 
         try:
-            return await self.execute_blocking(bl)
+            saved_item = await self.engine.upsert_item(container,
+                                                       reference_json)
         except exceptions.CosmosHttpResponseError as e:
             Log.i(__name__, "create_conversation_reference::error:",
                   sys.exc_info())
-            if e.status_code == 409:  # Already exists
-                return reference_json
             raise SaveItemError(e.http_error_message)
+        self.reference_index.add(key, digest, written=True)
+        self.cache_conversation(saved_item)
+        return saved_item
 
     async def create_initiation(self, initiator: str,
                                 notification_id: str) -> None:
         """ Save initiation """
-        container = await self.get_initiation_container()
-        initiation = Initiation(initiator=initiator,
-                                timestamp=timestamp_factory(),
-                                notification_id=notification_id)
-        data = Initiation.get_schema().dump(initiation)
-        await self.create_item(container, body=data)
+        data = self.make_initiation(initiator, notification_id)
+        await self.create_buffered_item(Containers.INITIATIONS,
+                                        notification_id, data)
 
     async def create_flow(self, cmd, url, tenant_id=None):
         """ Create Flow """
-        from config import AppConfig
         container = await self.get_flow_container()
-        flow = Flow(tenant_id=tenant_id or AppConfig.TENANT_ID, id=cmd,
-                    url=url)
-        data = Flow.get_schema().dump(flow)
-        return await self.create_item(container, body=data)
+        data = self.make_flow(cmd, url, tenant_id)
+        self.get_definition(Containers.FLOWS).PARTITION_STRATEGY.apply(data)
+        try:
+            return await self.create_item(container, body=data)
+        finally:
+            self.flows_version += 1
+            self.flows_cache.invalidate(data["tenantId"])
 
     async def get_flow(self, cmd, tenant_id=None) -> Flow:
         """ Get Flow """
         from config import AppConfig
 
-        container = await self.get_flow_container()
-        item = await self.get_item(container, cmd,
-                                   tenant_id or AppConfig.TENANT_ID)
+        item = await self.get_tenant_item(Containers.FLOWS, cmd,
+                                          tenant_id or AppConfig.TENANT_ID)
         return Flow.get_schema(unknown=EXCLUDE).load(item)
+
+    async def find_flow(self, cmd, tenant_id=None) -> Optional[Flow]:
+        """ Get Flow or None from the cached tenant flow table """
+        from config import AppConfig
+
+        table = await self.get_flow_table(tenant_id or AppConfig.TENANT_ID)
+        return table.get(cmd)
+
+    async def get_flow_table(self, tenant_id: str) -> Dict[str, Flow]:
+        """ All the flows of the tenant, cached for flow_cache_ttl.
+            Concurrent misses share one load """
+        table = self.flows_cache.get(tenant_id)
+        if table is not None:
+            return table
+        load = self.flow_table_loads.get(tenant_id)
+        if load is None:
+            load = asyncio.ensure_future(self.load_flow_table(tenant_id))
+            self.flow_table_loads[tenant_id] = load
+            load.add_done_callback(
+                lambda _: self.flow_table_loads.pop(tenant_id, None)
+            )
+        return await asyncio.shield(load)
+
+    async def load_flow_table(self, tenant_id: str) -> Dict[str, Flow]:
+        """ Query all the flows of the tenant and cache them """
+        version = self.flows_version
+        strategy = self.get_definition(Containers.FLOWS).PARTITION_STRATEGY
+        containers = [(await self.get_flow_container(),
+                       None if strategy.is_synthetic else tenant_id)]
+        legacy_container = await self.get_legacy_container(Containers.FLOWS)
+        if legacy_container is not None:
+            containers.insert(0, (legacy_container, tenant_id))
+        table = {}
+        for container, partition_key in containers:
+            async for flow in self.query_items(
+                container, partition_key,
+                where="r.tenantId=@tenant_id",
+                parameters=[{"name": "@tenant_id", "value": tenant_id}],
+                entity=Flow
+            ):
+                table[flow.id] = flow
+        if version == self.flows_version:
+            self.flows_cache.put(tenant_id, table)
+        return table
@@ -0,0 +1,704 @@
+""" Cosmos DB I/O engines """
+import abc
+import asyncio
+import time
+from concurrent import futures
+from typing import Any, Dict, List, Optional, Tuple, AsyncIterator, Union, \
+    Callable, Awaitable
+
+import aiohttp
+import azure.cosmos.cosmos_client as cosmos_client
+import azure.cosmos.exceptions as exceptions
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.cosmos import DatabaseProxy, ContainerProxy, documents
+from azure.cosmos._retry_options import RetryOptions
+from azure.cosmos.aio import CosmosClient as AioCosmosClient
+
+from utils.cosmos_metrics import CosmosMetrics
+from utils.log import Log
+from utils.rate_governor import RateGovernor
+
+
+TAG = __name__
+
+
+Page = Tuple[List[Dict[str, Any]], Optional[str]]
+# items, continuation token, response headers
+RawPage = Tuple[List[Dict[str, Any]], Optional[str], Dict[str, str]]
+ResponseHook = Callable[[Dict[str, str], Any], None]
+# ("create" | "upsert" | "replace" | ..., args tuple[, kwargs dict])
+BatchOperation = Tuple[Any, ...]
+
+
+class Engines:
+    """ Engine names """
+    THREADED = "threaded"
+    AIO = "aio"
+
+
+def make_connection_policy(throttle_retries: Optional[int] = None)\
+        -> documents.ConnectionPolicy:
+    """ SDK connection policy, `throttle_retries` overrides the number of
+        429 retries done by the SDK itself """
+    policy = documents.ConnectionPolicy()
+    if throttle_retries is not None:
+        policy.RetryOptions = RetryOptions(
+            max_retry_attempt_count=throttle_retries
+        )
+    return policy
+
+
+class CosmosEngine(abc.ABC):
+    """ Base Cosmos engine.
+
+        The engine owns the SDK client and does every I/O call, CosmosClient
+        only builds requests and parses responses. Database and container
+        handles are opaque for the callers: the threaded engine returns sync
+        SDK proxies, the aio engine returns aio SDK proxies.
+
+        Every request is recorded in `metrics`: request charge, client and
+        server latency and status code per operation and container.
+        Item requests and query pages go through `governor`: per container
+        AIMD concurrency limit and 429 retries. The SDK 429 retries should
+        be lowered (`throttle_retries`) so that the governor sees them.
+        Subclasses implement the underscored methods. """
+
+    name: str = None
+
+    def __init__(self, host: str, master_key: str,
+                 throttle_retries: Optional[int] = None,
+                 governor: Optional[RateGovernor] = None):
+        self.host = host
+        self.master_key = master_key
+        self.connection_policy = make_connection_policy(throttle_retries)
+        self.metrics = CosmosMetrics()
+        self.governor = governor or RateGovernor()
+
+    async def measure(self, operation: str, resource_id: str,
+                      call: Callable[[ResponseHook], Awaitable[Any]],
+                      status: int = 200) -> Any:
+        """ Run `call(response_hook)` and record its metrics """
+        headers = {}
+
+        def response_hook(response_headers: Dict[str, str], _result) -> None:
+            """ SDK response hook """
+            headers.update(response_headers or {})
+
+        start = time.perf_counter()
+        try:
+            return await call(response_hook)
+        except (exceptions.CosmosHttpResponseError,
+                exceptions.CosmosBatchOperationError) as e:
+            headers.update(e.headers or {})
+            status = e.status_code
+            raise
+        except Exception:
+            status = 0
+            raise
+        finally:
+            self.metrics.record(operation, resource_id, headers,
+                                time.perf_counter() - start, status)
+
+    async def governed(self, operation: str, container_id: str,
+                       call: Callable[[ResponseHook], Awaitable[Any]],
+                       status: int = 200) -> Any:
+        """ `measure` every attempt within the governor limit """
+        return await self.governor.run(
+            container_id,
+            lambda: self.measure(operation, container_id, call, status)
+        )
+
+    @abc.abstractmethod
+    async def get_db(self, database_id: str) -> DatabaseProxy:
+        """ Get database handle """
+
+    @abc.abstractmethod
+    async def get_container(self, db: DatabaseProxy,
+                            container_id: str) -> ContainerProxy:
+        """ Get container handle """
+
+    async def create_db(self, database_id: str) -> DatabaseProxy:
+        """ Create database if it does not exist """
+        return await self.measure(
+            "create_db", database_id,
+            lambda hook: self._create_db(database_id, response_hook=hook),
+            status=201
+        )
+
+    async def create_container(self, db: DatabaseProxy, container_id: str,
+                               partition_key: Any, **kwargs) -> ContainerProxy:
+        """ Create container if it does not exist """
+        return await self.measure(
+            "create_container", container_id,
+            lambda hook: self._create_container(db, container_id,
+                                                partition_key,
+                                                response_hook=hook, **kwargs),
+            status=201
+        )
+
+    async def read_container(self, container: ContainerProxy)\
+            -> Dict[str, Any]:
+        """ Read container properties """
+        return await self.measure(
+            "read_container", container.id,
+            lambda hook: self._read_container(container, response_hook=hook)
+        )
+
+    async def replace_container(self, db: DatabaseProxy,
+                                container: ContainerProxy,
+                                partition_key: Any,
+                                **kwargs) -> ContainerProxy:
+        """ Replace container properties """
+        return await self.measure(
+            "replace_container", container.id,
+            lambda hook: self._replace_container(db, container,
+                                                 partition_key,
+                                                 response_hook=hook,
+                                                 **kwargs)
+        )
+
+    async def read_item(self, container: ContainerProxy,
+                        item: Union[str, Dict[str, Any]],
+                        partition_key: Any, **kwargs) -> Dict[str, Any]:
+        """ Point read """
+        return await self.governed(
+            "read_item", container.id,
+            lambda hook: self._read_item(container, item, partition_key,
+                                         response_hook=hook, **kwargs)
+        )
+
+    async def create_item(self, container: ContainerProxy,
+                          body: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        """ Create item """
+        return await self.governed(
+            "create_item", container.id,
+            lambda hook: self._create_item(container, body,
+                                           response_hook=hook, **kwargs),
+            status=201
+        )
+
+    async def upsert_item(self, container: ContainerProxy,
+                          body: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        """ Insert or replace item """
+        return await self.governed(
+            "upsert_item", container.id,
+            lambda hook: self._upsert_item(container, body,
+                                           response_hook=hook, **kwargs)
+        )
+
+    async def execute_batch(self, container: ContainerProxy,
+                            operations: List[BatchOperation],
+                            partition_key: Any) -> List[Dict[str, Any]]:
+        """ Transactional batch within one logical partition: one request,
+            all or nothing. Raises CosmosBatchOperationError if an
+            operation fails, the results carry the resourceBody """
+        async def call(hook: ResponseHook) -> List[Dict[str, Any]]:
+            """ Execute batch """
+            results, headers = await self._execute_batch(
+                container, operations, partition_key
+            )
+            hook(headers, None)
+            return results
+
+        return await self.governed("batch", container.id, call)
+
+    async def query_pages(self, container: ContainerProxy, query: str,
+                          parameters: Optional[List[Dict[str, Any]]] = None,
+                          partition_key: Any = None,
+                          max_item_count: Optional[int] = None,
+                          continuation: Optional[str] = None,
+                          **kwargs) -> AsyncIterator[Page]:
+        """ Async generator of (items, continuation_token) pages,
+            every page fetch is recorded as a separate request. A throttled
+            page fetch is retried by restarting the query from the last
+            continuation token """
+        pages: Optional[AsyncIterator[RawPage]] = None
+        attempt = 0
+
+        async def fetch(hook: ResponseHook) -> Optional[RawPage]:
+            """ Fetch next page """
+            try:
+                raw_page = await pages.__anext__()
+            except StopAsyncIteration:
+                return None
+            hook(raw_page[2], None)
+            return raw_page
+
+        while True:
+            if pages is None:
+                pages = self._query_pages(container, query, parameters,
+                                          partition_key, max_item_count,
+                                          continuation, **kwargs)
+            try:
+                page = await self.governor.limited(
+                    container.id,
+                    lambda: self.measure("query", container.id, fetch)
+                )
+            except exceptions.CosmosHttpResponseError as e:
+                if not self.governor.is_throttled(e):
+                    raise
+                attempt += 1
+                if not await self.governor.backoff(container.id, e, attempt):
+                    raise
+                pages = None
+                continue
+            attempt = 0
+            if page is None:
+                return
+            items, continuation, _ = page
+            yield items, continuation
+            if continuation is None:
+                return
+
+    async def read_change_feed(self, container: ContainerProxy,
+                               continuation: Optional[str] = None,
+                               max_item_count: Optional[int] = None) -> Page:
+        """ Read one change feed page, returns (items, continuation).
+            Starts from the beginning if there is no continuation """
+        async def call(hook: ResponseHook) -> Page:
+            """ Read page """
+            items, token, headers = await self._read_change_feed(
+                container, continuation, max_item_count
+            )
+            hook(headers, None)
+            return items, token
+
+        return await self.governed("change_feed", container.id, call)
+
+    async def close(self) -> None:
+        """ Release engine resources """
+
+    @abc.abstractmethod
+    async def _create_db(self, database_id: str, **kwargs) -> DatabaseProxy:
+        """ Create DB, engine specific """
+
+    @abc.abstractmethod
+    async def _create_container(self, db: DatabaseProxy, container_id: str,
+                                partition_key: Any,
+                                **kwargs) -> ContainerProxy:
+        """ Create container, engine specific """
+
+    @abc.abstractmethod
+    async def _read_container(self, container: ContainerProxy,
+                              **kwargs) -> Dict[str, Any]:
+        """ Read container properties, engine specific """
+
+    @abc.abstractmethod
+    async def _replace_container(self, db: DatabaseProxy,
+                                 container: ContainerProxy,
+                                 partition_key: Any,
+                                 **kwargs) -> ContainerProxy:
+        """ Replace container properties, engine specific """
+
+    @abc.abstractmethod
+    async def _read_item(self, container: ContainerProxy,
+                         item: Union[str, Dict[str, Any]],
+                         partition_key: Any, **kwargs) -> Dict[str, Any]:
+        """ Point read, engine specific """
+
+    @abc.abstractmethod
+    async def _create_item(self, container: ContainerProxy,
+                           body: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        """ Create item, engine specific """
+
+    @abc.abstractmethod
+    async def _upsert_item(self, container: ContainerProxy,
+                           body: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        """ Upsert item, engine specific """
+
+    @abc.abstractmethod
+    async def _execute_batch(self, container: ContainerProxy,
+                             operations: List[BatchOperation],
+                             partition_key: Any)\
+            -> Tuple[List[Dict[str, Any]], Dict[str, str]]:
+        """ Transactional batch (results, headers), engine specific """
+
+    @abc.abstractmethod
+    def _query_pages(self, container: ContainerProxy, query: str,
+                     parameters: Optional[List[Dict[str, Any]]],
+                     partition_key: Any, max_item_count: Optional[int],
+                     continuation: Optional[str],
+                     **kwargs) -> AsyncIterator[RawPage]:
+        """ Async generator of (items, continuation_token, headers),
+            engine specific """
+
+    @abc.abstractmethod
+    async def _read_change_feed(self, container: ContainerProxy,
+                                continuation: Optional[str],
+                                max_item_count: Optional[int]) -> RawPage:
+        """ One change feed page (items, continuation, headers),
+            engine specific """
+
+    @staticmethod
+    def get_change_feed_kwargs(continuation: Optional[str],
+                               max_item_count: Optional[int],
+                               responses: List[Any]) -> Dict[str, Any]:
+        """ query_items_change_feed() kwargs, the response hook collects
+            the headers of every feed request to `responses` """
+        def response_hook(headers: Any, _result: Any) -> None:
+            """ Headers of this very request, not the client-wide
+                last_response_headers another thread may overwrite """
+            responses.append(headers)
+
+        if continuation is None:
+            return dict(is_start_from_beginning=True,
+                        max_item_count=max_item_count,
+                        response_hook=response_hook)
+        return dict(continuation=continuation, max_item_count=max_item_count,
+                    response_hook=response_hook)
+
+    @staticmethod
+    def get_change_feed_page(items: List[Dict[str, Any]],
+                             continuation: Optional[str],
+                             responses: List[Any]) -> RawPage:
+        """ Page with the continuation (etag) of its own response, an empty
+            page keeps the previous one """
+        headers = responses[-1] if responses else None
+        etag = headers.get("etag") if headers and items else None
+        return items, etag or continuation, dict(headers or {})
+
+
+class ThreadedCosmosEngine(CosmosEngine):
+    """ Sync azure.cosmos SDK running on a thread pool """
+
+    name = Engines.THREADED
+
+    def __init__(self, host: str, master_key: str,
+                 max_workers: Optional[int] = None, **kwargs):
+        super().__init__(host, master_key, **kwargs)
+        self.executor = futures.ThreadPoolExecutor(max_workers)
+        self.client = cosmos_client.CosmosClient(
+            host, dict(masterKey=master_key),
+            connection_policy=self.connection_policy
+        )
+
+    async def execute_blocking(self, bl, *args):
+        """ Execute blocking code """
+        return await asyncio.get_event_loop().run_in_executor(self.executor,
+                                                              bl,
+                                                              *args)
+
+    async def get_db(self, database_id: str) -> DatabaseProxy:
+        """ Get database handle """
+        return await self.execute_blocking(self.client.get_database_client,
+                                           database_id)
+
+    async def get_container(self, db: DatabaseProxy,
+                            container_id: str) -> ContainerProxy:
+        """ Get container handle """
+        return await self.execute_blocking(db.get_container_client,
+                                           container_id)
+
+    async def _create_db(self, database_id: str, **kwargs) -> DatabaseProxy:
+        """ Create DB """
+        def bl() -> DatabaseProxy:
+            """ Create DB blocking """
+            try:
+                return self.client.create_database(id=database_id, **kwargs)
+            except exceptions.CosmosResourceExistsError:
+                return self.client.get_database_client(database_id)
+
+        return await self.execute_blocking(bl)
+
+    async def _create_container(self, db: DatabaseProxy, container_id: str,
+                                partition_key: Any,
+                                **kwargs) -> ContainerProxy:
+        """ Create container """
+        def bl() -> ContainerProxy:
+            """ Create container blocking """
+            try:
+                return db.create_container(container_id, partition_key,
+                                           **kwargs)
+            except exceptions.CosmosResourceExistsError:
+                return db.get_container_client(container_id)
+
+        return await self.execute_blocking(bl)
+
+    async def _read_container(self, container: ContainerProxy,
+                              **kwargs) -> Dict[str, Any]:
+        """ Read container properties """
+        def bl() -> Dict[str, Any]:
+            """ Read container blocking """
+            return container.read(**kwargs)
+
+        return await self.execute_blocking(bl)
+
+    async def _replace_container(self, db: DatabaseProxy,
+                                 container: ContainerProxy,
+                                 partition_key: Any,
+                                 **kwargs) -> ContainerProxy:
+        """ Replace container properties """
+        def bl() -> ContainerProxy:
+            """ Replace container blocking """
+            return db.replace_container(container, partition_key, **kwargs)
+
+        return await self.execute_blocking(bl)
+
+    async def _read_item(self, container: ContainerProxy,
+                         item: Union[str, Dict[str, Any]],
+                         partition_key: Any, **kwargs) -> Dict[str, Any]:
+        """ Point read """
+        def bl() -> Dict[str, Any]:
+            """ Point read blocking """
+            return container.read_item(item=item,
+                                       partition_key=partition_key,
+                                       **kwargs)
+
+        return await self.execute_blocking(bl)
+
+    async def _create_item(self, container: ContainerProxy,
+                           body: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        """ Create item """
+        def bl() -> Dict[str, Any]:
+            """ Create item blocking """
+            return container.create_item(body=body, **kwargs)
+
+        return await self.execute_blocking(bl)
+
+    async def _upsert_item(self, container: ContainerProxy,
+                           body: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        """ Insert or replace item """
+        def bl() -> Dict[str, Any]:
+            """ Upsert item blocking """
+            return container.upsert_item(body=body, **kwargs)
+
+        return await self.execute_blocking(bl)
+
+    async def _execute_batch(self, container: ContainerProxy,
+                             operations: List[BatchOperation],
+                             partition_key: Any)\
+            -> Tuple[List[Dict[str, Any]], Dict[str, str]]:
+        """ Transactional batch """
+        def bl() -> Tuple[List[Dict[str, Any]], Dict[str, str]]:
+            """ Execute batch blocking """
+            results = container.execute_item_batch(
+                batch_operations=operations, partition_key=partition_key
+            )
+            headers = container.client_connection.last_response_headers
+            return list(results), dict(headers or {})
+
+        return await self.execute_blocking(bl)
+
+    @staticmethod
+    def get_next_page_bl(container: ContainerProxy, pager)\
+            -> Optional[Tuple[List[Dict[str, Any]], Dict[str, str]]]:
+        """ Get next page items and headers or None if there are no pages
+            left. Headers may belong to a concurrent request on the same
+            client, the sync SDK has no per-page response hook """
+        try:
+            items = list(pager.next())
+        except StopIteration:
+            return None
+        headers = container.client_connection.last_response_headers
+        return items, dict(headers or {})
+
+    async def _query_pages(self, container: ContainerProxy, query: str,
+                           parameters: Optional[List[Dict[str, Any]]],
+                           partition_key: Any, max_item_count: Optional[int],
+                           continuation: Optional[str],
+                           **kwargs) -> AsyncIterator[RawPage]:
+        """ Async generator of (items, continuation_token, headers) """
+        if partition_key is None:
+            kwargs.update(dict(enable_cross_partition_query=True))
+        # query_items() and by_page() are lazy, no I/O here
+        query_iterable = container.query_items(
+            query=query, parameters=parameters, partition_key=partition_key,
+            max_item_count=max_item_count, **kwargs
+        )
+        pager = query_iterable.by_page(continuation)
+        while True:
+            page = await self.execute_blocking(self.get_next_page_bl,
+                                               container, pager)
+            if page is None:
+                return
+            items, headers = page
+            yield items, pager.continuation_token or None, headers
+
+    async def _read_change_feed(self, container: ContainerProxy,
+                                continuation: Optional[str],
+                                max_item_count: Optional[int]) -> RawPage:
+        """ One change feed page """
+        def bl() -> RawPage:
+            """ Read change feed page blocking """
+            responses = []
+            pager = container.query_items_change_feed(
+                **self.get_change_feed_kwargs(continuation, max_item_count,
+                                              responses)
+            ).by_page()
+            # the SDK calls the hook once on creation with the shared headers
+            responses.clear()
+            items = list(next(pager, []))
+            return self.get_change_feed_page(items, continuation, responses)
+
+        return await self.execute_blocking(bl)
+
+    async def close(self) -> None:
+        """ Release engine resources """
+        self.executor.shutdown(wait=False)
+
+
+class AioCosmosEngine(CosmosEngine):
+    """ Native asyncio engine built on azure.cosmos.aio.
+
+        All the requests share one aiohttp connection pool. The SDK client
+        and the session are created lazily because aiohttp sessions have to
+        be created inside a running event loop, while CosmosClient is created
+        on config import. """
+
+    name = Engines.AIO
+
+    def __init__(self, host: str, master_key: str, pool_size: int = 100,
+                 pool_size_per_host: int = 0, dns_cache_ttl: int = 300,
+                 **kwargs):
+        super().__init__(host, master_key, **kwargs)
+        self.pool_size = pool_size
+        self.pool_size_per_host = pool_size_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.client: Optional[AioCosmosClient] = None
+
+    def get_client(self) -> AioCosmosClient:
+        """ Get or create the SDK client (inside the running loop) """
+        if self.client is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size_per_host,
+                ttl_dns_cache=self.dns_cache_ttl
+            )
+            self.session = aiohttp.ClientSession(connector=connector)
+            transport = AioHttpTransport(session=self.session,
+                                         session_owner=False)
+            self.client = AioCosmosClient(
+                self.host, dict(masterKey=self.master_key),
+                transport=transport, connection_policy=self.connection_policy
+            )
+            Log.i(TAG, f"get_client::aio client created, "
+                       f"pool_size: {self.pool_size}")
+        return self.client
+
+    async def get_db(self, database_id: str) -> DatabaseProxy:
+        """ Get database handle """
+        return self.get_client().get_database_client(database_id)
+
+    async def get_container(self, db: DatabaseProxy,
+                            container_id: str) -> ContainerProxy:
+        """ Get container handle """
+        return db.get_container_client(container_id)
+
+    async def _create_db(self, database_id: str, **kwargs) -> DatabaseProxy:
+        """ Create DB """
+        client = self.get_client()
+        try:
+            return await client.create_database(id=database_id, **kwargs)
+        except exceptions.CosmosResourceExistsError:
+            return client.get_database_client(database_id)
+
+    async def _create_container(self, db: DatabaseProxy, container_id: str,
+                                partition_key: Any,
+                                **kwargs) -> ContainerProxy:
+        """ Create container """
+        try:
+            return await db.create_container(container_id, partition_key,
+                                             **kwargs)
+        except exceptions.CosmosResourceExistsError:
+            return db.get_container_client(container_id)
+
+    async def _read_container(self, container: ContainerProxy,
+                              **kwargs) -> Dict[str, Any]:
+        """ Read container properties """
+        return await container.read(**kwargs)
+
+    async def _replace_container(self, db: DatabaseProxy,
+                                 container: ContainerProxy,
+                                 partition_key: Any,
+                                 **kwargs) -> ContainerProxy:
+        """ Replace container properties """
+        return await db.replace_container(container, partition_key,
+                                          **kwargs)
+
+    async def _read_item(self, container: ContainerProxy,
+                         item: Union[str, Dict[str, Any]],
+                         partition_key: Any, **kwargs) -> Dict[str, Any]:
+        """ Point read """
+        return await container.read_item(item=item,
+                                         partition_key=partition_key,
+                                         **kwargs)
+
+    async def _create_item(self, container: ContainerProxy,
+                           body: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        """ Create item """
+        return await container.create_item(body=body, **kwargs)
+
+    async def _upsert_item(self, container: ContainerProxy,
+                           body: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        """ Insert or replace item """
+        return await container.upsert_item(body=body, **kwargs)
+
+    async def _execute_batch(self, container: ContainerProxy,
+                             operations: List[BatchOperation],
+                             partition_key: Any)\
+            -> Tuple[List[Dict[str, Any]], Dict[str, str]]:
+        """ Transactional batch """
+        results = await container.execute_item_batch(
+            batch_operations=operations, partition_key=partition_key
+        )
+        headers = container.client_connection.last_response_headers
+        return list(results), dict(headers or {})
+
+    async def _query_pages(self, container: ContainerProxy, query: str,
+                           parameters: Optional[List[Dict[str, Any]]],
+                           partition_key: Any, max_item_count: Optional[int],
+                           continuation: Optional[str],
+                           **kwargs) -> AsyncIterator[RawPage]:
+        """ Async generator of (items, continuation_token, headers) """
+        query_iterable = container.query_items(
+            query=query, parameters=parameters, partition_key=partition_key,
+            max_item_count=max_item_count, **kwargs
+        )
+        pager = query_iterable.by_page(continuation)
+        async for page in pager:
+            items = [item async for item in page]
+            # read right after the fetch, before yielding to the loop
+            headers = container.client_connection.last_response_headers
+            yield items, pager.continuation_token or None, dict(headers or {})
+
+    async def _read_change_feed(self, container: ContainerProxy,
+                                continuation: Optional[str],
+                                max_item_count: Optional[int]) -> RawPage:
+        """ One change feed page """
+        responses = []
+        pager = container.query_items_change_feed(
+            **self.get_change_feed_kwargs(continuation, max_item_count,
+                                          responses)
+        ).by_page()
+        # the SDK calls the hook once on creation with the shared headers
+        responses.clear()
+        items = []
+        async for page in pager:
+            items = [item async for item in page]
+            break
+        return self.get_change_feed_page(items, continuation, responses)
+
+    async def close(self) -> None:
+        """ Close the SDK client and the connection pool """
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+def create_engine(name: str, host: str, master_key: str,
+                  max_workers: Optional[int] = None, pool_size: int = 100,
+                  pool_size_per_host: int = 0,
+                  throttle_retries: Optional[int] = None,
+                  governor: Optional[RateGovernor] = None) -> CosmosEngine:
+    """ Create engine by name """
+    kwargs = dict(throttle_retries=throttle_retries, governor=governor)
+    if name == Engines.THREADED:
+        return ThreadedCosmosEngine(host, master_key, max_workers, **kwargs)
+    if name == Engines.AIO:
+        return AioCosmosEngine(host, master_key, pool_size,
+                               pool_size_per_host, **kwargs)
+    raise ValueError(f"Unknown cosmos engine: '{name}'")
@@ -0,0 +1,151 @@
+""" Cosmos DB request charge and latency metrics """
+import asyncio
+import bisect
+import sys
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from utils.log import Log
+
+
+TAG = __name__
+
+
+REQUEST_CHARGE_HEADER = "x-ms-request-charge"
+REQUEST_DURATION_HEADER = "x-ms-request-duration-ms"
+
+CHARGE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Histogram:
+    """ Fixed buckets histogram """
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        """ Add value """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p: float) -> float:
+        """ Upper bound of the bucket the percentile falls into """
+        if self.count == 0:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self) -> Dict[str, Any]:
+        """ Histogram summary """
+        return dict(
+            count=self.count, sum=round(self.total, 3), max=self.max,
+            avg=round(self.total / self.count, 3) if self.count else 0,
+            p50=self.percentile(50), p95=self.percentile(95),
+            p99=self.percentile(99),
+            buckets={("+Inf" if i == len(self.buckets) else
+                      str(self.buckets[i])): count
+                     for i, count in enumerate(self.counts)}
+        )
+
+
+class OperationMetrics:
+    """ Metrics of one (operation, container) pair """
+
+    def __init__(self):
+        self.charge = Histogram(CHARGE_BUCKETS)
+        self.latency = Histogram(LATENCY_BUCKETS_MS)
+        self.server_latency = Histogram(LATENCY_BUCKETS_MS)
+        self.statuses = Counter()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """ Operation summary """
+        return dict(requestCharge=self.charge.snapshot(),
+                    latencyMs=self.latency.snapshot(),
+                    serverLatencyMs=self.server_latency.snapshot(),
+                    statuses={str(k): v for k, v in self.statuses.items()})
+
+
+class CosmosMetrics:
+    """ Per operation/container request charge and latency histograms """
+
+    def __init__(self):
+        self.operations: Dict[Tuple[str, str], OperationMetrics] = {}
+        self.reporter: Optional[asyncio.Task] = None
+
+    def record(self, operation: str, container: str,
+               headers: Optional[Dict[str, str]], latency: float,
+               status: int) -> None:
+        """ Record one request, latency in seconds """
+        key = (operation, container)
+        metrics = self.operations.get(key)
+        if metrics is None:
+            metrics = self.operations[key] = OperationMetrics()
+        headers = headers or {}
+        metrics.latency.observe(latency * 1000)
+        metrics.statuses[status] += 1
+        # noinspection PyBroadException
+        try:
+            if REQUEST_CHARGE_HEADER in headers:
+                metrics.charge.observe(float(headers[REQUEST_CHARGE_HEADER]))
+            if REQUEST_DURATION_HEADER in headers:
+                metrics.server_latency.observe(
+                    float(headers[REQUEST_DURATION_HEADER])
+                )
+        except Exception:
+            Log.w(TAG, "record::bad headers", sys.exc_info())
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """ All operations, the most expensive first """
+        items = [dict(operation=operation, container=container,
+                      **metrics.snapshot())
+                 for (operation, container), metrics
+                 in self.operations.items()]
+        return sorted(items, key=lambda x: x["requestCharge"]["sum"],
+                      reverse=True)
+
+    def summary(self) -> str:
+        """ Human readable summary """
+        lines = ["operation/container: count, RU sum/avg/p95, "
+                 "latency ms p50/p95/p99"]
+        for item in self.snapshot():
+            charge, latency = item["requestCharge"], item["latencyMs"]
+            lines.append(
+                f"{item['operation']}/{item['container']}: "
+                f"{latency['count']}, "
+                f"{charge['sum']}/{charge['avg']}/{charge['p95']}, "
+                f"{latency['p50']}/{latency['p95']}/{latency['p99']}"
+            )
+        return "\n".join(lines)
+
+    def start_reporter(self, interval: float) -> None:
+        """ Log summary every `interval` seconds """
+        async def report():
+            """ Reporter loop """
+            while True:
+                await asyncio.sleep(interval)
+                Log.i(TAG, f"cosmos metrics:\n{self.summary()}")
+
+        if self.reporter is None and interval > 0:
+            self.reporter = asyncio.get_event_loop().create_task(report())
+
+    async def stop_reporter(self) -> None:
+        """ Stop the reporter """
+        if self.reporter is not None:
+            self.reporter.cancel()
+            try:
+                await self.reporter
+            except asyncio.CancelledError:
+                pass
+            self.reporter = None
@@ -0,0 +1,192 @@
+""" Outbound delivery queue """
+import asyncio
+import itertools
+import sys
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from utils.cosmos_metrics import Histogram, LATENCY_BUCKETS_MS
+from utils.log import Log
+
+
+TAG = __name__
+
+
+# sends the message, the result is set to the submit() future
+Job = Callable[[], Awaitable[Any]]
+# (priority, sequence, enqueued at, job, future)
+Entry = Tuple[int, int, float, Job, asyncio.Future]
+
+
+class Priority:
+    """ Delivery priorities, lower goes first """
+    HIGH = 0  # a caller is waiting for the result
+    NORMAL = 1  # accepted with 202
+    LOW = 2  # batch fan-out
+
+
+class DeliveryQueueFull(Exception):
+    """ The queue is full or isn't accepting sends """
+    def __init__(self, message: str = "Delivery queue is full"):
+        self.message = message
+
+
+class DeliveryQueue:
+    """ Bounded priority queue of proactive sends drained by a pool of
+        workers, so at most `workers` sends are in flight.
+
+        submit() never waits for space: a full queue raises
+        DeliveryQueueFull and the caller answers 503, that's the
+        backpressure. Sends of the same priority go FIFO. A send submitted
+        with a delay is held by a timer and queued when it's due, the
+        workers never wait for it. stop() stops accepting, waits up to
+        `drain_timeout` seconds for the queued and the scheduled sends and
+        cancels the rest. """
+
+    def __init__(self, workers: int = 16, max_size: int = 10000,
+                 drain_timeout: float = 30):
+        self.workers = max(workers, 1)
+        self.max_size = max_size
+        self.drain_timeout = drain_timeout
+        self.queue: Optional[asyncio.PriorityQueue] = None
+        self.tasks: List[asyncio.Task] = []
+        # scheduled sends by sequence
+        self.timers: Dict[int, Tuple[asyncio.TimerHandle, Entry]] = {}
+        # queued, scheduled and running sends
+        self.unfinished = 0
+        self.drained: Optional[asyncio.Event] = None
+        self.sequence = itertools.count()
+        self.stopping = False
+        self.busy = 0
+        self.submitted = 0
+        self.scheduled = 0
+        self.sent = 0
+        self.failed = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.wait_ms = Histogram(LATENCY_BUCKETS_MS)
+        self.send_ms = Histogram(LATENCY_BUCKETS_MS)
+
+    @property
+    def size(self) -> int:
+        """ Sends waiting for a worker or for their time """
+        return ((self.queue.qsize() if self.queue is not None else 0)
+                + len(self.timers))
+
+    @property
+    def is_running(self) -> bool:
+        """ Does the queue accept sends """
+        return bool(self.tasks) and not self.stopping
+
+    def start(self) -> None:
+        """ Start workers """
+        if self.tasks:
+            return
+        self.stopping = False
+        # bounded by submit(), the due scheduled sends always fit
+        self.queue = asyncio.PriorityQueue()
+        self.drained = asyncio.Event()
+        self.drained.set()
+        loop = asyncio.get_event_loop()
+        self.tasks = [loop.create_task(self.worker())
+                      for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        """ Stop accepting sends and drain the queue """
+        if not self.tasks:
+            return
+        self.stopping = True
+        try:
+            await asyncio.wait_for(self.drained.wait(), self.drain_timeout)
+        except asyncio.TimeoutError:
+            Log.w(TAG, f"stop::drain timeout, {self.size} sends left")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        entries = []
+        for timer, entry in self.timers.values():
+            timer.cancel()
+            entries.append(entry)
+        self.timers.clear()
+        while not self.queue.empty():
+            entries.append(self.queue.get_nowait())
+        for _, _, _, _, future in entries:
+            future.cancel()
+            self.dropped += 1
+        self.unfinished = 0
+        self.drained.set()
+        Log.i(TAG, f"stop::drained: {self.stats()}")
+
+    def submit(self, job: Job, priority: int = Priority.NORMAL,
+               delay: float = 0.0) -> asyncio.Future:
+        """ Queue the send in `delay` seconds, the future gets the job
+            result. Raises DeliveryQueueFull """
+        if not self.is_running:
+            raise DeliveryQueueFull("Delivery queue is not running")
+        if self.size >= self.max_size:
+            self.rejected += 1
+            raise DeliveryQueueFull()
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        entry = (priority, next(self.sequence), 0.0, job, future)
+        if delay > 0:
+            self.scheduled += 1
+            self.timers[entry[1]] = (loop.call_later(delay, self.release,
+                                                     entry), entry)
+        else:
+            self.release(entry)
+        self.unfinished += 1
+        self.drained.clear()
+        self.submitted += 1
+        # the worker logs the errors, the caller may not wait for the result
+        future.add_done_callback(
+            lambda f: f.cancelled() or f.exception()
+        )
+        return future
+
+    def release(self, entry: Entry) -> None:
+        """ Queue the due send """
+        priority, sequence, _, job, future = entry
+        self.timers.pop(sequence, None)
+        self.queue.put_nowait((priority, sequence, time.perf_counter(), job,
+                               future))
+
+    async def worker(self) -> None:
+        """ Send loop """
+        while True:
+            _, _, enqueued, job, future = await self.queue.get()
+            start = time.perf_counter()
+            self.wait_ms.observe((start - enqueued) * 1000)
+            self.busy += 1
+            try:
+                result = await job()
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                self.failed += 1
+                Log.e(TAG, "worker::send error", sys.exc_info())
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.sent += 1
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.busy -= 1
+                self.send_ms.observe((time.perf_counter() - start) * 1000)
+                self.queue.task_done()
+                self.unfinished -= 1
+                if self.unfinished <= 0:
+                    self.drained.set()
+
+    def stats(self) -> Dict[str, Any]:
+        """ Queue counters """
+        return dict(size=self.size, maxSize=self.max_size,
+                    workers=self.workers, busy=self.busy,
+                    submitted=self.submitted, scheduled=self.scheduled,
+                    timers=len(self.timers), sent=self.sent,
+                    failed=self.failed, rejected=self.rejected,
+                    dropped=self.dropped, waitMs=self.wait_ms.snapshot(),
+                    sendMs=self.send_ms.snapshot())
@@ -0,0 +1,266 @@
+""" Durable Power Automate flow dispatch queue """
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import time
+from concurrent import futures
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import aiohttp
+
+from utils.cosmos_metrics import Histogram
+from utils.json_func import json_dumps
+from utils.log import Log
+
+
+TAG = __name__
+
+
+DISPATCH_BUCKETS_MS = (10, 50, 100, 500, 1000, 5000, 10000, 30000, 60000,
+                       300000, 900000, 3600000)
+RETRY_AFTER_HEADER = "Retry-After"
+
+# (id, url, payload, attempts, created)
+Job = Tuple[int, str, str, int, float]
+
+
+class FlowDispatcher:
+    """ SQLite backed queue of flow calls drained by `workers` workers.
+
+        enqueue() returns once the job is committed, so the turn doesn't
+        wait for the flow run. A worker claims a due job by moving its
+        next_at `lease` seconds ahead, so a job claimed by a crashed
+        process is picked up again after the lease: the delivery is at
+        least once. 5xx, 429 and network errors are retried with
+        exponential backoff (429 honors Retry-After), other 4xx and jobs
+        failing `max_retries` times are marked dead and kept in the file.
+        One process per queue file. """
+
+    def __init__(self, path: str,
+                 session_provider: Callable[[], aiohttp.ClientSession],
+                 workers: int = 4, max_retries: int = 8,
+                 base_delay: float = 1.0, max_delay: float = 300.0,
+                 lease: float = 120.0, poll_interval: float = 1.0):
+        self.path = path
+        self.session_provider = session_provider
+        self.workers = max(workers, 1)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.executor = futures.ThreadPoolExecutor(1)
+        self.connection: Optional[sqlite3.Connection] = None
+        self.tasks: List[asyncio.Task] = []
+        self.event: Optional[asyncio.Event] = None
+        self.stopping = False
+        self.pending = 0
+        self.enqueued = 0
+        self.dispatched = 0
+        self.retried = 0
+        self.dead = 0
+        self.dispatch_ms = Histogram(DISPATCH_BUCKETS_MS)
+        self.post_ms = Histogram(DISPATCH_BUCKETS_MS)
+
+    async def execute_blocking(self, bl, *args):
+        """ Execute blocking code on the queue thread """
+        return await asyncio.get_event_loop().run_in_executor(self.executor,
+                                                              bl, *args)
+
+    def get_connection_bl(self) -> sqlite3.Connection:
+        """ Get or open the connection, queue thread only """
+        if self.connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                        exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # the job must survive a crash right after the turn has ended
+            connection.execute("PRAGMA synchronous=FULL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS flow_jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT NOT NULL, "
+                "payload TEXT NOT NULL, attempts INTEGER NOT NULL, "
+                "next_at REAL NOT NULL, created REAL NOT NULL, "
+                "dead INTEGER NOT NULL DEFAULT 0, error TEXT)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_flow_jobs_next_at "
+                "ON flow_jobs (dead, next_at)"
+            )
+            self.connection = connection
+        return self.connection
+
+    def count_pending_bl(self) -> int:
+        """ Jobs left by the previous run """
+        return self.get_connection_bl().execute(
+            "SELECT COUNT(1) FROM flow_jobs WHERE dead = 0"
+        ).fetchone()[0]
+
+    def insert_bl(self, url: str, payload: str) -> int:
+        """ Persist the job """
+        now = time.time()
+        return self.get_connection_bl().execute(
+            "INSERT INTO flow_jobs (url, payload, attempts, next_at, created) "
+            "VALUES (?, ?, 0, ?, ?)", (url, payload, now, now)
+        ).lastrowid
+
+    def claim_bl(self) -> Optional[Job]:
+        """ Take the earliest due job for `lease` seconds """
+        now = time.time()
+        connection = self.get_connection_bl()
+        row = connection.execute(
+            "SELECT id, url, payload, attempts, created FROM flow_jobs "
+            "WHERE dead = 0 AND next_at <= ? ORDER BY next_at LIMIT 1",
+            (now,)
+        ).fetchone()
+        if row is not None:
+            connection.execute("UPDATE flow_jobs SET next_at = ? WHERE id = ?",
+                               (now + self.lease, row[0]))
+        return row
+
+    def delete_bl(self, job_id: int) -> None:
+        """ Job done """
+        self.get_connection_bl().execute("DELETE FROM flow_jobs WHERE id = ?",
+                                         (job_id,))
+
+    def reschedule_bl(self, job_id: int, attempts: int, next_at: float,
+                      error: str) -> None:
+        """ Retry the job at next_at """
+        self.get_connection_bl().execute(
+            "UPDATE flow_jobs SET attempts = ?, next_at = ?, error = ? "
+            "WHERE id = ?", (attempts, next_at, error, job_id)
+        )
+
+    def bury_bl(self, job_id: int, attempts: int, error: str) -> None:
+        """ Give up on the job, it stays in the file """
+        self.get_connection_bl().execute(
+            "UPDATE flow_jobs SET attempts = ?, dead = 1, error = ? "
+            "WHERE id = ?", (attempts, error, job_id)
+        )
+
+    async def start(self) -> None:
+        """ Open the queue and start the workers """
+        if self.tasks:
+            return
+        self.stopping = False
+        self.event = asyncio.Event()
+        self.pending = await self.execute_blocking(self.count_pending_bl)
+        loop = asyncio.get_event_loop()
+        self.tasks = [loop.create_task(self.worker())
+                      for _ in range(self.workers)]
+        Log.i(TAG, f"start::{self.pending} jobs pending")
+
+    async def stop(self, timeout: float = 10) -> None:
+        """ Let the running calls finish, the queued jobs stay in the file
+            for the next start """
+        if not self.tasks:
+            return
+        self.stopping = True
+        self.event.set()
+        _, running = await asyncio.wait(self.tasks, timeout=timeout)
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        await self.execute_blocking(self.close_bl)
+        Log.i(TAG, f"stop::{self.stats()}")
+
+    def close_bl(self) -> None:
+        """ Close the connection """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    async def enqueue(self, url: str, payload: Dict[str, Any]) -> int:
+        """ Persist the flow call, returns the job id """
+        job_id = await self.execute_blocking(self.insert_bl, url,
+                                             json_dumps(payload))
+        self.enqueued += 1
+        self.pending += 1
+        if self.event is not None:
+            self.event.set()
+        return job_id
+
+    async def worker(self) -> None:
+        """ Dispatch loop """
+        while not self.stopping:
+            # noinspection PyBroadException
+            try:
+                job = await self.execute_blocking(self.claim_bl)
+                if job is not None:
+                    await self.dispatch(job)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                Log.e(TAG, "worker::error", sys.exc_info())
+            self.event.clear()
+            try:
+                await asyncio.wait_for(self.event.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def dispatch(self, job: Job) -> None:
+        """ Call the flow, then delete, reschedule or bury the job """
+        job_id, url, payload, attempts, created = job
+        attempts += 1
+        start = time.perf_counter()
+        retry_after = None
+        try:
+            async with self.session_provider().post(
+                url, data=payload, headers={"Content-Type": "application/json"}
+            ) as response:
+                await response.read()
+                status = response.status
+                retry_after = response.headers.get(RETRY_AFTER_HEADER)
+            error = None if status < 400 else f"HTTP {status}"
+            retryable = status >= 500 or status == 429
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # network errors and the rest alike, the job mustn't stay leased
+            error, retryable = f"{type(e).__name__}: {e}", True
+        finally:
+            self.post_ms.observe((time.perf_counter() - start) * 1000)
+
+        if error is None:
+            await self.execute_blocking(self.delete_bl, job_id)
+            self.pending -= 1
+            self.dispatched += 1
+            self.dispatch_ms.observe((time.time() - created) * 1000)
+            return
+        if not retryable or attempts > self.max_retries:
+            await self.execute_blocking(self.bury_bl, job_id, attempts,
+                                        error)
+            self.pending -= 1
+            self.dead += 1
+            Log.e(TAG, f"dispatch::job {job_id} {url} is dead after "
+                       f"{attempts} attempts: {error}")
+            return
+        delay = self.get_delay(attempts, retry_after)
+        await self.execute_blocking(self.reschedule_bl, job_id, attempts,
+                                    time.time() + delay, error)
+        self.retried += 1
+        Log.w(TAG, f"dispatch::job {job_id} {error}, "
+                   f"retry {attempts} in {delay:.3f}s")
+
+    def get_delay(self, attempts: int, retry_after: Optional[str]) -> float:
+        """ Retry-After seconds or exponential backoff with jitter """
+        if retry_after:
+            try:
+                return min(max(float(retry_after), 0), self.max_delay)
+            except ValueError:
+                pass
+        delay = min(self.base_delay * (2 ** (attempts - 1)), self.max_delay)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def stats(self) -> Dict[str, Any]:
+        """ Queue counters """
+        return dict(pending=self.pending, workers=self.workers,
+                    enqueued=self.enqueued, dispatched=self.dispatched,
+                    retried=self.retried, dead=self.dead,
+                    dispatchMs=self.dispatch_ms.snapshot(),
+                    postMs=self.post_ms.snapshot())
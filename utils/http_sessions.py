@@ -0,0 +1,93 @@
+""" Shared outbound HTTP sessions """
+import asyncio
+from types import SimpleNamespace
+from typing import Any, Dict, Optional
+
+import aiohttp
+
+
+class HttpSessionPool:
+    """ One keep-alive aiohttp session for the outbound calls
+        (Power Automate flows, webhooks).
+
+        The connector keeps idle connections for `keepalive_timeout`
+        seconds, caps them at `limit` in total and `limit_per_host` per
+        host, and caches DNS for `dns_ttl` seconds. The session is created
+        on the first use within the event loop and closed by close(). """
+
+    def __init__(self, limit: int = 100, limit_per_host: int = 10,
+                 dns_ttl: int = 300, keepalive_timeout: float = 30,
+                 timeout: float = 30):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.requests = 0
+        self.errors = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.dns_cache_hits = 0
+        self.dns_cache_misses = 0
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """ Shared session """
+        if self._session is None or self._session.closed:
+            self._session = self.create_session()
+        return self._session
+
+    def create_session(self) -> aiohttp.ClientSession:
+        """ Session with the pooled connector and the counters """
+        connector = aiohttp.TCPConnector(
+            limit=self.limit, limit_per_host=self.limit_per_host,
+            use_dns_cache=True, ttl_dns_cache=self.dns_ttl,
+            keepalive_timeout=self.keepalive_timeout
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            trace_configs=[self.create_trace_config()]
+        )
+
+    def create_trace_config(self) -> aiohttp.TraceConfig:
+        """ Count the requests, new and reused connections """
+        def counter(name: str):
+            """ Trace callback incrementing the counter """
+            async def callback(_session: aiohttp.ClientSession,
+                               _context: SimpleNamespace,
+                               _params: Any) -> None:
+                """ Increment """
+                setattr(self, name, getattr(self, name) + 1)
+            return callback
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(counter("requests"))
+        trace_config.on_request_exception.append(counter("errors"))
+        trace_config.on_connection_create_end.append(
+            counter("connections_created")
+        )
+        trace_config.on_connection_reuseconn.append(
+            counter("connections_reused")
+        )
+        trace_config.on_dns_cache_hit.append(counter("dns_cache_hits"))
+        trace_config.on_dns_cache_miss.append(counter("dns_cache_misses"))
+        return trace_config
+
+    async def close(self) -> None:
+        """ Close the session and its connections """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            # let the SSL transports close, see aiohttp graceful shutdown
+            await asyncio.sleep(0.25)
+        self._session = None
+
+    def stats(self) -> Dict[str, Any]:
+        """ Pool counters """
+        return dict(limit=self.limit, limitPerHost=self.limit_per_host,
+                    requests=self.requests, errors=self.errors,
+                    connectionsCreated=self.connections_created,
+                    connectionsReused=self.connections_reused,
+                    dnsCacheHits=self.dns_cache_hits,
+                    dnsCacheMisses=self.dns_cache_misses)
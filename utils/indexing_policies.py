@@ -0,0 +1,64 @@
+""" Declarative Cosmos DB indexing policies """
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+
+ASCENDING = "ascending"
+DESCENDING = "descending"
+
+# added by Cosmos DB to every policy
+SYSTEM_EXCLUDED_PATHS = {'/"_etag"/?'}
+
+
+CompositeIndex = Sequence[Tuple[str, str]]
+
+
+def make_policy(included: Sequence[str] = (),
+                excluded: Sequence[str] = ("/*",),
+                composite: Sequence[CompositeIndex] = ()) -> Dict[str, Any]:
+    """ Consistent indexing policy, everything is excluded by default and
+        only the queried paths are included """
+    policy = dict(
+        indexingMode="consistent",
+        automatic=True,
+        includedPaths=[dict(path=path) for path in included],
+        excludedPaths=[dict(path=path) for path in excluded],
+    )
+    if composite:
+        policy.update(dict(compositeIndexes=[
+            [dict(path=path, order=order) for path, order in index]
+            for index in composite
+        ]))
+    return policy
+
+
+def normalize(policy: Optional[Dict[str, Any]])\
+        -> Tuple[Set[str], Set[str], Set[Tuple[Tuple[str, str], ...]]]:
+    """ (included paths, excluded paths, composite indexes) """
+    policy = policy or {}
+    included = set(x["path"] for x in policy.get("includedPaths", []))
+    excluded = set(x["path"] for x in policy.get("excludedPaths", [])) \
+        - SYSTEM_EXCLUDED_PATHS
+    composite = set(
+        tuple((x["path"], x.get("order", ASCENDING)) for x in index)
+        for index in policy.get("compositeIndexes", [])
+    )
+    return included, excluded, composite
+
+
+def diff(declared: Dict[str, Any],
+         actual: Optional[Dict[str, Any]]) -> Dict[str, List[Any]]:
+    """ Drift between the declared and the actual policy,
+        empty dict if there is none """
+    drift = {}
+    names = ("IncludedPaths", "ExcludedPaths", "CompositeIndexes")
+    for name, expected, found in zip(names, normalize(declared),
+                                     normalize(actual)):
+        missing, unexpected = expected - found, found - expected
+        if missing:
+            drift[f"missing{name}"] = sorted(missing)
+        if unexpected:
+            drift[f"unexpected{name}"] = sorted(unexpected)
+    if declared.get("indexingMode") != (actual or {}).get("indexingMode"):
+        drift["indexingMode"] = [declared.get("indexingMode"),
+                                 (actual or {}).get("indexingMode")]
+    return drift
@@ -0,0 +1,72 @@
+""" Bounded in-process LRU cache with TTL """
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+_MISSING = object()
+
+
+class TTLCache:
+    """ LRU cache with per-entry time to live.
+
+        Not thread safe, meant to be used from the event loop only. """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = 300):
+        self.max_size = max(max_size, 1)
+        self.ttl = ttl
+        self.items: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING, count=False) is not _MISSING
+
+    def get(self, key: Hashable, default: Any = None,
+            count: bool = True) -> Any:
+        """ Get value or default if there is no value or it has expired """
+        entry = self.items.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at is None or expires_at > time.monotonic():
+                self.items.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return value
+            del self.items[key]
+            self.expirations += 1
+        if count:
+            self.misses += 1
+        return default
+
+    def put(self, key: Hashable, value: Any,
+            ttl: Optional[float] = None) -> None:
+        """ Put value, evict the least recently used item if needed """
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        self.items[key] = (expires_at, value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        """ Drop the key """
+        self.items.pop(key, None)
+
+    def clear(self) -> None:
+        """ Drop everything """
+        self.items.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """ Cache counters """
+        lookups = self.hits + self.misses
+        return dict(size=len(self.items), maxSize=self.max_size,
+                    ttl=self.ttl, hits=self.hits, misses=self.misses,
+                    hitRatio=round(self.hits / lookups, 4) if lookups else 0,
+                    evictions=self.evictions, expirations=self.expirations)
@@ -0,0 +1,192 @@
+""" Outbound Bot Framework rate limiter """
+import email.utils
+import math
+import random
+import time
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
+
+from utils.log import Log
+from utils.lru_cache import TTLCache
+
+
+TAG = __name__
+
+
+# (messages, seconds)
+Limit = Tuple[int, float]
+
+# Teams per bot per conversation thresholds
+TEAMS_CONVERSATION_LIMITS: Sequence[Limit] = ((7, 1), (8, 2), (60, 30),
+                                              (1800, 3600))
+# Teams per bot global (per app per tenant) threshold
+TEAMS_GLOBAL_LIMITS: Sequence[Limit] = ((50, 1),)
+
+RETRY_AFTER_HEADER = "Retry-After"
+TOO_MANY_REQUESTS = 429
+
+
+def parse_limits(value: str) -> List[Limit]:
+    """ '7/1,8/2' -> [(7, 1.0), (8, 2.0)] """
+    limits = []
+    for limit in value.split(","):
+        count, seconds = limit.strip().split("/")
+        limits.append((int(count), float(seconds)))
+    return limits
+
+
+class TokenBucket:
+    """ At most `count` tokens within any `seconds` window.
+
+        Teams counts the messages in sliding windows, so a bucket that
+        holds `count` tokens and refills `count` per window lets through
+        up to twice the limit. The bucket holds `burst` of the window and
+        refills the rest evenly: burst + rate * seconds == count.
+
+        take() always takes a token and returns how long the caller has to
+        wait for it: the tokens go negative while the callers queue up. """
+
+    def __init__(self, count: int, seconds: float, burst: float = 0.25):
+        self.capacity = float(min(max(math.ceil(count * burst), 1), count))
+        self.rate = max(count - self.capacity, 1) / seconds
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self, now: float) -> float:
+        """ Take a token, returns the delay in seconds """
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(-self.tokens / self.rate, 0.0)
+
+
+class RateLimit:
+    """ Several windows of one key, the strictest one wins """
+
+    def __init__(self, limits: Sequence[Limit], burst: float = 0.25):
+        self.buckets = [TokenBucket(count, seconds, burst)
+                        for count, seconds in limits]
+        self.paused_until = 0.0
+
+    def take(self, now: float) -> float:
+        """ Take a token from every window, returns the delay """
+        delay = max([bucket.take(now) for bucket in self.buckets] or [0.0])
+        return max(delay, self.paused_until - now)
+
+    def pause(self, seconds: float) -> None:
+        """ Stop sending for `seconds`, the server has asked for it """
+        self.paused_until = max(self.paused_until,
+                                time.monotonic() + seconds)
+
+
+class OutboundLimiter:
+    """ Paces the sends to the Bot Framework connector below the Teams
+        throttling thresholds.
+
+        reserve() takes a token of the service URL (global limits) and of
+        the conversation (per conversation limits) and returns when both
+        are available. The caller schedules the send for that time, so a
+        burst is spread over time instead of being rejected and nobody
+        sleeps on a token. `burst` is the share of every window that may
+        be sent at once, the rest is paced. throttle() pauses the
+        conversation for Retry-After (or an exponential backoff) after a
+        429, the send is re-queued up to `max_retries` times. """
+
+    def __init__(self,
+                 conversation_limits: Sequence[Limit] =
+                 TEAMS_CONVERSATION_LIMITS,
+                 global_limits: Sequence[Limit] = TEAMS_GLOBAL_LIMITS,
+                 burst: float = 0.25, max_conversations: int = 10000,
+                 max_retries: int = 3, base_delay: float = 1.0,
+                 max_delay: float = 60.0):
+        self.conversation_limits = conversation_limits
+        self.global_limits = global_limits
+        self.burst = burst
+        # the longest window is refilled after an hour of silence anyway
+        self.conversations = TTLCache(max_conversations, 3600)
+        self.services: Dict[str, RateLimit] = {}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.delayed = 0
+        self.delay_total = 0.0
+        self.throttled = 0
+        self.give_ups = 0
+
+    def get_conversation_limit(self, key: Hashable) -> RateLimit:
+        """ Get or create the conversation limit """
+        limit = self.conversations.get(key, count=False)
+        if limit is None:
+            limit = RateLimit(self.conversation_limits, self.burst)
+            self.conversations.put(key, limit)
+        return limit
+
+    def get_service_limit(self, service_url: str) -> RateLimit:
+        """ Get or create the service URL limit """
+        limit = self.services.get(service_url)
+        if limit is None:
+            limit = RateLimit(self.global_limits, self.burst)
+            self.services[service_url] = limit
+        return limit
+
+    def reserve(self, service_url: str, conversation_id: str) -> float:
+        """ Take the send slot, returns in how many seconds it's due """
+        now = time.monotonic()
+        delay = max(
+            self.get_service_limit(service_url).take(now),
+            self.get_conversation_limit((service_url,
+                                         conversation_id)).take(now)
+        )
+        if delay > 0:
+            self.delayed += 1
+            self.delay_total += delay
+        return delay
+
+    @staticmethod
+    def get_status(error: Exception) -> Optional[int]:
+        """ HTTP status of the connector error if any """
+        response = getattr(error, "response", None)
+        return getattr(response, "status_code", None)
+
+    def get_delay(self, error: Exception, attempt: int) -> float:
+        """ Retry-After (seconds or HTTP date) or exponential backoff """
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None) or {}
+        retry_after = headers.get(RETRY_AFTER_HEADER)
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_delay)
+            except ValueError:
+                pass
+            try:
+                date = email.utils.parsedate_to_datetime(retry_after)
+                return min(max(date.timestamp() - time.time(), 0),
+                           self.max_delay)
+            except (TypeError, ValueError):
+                pass
+        delay = min(self.base_delay * (2 ** (attempt - 1)), self.max_delay)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def throttle(self, service_url: str, conversation_id: str,
+                 error: Exception, attempt: int) -> bool:
+        """ Pause the conversation after a 429, returns False when the
+            error isn't a 429 or the `attempt` is over max_retries """
+        if self.get_status(error) != TOO_MANY_REQUESTS:
+            return False
+        self.throttled += 1
+        if attempt > self.max_retries:
+            self.give_ups += 1
+            return False
+        delay = self.get_delay(error, attempt)
+        Log.w(TAG, f"throttle::{service_url} {conversation_id} "
+                   f"throttled, retry {attempt} in {delay:.3f}s")
+        self.get_conversation_limit((service_url,
+                                     conversation_id)).pause(delay)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        """ Limiter counters """
+        return dict(conversations=len(self.conversations),
+                    services=len(self.services), delayed=self.delayed,
+                    delaySeconds=round(self.delay_total, 3),
+                    throttled=self.throttled, giveUps=self.give_ups)
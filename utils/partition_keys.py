@@ -0,0 +1,69 @@
+""" Partition key strategies of the tenant scoped containers """
+import zlib
+from typing import Any, Dict, Optional
+
+
+class PartitionKeyStrategy:
+    """ Tenant partition key, optionally spread over hash buckets.
+
+        With buckets == 0 documents are partitioned by /tenantId: every
+        document of a tenant lands in one logical partition. With buckets > 0
+        the synthetic /partitionKey is '<tenantId>:<bucket>', the bucket is
+        crc32(id) % buckets. It depends on the id only, so a point read
+        still needs nothing but the tenant and the id, while the writes are
+        spread over `buckets` logical partitions. Changing the number of
+        buckets moves the documents, so every layout has its own container
+        and the old one is migrated, see tools.migrate_partitions.
+        Documents with GROUP_FIELD (the delivery of a notification) take
+        the bucket of the group id, so they share the partition with the
+        group document and can be written with it in one batch. """
+
+    TENANT_FIELD = "tenantId"
+    SYNTHETIC_FIELD = "partitionKey"
+    GROUP_FIELD = "notificationId"
+
+    def __init__(self, buckets: int = 0):
+        self.buckets = max(buckets, 0)
+
+    def __repr__(self) -> str:
+        # stable, it's a part of the provisioning fingerprint
+        return f"PartitionKeyStrategy(buckets={self.buckets})"
+
+    @property
+    def is_synthetic(self) -> bool:
+        """ Is the key synthetic """
+        return self.buckets > 0
+
+    @property
+    def path(self) -> str:
+        """ Partition key path """
+        field = self.SYNTHETIC_FIELD if self.is_synthetic \
+            else self.TENANT_FIELD
+        return f"/{field}"
+
+    def container_name(self, name: str) -> str:
+        """ Container name of the layout """
+        return f"{name}-b{self.buckets}" if self.is_synthetic else name
+
+    def legacy_container_name(self, name: str) -> Optional[str]:
+        """ Container of the /tenantId layout to fall back to, if any """
+        return name if self.is_synthetic else None
+
+    def get_bucket(self, item_id: str) -> int:
+        """ Hash bucket of the id """
+        return zlib.crc32(item_id.encode("utf-8")) % self.buckets
+
+    def value(self, tenant_id: str, item_id: str) -> str:
+        """ Partition key value of the document """
+        if not self.is_synthetic:
+            return tenant_id
+        return f"{tenant_id}:{self.get_bucket(item_id)}"
+
+    def apply(self, body: Dict[str, Any]) -> str:
+        """ Set the synthetic key field of the document,
+            returns the partition key value """
+        value = self.value(body[self.TENANT_FIELD],
+                           body.get(self.GROUP_FIELD) or body["id"])
+        if self.is_synthetic:
+            body[self.SYNTHETIC_FIELD] = value
+        return value
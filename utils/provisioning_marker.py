@@ -0,0 +1,55 @@
+""" Cached marker of the last successful storage provisioning """
+import hashlib
+import os
+import sys
+from typing import Any, Iterable
+
+from utils.json_func import json_dumps
+from utils.log import Log
+
+
+TAG = __name__
+
+
+class ProvisioningMarker:
+    """ File with the fingerprint of the provisioned definitions.
+
+        The fingerprint covers the account host and every upper case
+        attribute of every container definition (database, container,
+        partition key, ...), so any change of a definition invalidates the
+        marker and the next startup provisions again. """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @staticmethod
+    def fingerprint(host: str, definitions: Iterable[Any]) -> str:
+        """ Fingerprint of the definitions """
+        data = dict(host=host, definitions=[
+            {key: getattr(definition, key) for key in dir(definition)
+             if key.isupper()}
+            for definition in definitions
+        ])
+        return hashlib.sha1(
+            json_dumps(data, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+    def is_valid(self, fingerprint: str) -> bool:
+        """ Does the marker match the fingerprint """
+        try:
+            with open(self.path, "r") as f:
+                return f.read().strip() == fingerprint
+        except OSError:
+            return False
+
+    def save(self, fingerprint: str) -> None:
+        """ Save the marker, errors are logged and ignored """
+        tmp_path = f"{self.path}.tmp"
+        # noinspection PyBroadException
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(fingerprint)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            Log.w(TAG, f"save::can't save marker {self.path}",
+                  sys.exc_info())
@@ -0,0 +1,192 @@
+""" RU-aware adaptive throttling for Cosmos DB requests """
+import asyncio
+import random
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict
+
+import azure.cosmos.exceptions as exceptions
+
+from utils.log import Log
+
+
+TAG = __name__
+
+
+RETRY_AFTER_HEADER = "x-ms-retry-after-ms"
+TOO_MANY_REQUESTS = 429
+
+
+class AdaptiveLimiter:
+    """ AIMD concurrency limit of one container.
+
+        The limit grows by `increase` after every `limit` successful
+        requests (roughly once per round trip at full load) and is
+        multiplied by `decrease` on every throttled request. Requests over
+        the limit wait in FIFO order. """
+
+    def __init__(self, initial: int = 32, min_limit: int = 1,
+                 max_limit: int = 256, increase: int = 1,
+                 decrease: float = 0.5):
+        self.min_limit = max(min_limit, 1)
+        self.max_limit = max(max_limit, self.min_limit)
+        self.limit = min(max(initial, self.min_limit), self.max_limit)
+        self.increase = increase
+        self.decrease = decrease
+        self.in_flight = 0
+        self.successes = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.throttles = 0
+
+    async def acquire(self) -> None:
+        """ Wait for a free slot """
+        if self.in_flight < self.limit and not self.waiters:
+            self.in_flight += 1
+            return
+        future = asyncio.get_event_loop().create_future()
+        self.waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was handed over already, give it back
+                self.release()
+            else:
+                self.waiters.remove(future)
+            raise
+
+    def release(self) -> None:
+        """ Free the slot and wake up the waiters that fit the limit """
+        self.in_flight -= 1
+        self.wake_up()
+
+    def wake_up(self) -> None:
+        """ Hand the free slots over to the waiters """
+        while self.waiters and self.in_flight < self.limit:
+            future = self.waiters.popleft()
+            if not future.done():
+                self.in_flight += 1
+                future.set_result(None)
+
+    def on_success(self) -> None:
+        """ Additive increase """
+        self.successes += 1
+        if self.successes >= self.limit:
+            self.successes = 0
+            self.limit = min(self.limit + self.increase, self.max_limit)
+            self.wake_up()
+
+    def on_throttle(self) -> None:
+        """ Multiplicative decrease """
+        self.throttles += 1
+        self.successes = 0
+        self.limit = max(int(self.limit * self.decrease), self.min_limit)
+
+    def stats(self) -> Dict[str, Any]:
+        """ Limiter counters """
+        return dict(limit=self.limit, inFlight=self.in_flight,
+                    queued=len(self.waiters), throttles=self.throttles)
+
+
+class RateGovernor:
+    """ Per container AIMD limiter plus 429 retries.
+
+        Throttled requests are retried after x-ms-retry-after-ms (or an
+        exponential backoff if the header is missing) plus jitter, up to
+        `max_retries` times, then the 429 error is raised to the caller. """
+
+    def __init__(self, initial_limit: int = 32, min_limit: int = 1,
+                 max_limit: int = 256, max_retries: int = 5,
+                 base_delay: float = 0.1, max_delay: float = 10.0):
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limiters: Dict[str, AdaptiveLimiter] = {}
+        self.retries = 0
+        self.give_ups = 0
+
+    def limiter(self, container_id: str) -> AdaptiveLimiter:
+        """ Get or create container limiter """
+        limiter = self.limiters.get(container_id)
+        if limiter is None:
+            limiter = self.limiters[container_id] = AdaptiveLimiter(
+                self.initial_limit, self.min_limit, self.max_limit
+            )
+        return limiter
+
+    def get_delay(self, error: exceptions.CosmosHttpResponseError,
+                  attempt: int) -> float:
+        """ Retry delay in seconds with jitter, attempt starts from 1 """
+        retry_after = (error.headers or {}).get(RETRY_AFTER_HEADER)
+        try:
+            delay = float(retry_after) / 1000
+        except (TypeError, ValueError):
+            delay = self.base_delay * (2 ** (attempt - 1))
+        delay = min(delay, self.max_delay)
+        return delay + random.uniform(0, max(delay * 0.2, self.base_delay))
+
+    @staticmethod
+    def is_throttled(error: Exception) -> bool:
+        """ Is it 429 Too Many Requests """
+        return isinstance(error, exceptions.CosmosHttpResponseError) \
+            and error.status_code == TOO_MANY_REQUESTS
+
+    async def limited(self, container_id: str,
+                      call: Callable[[], Awaitable[Any]]) -> Any:
+        """ Run `call()` once within the container limit """
+        limiter = self.limiter(container_id)
+        await limiter.acquire()
+        try:
+            result = await call()
+        except exceptions.CosmosHttpResponseError as e:
+            if self.is_throttled(e):
+                limiter.on_throttle()
+            raise
+        else:
+            limiter.on_success()
+            return result
+        finally:
+            limiter.release()
+
+    async def backoff(self, container_id: str,
+                      error: exceptions.CosmosHttpResponseError,
+                      attempt: int) -> bool:
+        """ Sleep before the retry `attempt`,
+            False if the caller has to give up """
+        if attempt > self.max_retries:
+            self.give_ups += 1
+            Log.w(TAG, f"backoff::{container_id} throttled, giving up after "
+                       f"{attempt} attempts")
+            return False
+        self.retries += 1
+        delay = self.get_delay(error, attempt)
+        Log.d(TAG, f"backoff::{container_id} throttled, attempt: {attempt}, "
+                   f"retry in {delay:.3f}s, "
+                   f"limit: {self.limiter(container_id).limit}")
+        await asyncio.sleep(delay)
+        return True
+
+    async def run(self, container_id: str,
+                  call: Callable[[], Awaitable[Any]]) -> Any:
+        """ Run `call()` within the container limit, retry on 429 """
+        attempt = 0
+        while True:
+            try:
+                return await self.limited(container_id, call)
+            except exceptions.CosmosHttpResponseError as e:
+                if not self.is_throttled(e):
+                    raise
+                attempt += 1
+                if not await self.backoff(container_id, e, attempt):
+                    raise
+
+    def stats(self) -> Dict[str, Any]:
+        """ Governor counters """
+        return dict(
+            retries=self.retries, giveUps=self.give_ups,
+            queued=sum(len(x.waiters) for x in self.limiters.values()),
+            containers={container_id: limiter.stats()
+                        for container_id, limiter in self.limiters.items()}
+        )
@@ -0,0 +1,54 @@
+""" Index of conversation references already stored in the DB """
+import hashlib
+from typing import Any, Dict, Hashable, Optional
+
+from utils.json_func import json_dumps
+from utils.lru_cache import TTLCache
+
+
+class ReferenceIndex:
+    """ Remembers the content digest of every reference we've stored.
+
+        Inbound activities carry the conversation reference on every turn,
+        only a new conversation or a change in one of DIGEST_FIELDS
+        (serviceUrl, locale, ...) is worth a DB write. activityId and user
+        are left out on purpose: they change with every message. """
+
+    DIGEST_FIELDS = ("channelId", "serviceUrl", "locale", "bot",
+                     "conversation")
+
+    def __init__(self, max_size: int = 10000, ttl: Optional[float] = 3600):
+        self.digests = TTLCache(max_size, ttl)
+        self.skipped = 0
+        self.writes = 0
+
+    @classmethod
+    def digest(cls, reference_json: Dict[str, Any]) -> str:
+        """ Content digest of the reference fields we care about """
+        data = {key: reference_json.get(key) for key in cls.DIGEST_FIELDS}
+        return hashlib.sha1(
+            json_dumps(data, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def is_seen(self, key: Hashable) -> bool:
+        """ Have we seen any version of the reference """
+        return key in self.digests
+
+    def is_stored(self, key: Hashable, digest: str) -> bool:
+        """ Is this exact version of the reference already in the DB """
+        if self.digests.get(key) == digest:
+            self.skipped += 1
+            return True
+        return False
+
+    def add(self, key: Hashable, digest: str, written: bool = False) -> None:
+        """ Mark reference version as stored """
+        self.digests.put(key, digest)
+        if written:
+            self.writes += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """ Index counters """
+        stats = self.digests.stats()
+        stats.update(dict(skipped=self.skipped, writes=self.writes))
+        return stats
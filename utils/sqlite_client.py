@@ -0,0 +1,408 @@
+""" Embedded SQLite storage backend """
+import asyncio
+import sqlite3
+import time
+import uuid
+from concurrent import futures
+from typing import Any, AsyncIterator, Dict, List, NamedTuple, Optional, \
+    Sequence, Tuple, Type
+
+from botbuilder.core import TurnContext
+from botbuilder.schema import ChannelAccount, \
+    ConversationReference as MSConversationReference
+from marshmallow import EXCLUDE
+
+from entities.json.acknowledge import Acknowledge
+from entities.json.flow import Flow
+from entities.json.initiation import Initiation
+from entities.json.notification import NotificationCosmos
+from entities.json.notification_delivery import NotificationDelivery
+from entities.json.notification_summary import NotificationStatus, \
+    NotificationSummary
+from utils.json_func import json_dumps, json_loads
+from utils.log import Log
+from utils.storage_backend import StorageBackend, StorageBackends, \
+    AcknowledgeRecord, Containers, InitiationRecord, ItemExists, \
+    ItemNotFound
+
+
+TAG = __name__
+
+
+# container -> table, every table is (pk, id, ts, body) where pk is the
+# Cosmos partition key value and ts is the Cosmos-like _ts
+TABLES = {
+    Containers.CONVERSATIONS: "conversations",
+    Containers.NOTIFICATIONS: "notifications",
+    Containers.ACKNOWLEDGES: "acknowledges",
+    Containers.INITIATIONS: "initiations",
+    Containers.FLOWS: "flows",
+}
+# tables partitioned by notificationId and listed in _ts order
+NOTIFICATION_TABLES = (Containers.ACKNOWLEDGES, Containers.INITIATIONS)
+
+
+class SQLiteClient(StorageBackend):
+    """ SQLite storage in WAL mode.
+
+        One connection used from a single worker thread, so the event loop
+        never blocks on the file and the writes never contend with each
+        other. Acknowledges and initiations are listed with the
+        (notificationId, _ts) index, paging tokens are '<_ts>:<rowid>'
+        keysets, no OFFSET scans. """
+
+    name = StorageBackends.SQLITE
+
+    def __init__(self, path: str, busy_timeout: int = 5000):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.executor = futures.ThreadPoolExecutor(1)
+        self.connection: Optional[sqlite3.Connection] = None
+        self.reads = 0
+        self.writes = 0
+        self.queries = 0
+
+    async def execute_blocking(self, bl, *args):
+        """ Execute blocking code on the DB thread """
+        return await asyncio.get_event_loop().run_in_executor(self.executor,
+                                                              bl,
+                                                              *args)
+
+    def get_connection_bl(self) -> sqlite3.Connection:
+        """ Get or open the connection, DB thread only """
+        if self.connection is None:
+            connection = sqlite3.connect(self.path, check_same_thread=False,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(f"PRAGMA busy_timeout={self.busy_timeout}")
+            self.connection = connection
+        return self.connection
+
+    def init_storage_bl(self) -> None:
+        """ Create tables and indexes """
+        connection = self.get_connection_bl()
+        for name, table in TABLES.items():
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                f"pk TEXT NOT NULL, id TEXT NOT NULL, ts INTEGER NOT NULL, "
+                f"body TEXT NOT NULL, PRIMARY KEY (pk, id))"
+            )
+            if name in NOTIFICATION_TABLES:
+                connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS ix_{table}_notification_ts "
+                    f"ON {table} (pk, ts)"
+                )
+
+    async def init_storage(self) -> None:
+        """ Create tables and indexes """
+        await self.execute_blocking(self.init_storage_bl)
+        Log.i(TAG, f"init_storage::{self.path} ready")
+
+    async def close(self) -> None:
+        """ Close the connection and the DB thread """
+        def bl() -> None:
+            """ Close blocking """
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+        await self.execute_blocking(bl)
+        self.executor.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, Any]:
+        """ Backend counters """
+        return dict(backend=self.name, path=self.path, reads=self.reads,
+                    writes=self.writes, queries=self.queries)
+
+    def write_bl(self, name: str, partition_key: str, body: Dict[str, Any],
+                 replace: bool = False) -> Dict[str, Any]:
+        """ Insert (or replace) item, raises ItemExists """
+        body = dict(body, _ts=int(time.time()))
+        verb = "INSERT OR REPLACE" if replace else "INSERT"
+        try:
+            self.get_connection_bl().execute(
+                f"{verb} INTO {TABLES[name]} (pk, id, ts, body) "
+                f"VALUES (?, ?, ?, ?)",
+                (partition_key, body["id"], body["_ts"], json_dumps(body))
+            )
+        except sqlite3.IntegrityError as e:
+            raise ItemExists(str(e))
+        self.writes += 1
+        return body
+
+    def write_batch_bl(self, name: str, partition_key: str,
+                       bodies: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """ Insert items in one transaction, all or nothing """
+        connection = self.get_connection_bl()
+        connection.execute("BEGIN")
+        try:
+            saved_items = [self.write_bl(name, partition_key, body)
+                           for body in bodies]
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return saved_items
+
+    def read_bl(self, name: str, partition_key: str,
+                item_id: str) -> Dict[str, Any]:
+        """ Point read, raises ItemNotFound """
+        self.reads += 1
+        row = self.get_connection_bl().execute(
+            f"SELECT body FROM {TABLES[name]} WHERE pk = ? AND id = ?",
+            (partition_key, item_id)
+        ).fetchone()
+        if row is None:
+            raise ItemNotFound(f"{name}/{partition_key}/{item_id}")
+        return json_loads(row[0])
+
+    def page_bl(self, name: str, partition_key: str, token: Optional[str],
+                limit: int, fields: Optional[Sequence[str]] = None)\
+            -> Tuple[List[Any], Optional[str]]:
+        """ One page of the partition in (_ts, rowid) order, bodies or
+            tuples of the `fields` extracted by sqlite """
+        self.queries += 1
+        columns = (", ".join(f"json_extract(body, '$.{field}')"
+                             for field in fields) if fields else "body")
+        # noinspection SqlResolve
+        query = (f"SELECT rowid, ts, {columns} FROM {TABLES[name]} "
+                 f"WHERE pk = ?")
+        parameters: List[Any] = [partition_key]
+        if token:
+            ts, rowid = (int(x) for x in token.split(":"))
+            query += " AND (ts > ? OR (ts = ? AND rowid > ?))"
+            parameters += [ts, ts, rowid]
+        query += " ORDER BY ts, rowid LIMIT ?"
+        parameters.append(limit + 1)
+        rows = self.get_connection_bl().execute(query, parameters).fetchall()
+        next_token = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_token = f"{rows[-1][1]}:{rows[-1][0]}"
+        if fields:
+            return [tuple(row[2:]) for row in rows], next_token
+        return [json_loads(row[2]) for row in rows], next_token
+
+    def summary_bl(self, notification_id: str) -> Optional[Tuple[int, ...]]:
+        """ (ack count, first ack, last ack, initiation count) """
+        self.queries += 1
+        connection = self.get_connection_bl()
+        ack_count, first_ack, last_ack = connection.execute(
+            f"SELECT COUNT(1), MIN(json_extract(body, '$.timestamp')), "
+            f"MAX(json_extract(body, '$.timestamp')) "
+            f"FROM {TABLES[Containers.ACKNOWLEDGES]} WHERE pk = ?",
+            (notification_id,)
+        ).fetchone()
+        initiation_count, = connection.execute(
+            f"SELECT COUNT(1) FROM {TABLES[Containers.INITIATIONS]} "
+            f"WHERE pk = ?", (notification_id,)
+        ).fetchone()
+        if ack_count == 0 and initiation_count == 0:
+            return None
+        return ack_count, first_ack, last_ack, initiation_count
+
+    async def write(self, name: str, partition_key: str,
+                    body: Dict[str, Any], replace: bool = False)\
+            -> Dict[str, Any]:
+        """ Insert (or replace) item, raises ItemExists """
+        return await self.execute_blocking(self.write_bl, name,
+                                           partition_key, body, replace)
+
+    async def write_batch(self, name: str, partition_key: str,
+                          bodies: List[Dict[str, Any]])\
+            -> List[Dict[str, Any]]:
+        """ Insert items atomically, raises ItemExists """
+        return await self.execute_blocking(self.write_batch_bl, name,
+                                           partition_key, bodies)
+
+    async def read(self, name: str, partition_key: str,
+                   item_id: str) -> Dict[str, Any]:
+        """ Point read, raises ItemNotFound """
+        return await self.execute_blocking(self.read_bl, name,
+                                           partition_key, item_id)
+
+    async def page(self, name: str, partition_key: str,
+                   token: Optional[str], limit: int,
+                   fields: Optional[Sequence[str]] = None)\
+            -> Tuple[List[Any], Optional[str]]:
+        """ One page of the partition in _ts order """
+        return await self.execute_blocking(self.page_bl, name,
+                                           partition_key, token, limit,
+                                           fields)
+
+    async def records_page(self, name: str, partition_key: str,
+                           record: Type[NamedTuple], token: Optional[str],
+                           limit: int) -> Tuple[List[Any], Optional[str]]:
+        """ One page of the partition projected to `record` """
+        rows, token = await self.page(name, partition_key, token, limit,
+                                      record._fields)
+        return [record._make(row) for row in rows], token
+
+    async def create_notification(self, notification: NotificationCosmos)\
+            -> NotificationCosmos:
+        """ Create notification and its PENDING delivery """
+        from config import AppConfig
+
+        notification.id = notification.id or uuid.uuid4().__str__()
+        schema = NotificationCosmos.get_schema(unknown=EXCLUDE)
+        body = schema.dump(notification)
+        delivery = self.make_delivery(notification.id,
+                                      NotificationStatus.PENDING,
+                                      notification.tenant_id)
+        saved_item, _ = await self.write_batch(
+            Containers.NOTIFICATIONS,
+            body.get("tenantId") or AppConfig.TENANT_ID, [body, delivery]
+        )
+        return schema.load(saved_item)
+
+    async def get_notification(self, notification_id: str)\
+            -> NotificationCosmos:
+        """ Get notification """
+        from config import AppConfig
+
+        item = await self.read(Containers.NOTIFICATIONS, AppConfig.TENANT_ID,
+                               notification_id)
+        return NotificationCosmos.get_schema(unknown=EXCLUDE).load(item)
+
+    async def get_notification_summary(self, notification_id: str)\
+            -> Optional[NotificationSummary]:
+        """ Notification summary, computed on read: local aggregates over
+            the notificationId index are cheaper than a projection """
+        counters = await self.execute_blocking(self.summary_bl,
+                                               notification_id)
+        if counters is None:
+            return None
+        return NotificationSummary.build(notification_id, *counters)
+
+    async def get_notification_delivery(self, notification_id: str,
+                                        tenant_id: Optional[str] = None)\
+            -> Optional[NotificationDelivery]:
+        """ Get notification delivery """
+        from config import AppConfig
+
+        try:
+            item = await self.read(
+                Containers.NOTIFICATIONS, tenant_id or AppConfig.TENANT_ID,
+                NotificationDelivery.make_id(notification_id)
+            )
+        except ItemNotFound:
+            return None
+        return NotificationDelivery.get_schema(unknown=EXCLUDE).load(item)
+
+    async def set_notification_status(self, notification_id: str,
+                                      status: str,
+                                      tenant_id: Optional[str] = None)\
+            -> None:
+        """ Update the delivery status """
+        from config import AppConfig
+
+        await self.write(Containers.NOTIFICATIONS,
+                         tenant_id or AppConfig.TENANT_ID,
+                         self.make_delivery(notification_id, status,
+                                            tenant_id),
+                         replace=True)
+
+    async def create_acknowledge(self, notification_id: str,
+                                 account: ChannelAccount) -> Dict[str, Any]:
+        """ Add the first acknowledge of the notification.
+            Raises ItemExists if it's been acknowledged already """
+        acknowledge = self.make_acknowledge(notification_id, account)
+        return await self.write(Containers.ACKNOWLEDGES, notification_id,
+                                acknowledge)
+
+    async def has_acknowledge(self, notification_id: str) -> bool:
+        """ Has anybody acknowledged the notification """
+        items, _ = await self.page(Containers.ACKNOWLEDGES, notification_id,
+                                   None, 1)
+        return len(items) > 0
+
+    async def get_acknowledge_page(self, notification_id: str,
+                                   token: Optional[str] = None,
+                                   limit: int = 20)\
+            -> Tuple[List[Acknowledge], Optional[str]]:
+        """ Get one page of Acknowledge Items and the next page token """
+        items, token = await self.page(Containers.ACKNOWLEDGES,
+                                       notification_id, token, limit)
+        schema = Acknowledge.get_schema(unknown=EXCLUDE)
+        return schema.load(items, many=True), token
+
+    async def get_acknowledge_records(self, notification_id: str,
+                                      token: Optional[str] = None,
+                                      limit: int = 20)\
+            -> Tuple[List[AcknowledgeRecord], Optional[str]]:
+        """ Get one page of the acknowledges listing """
+        return await self.records_page(Containers.ACKNOWLEDGES,
+                                       notification_id, AcknowledgeRecord,
+                                       token, limit)
+
+    async def iter_acknowledge_items(self, notification_id: str,
+                                     page_size: Optional[int] = None)\
+            -> AsyncIterator[Acknowledge]:
+        """ Stream Acknowledge Items page by page """
+        token = None
+        while True:
+            items, token = await self.get_acknowledge_page(
+                notification_id, token, page_size or 100
+            )
+            for item in items:
+                yield item
+            if token is None:
+                return
+
+    async def create_initiation(self, initiator: str,
+                                notification_id: str) -> None:
+        """ Save initiation """
+        data = self.make_initiation(initiator, notification_id)
+        data.update(dict(id=uuid.uuid4().__str__()))
+        await self.write(Containers.INITIATIONS, notification_id, data)
+
+    async def get_initiation_items(self, notification_id,
+                                   token=None) -> Tuple[List[Initiation], str]:
+        """ Get Initiation Items """
+        items, token = await self.page(Containers.INITIATIONS,
+                                       notification_id, token, 20)
+        schema = Initiation.get_schema(unknown=EXCLUDE)
+        return schema.load(items, many=True), token
+
+    async def get_initiation_records(self, notification_id: str,
+                                     token: Optional[str] = None,
+                                     limit: int = 20)\
+            -> Tuple[List[InitiationRecord], Optional[str]]:
+        """ Get one page of the initiations listing """
+        return await self.records_page(Containers.INITIATIONS,
+                                       notification_id, InitiationRecord,
+                                       token, limit)
+
+    async def get_conversation(self, conversation_id: str,
+                               tenant_id: str = None)\
+            -> MSConversationReference:
+        """ Get Conversation Reference """
+        from config import AppConfig
+
+        item = await self.read(Containers.CONVERSATIONS,
+                               tenant_id or AppConfig.TENANT_ID,
+                               conversation_id)
+        return self.load_conversation(item)
+
+    async def create_conversation_reference(self, turn_context: TurnContext)\
+            -> Dict[str, Any]:
+        """ Save Conversation Reference """
+        (tenant_id, _), reference_json = self.make_conversation_reference(
+            turn_context
+        )
+        return await self.write(Containers.CONVERSATIONS, tenant_id,
+                                reference_json, replace=True)
+
+    async def create_flow(self, cmd, url, tenant_id=None):
+        """ Create Flow """
+        data = self.make_flow(cmd, url, tenant_id)
+        return await self.write(Containers.FLOWS, data["tenantId"], data)
+
+    async def get_flow(self, cmd, tenant_id=None) -> Flow:
+        """ Get Flow """
+        from config import AppConfig
+
+        item = await self.read(Containers.FLOWS,
+                               tenant_id or AppConfig.TENANT_ID, cmd)
+        return Flow.get_schema(unknown=EXCLUDE).load(item)
@@ -0,0 +1,97 @@
+""" Change feed driven notification status projection """
+import asyncio
+import sys
+import time
+from typing import Any, Dict, Optional, Sequence, Set
+
+from utils.log import Log
+
+
+TAG = __name__
+
+
+class StatusProjector:
+    """ Keeps the notification summaries up to date.
+
+        Polls the change feed of the acknowledges and initiations
+        containers, collects the notification ids touched by the changes and
+        recomputes their summaries with aggregate queries. Recomputing is
+        idempotent, so the feed is processed at least once: the continuation
+        is saved as a lease only after the summaries have been written, a
+        crash replays the last batch. `client` is a CosmosClient. """
+
+    def __init__(self, client: Any, containers: Sequence[str],
+                 poll_interval: float = 1.0, max_item_count: int = 100):
+        self.client = client
+        self.containers = list(containers)
+        self.poll_interval = poll_interval
+        self.max_item_count = max_item_count
+        self.task: Optional[asyncio.Task] = None
+        self.tokens: Dict[str, Optional[str]] = {}
+        self.changes = 0
+        self.refreshed = 0
+        self.errors = 0
+        self.last_poll: Optional[float] = None
+
+    def start(self) -> None:
+        """ Start polling """
+        if self.task is None:
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        """ Stop polling """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self) -> None:
+        """ Poll loop """
+        while True:
+            # noinspection PyBroadException
+            try:
+                processed = await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.errors += 1
+                Log.e(TAG, "run::poll error", sys.exc_info())
+                processed = 0
+            self.last_poll = time.time()
+            if processed == 0:
+                await asyncio.sleep(self.poll_interval)
+
+    async def poll(self) -> int:
+        """ Read one page of every feed, returns the number of changes """
+        processed = 0
+        for name in self.containers:
+            if name not in self.tokens:
+                # loaded here to be retried with the poll on errors
+                self.tokens[name] = await self.client.get_lease(name)
+            token = self.tokens[name]
+            items, next_token = await self.client.read_change_feed(
+                name, token, self.max_item_count
+            )
+            notification_ids: Set[str] = set(
+                item["notificationId"] for item in items
+                if item.get("notificationId")
+            )
+            await asyncio.gather(*[
+                self.client.refresh_notification_summary(notification_id)
+                for notification_id in notification_ids
+            ])
+            if next_token != token:
+                await self.client.save_lease(name, next_token)
+                self.tokens[name] = next_token
+            self.changes += len(items)
+            self.refreshed += len(notification_ids)
+            processed += len(items)
+        return processed
+
+    def stats(self) -> Dict[str, Any]:
+        """ Projector counters """
+        return dict(changes=self.changes, refreshed=self.refreshed,
+                    errors=self.errors, lastPoll=self.last_poll)
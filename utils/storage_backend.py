@@ -0,0 +1,298 @@
+""" Storage backend interface """
+import abc
+from typing import Any, AsyncIterator, Dict, Hashable, List, NamedTuple, \
+    Optional, Tuple
+
+from botbuilder.core import TurnContext
+from botbuilder.schema import ChannelAccount, \
+    ConversationReference as MSConversationReference
+from marshmallow import EXCLUDE
+
+from entities.json.acknowledge import Acknowledge
+from entities.json.acknowledge_schema import AcknowledgeSchema
+from entities.json.camel_case_mixin import timestamp_factory
+from entities.json.conversation_reference import ConversationReference
+from entities.json.flow import Flow
+from entities.json.initiation import Initiation
+from entities.json.notification import NotificationCosmos
+from entities.json.notification_delivery import NotificationDelivery
+from entities.json.notification_summary import NotificationSummary
+
+
+class StorageException(Exception):
+    """ Storage base exception """
+    def __init__(self, message: str):
+        self.message = message
+
+
+class ItemExists(StorageException):
+    """ Item already exists in the DB """
+    pass
+
+
+class SaveItemError(StorageException):
+    """ Save Item Error """
+    pass
+
+
+class SaveConversationError(StorageException):
+    """ Save Conversation Error """
+    pass
+
+
+class ItemNotFound(StorageException):
+    """ Item not found """
+    pass
+
+
+class StorageBackends:
+    """ Backend names """
+    COSMOS = "cosmos"
+    SQLITE = "sqlite"
+
+
+class Containers:
+    """ Container definition names, see CosmosDBConfig """
+    CONVERSATIONS = "Conversations"
+    NOTIFICATIONS = "Notifications"
+    ACKNOWLEDGES = "Acknowledges"
+    INITIATIONS = "Initiations"
+    FLOWS = "Flows"
+    SUMMARIES = "Summaries"
+    LEASES = "Leases"
+
+
+class InitiationRecord(NamedTuple):
+    """ Initiation listing projection, field names are document fields """
+    id: str
+    initiator: str
+    timestamp: Optional[int]
+
+
+class AcknowledgeRecord(NamedTuple):
+    """ Acknowledge listing projection, field names are document fields """
+    username: Optional[str]
+    timestamp: Optional[int]
+
+
+class StorageBackend(abc.ABC):
+    """ Storage of the bot entities.
+
+        Covers everything the bot and the API use, so that the Cosmos DB
+        client can be replaced with the embedded SQLite one for local runs
+        and benchmarks. Paging tokens are opaque strings, None when there
+        are no more pages. """
+
+    name: str = None
+
+    @abc.abstractmethod
+    async def init_storage(self) -> None:
+        """ Create databases, containers, tables... """
+
+    async def close(self) -> None:
+        """ Release backend resources """
+
+    def stats(self) -> Dict[str, Any]:
+        """ In-process metrics of the backend """
+        return dict(backend=self.name)
+
+    def start_write_buffer(self, **kwargs) -> None:
+        """ Start write-behind buffer if the backend has one """
+
+    def start_metrics_reporter(self, interval: float) -> None:
+        """ Start periodic metrics logging if the backend has one """
+
+    def start_archiver(self, **kwargs) -> None:
+        """ Start archiving the documents before their retention ends if
+            the backend has retention """
+
+    def start_status_projector(self, **kwargs) -> None:
+        """ Start notification summaries projection if the backend
+            needs one """
+
+    @abc.abstractmethod
+    async def create_notification(self, notification: NotificationCosmos)\
+            -> NotificationCosmos:
+        """ Create notification and its PENDING delivery atomically """
+
+    @abc.abstractmethod
+    async def get_notification(self, notification_id: str)\
+            -> NotificationCosmos:
+        """ Get notification, raises ItemNotFound """
+
+    @abc.abstractmethod
+    async def get_notification_summary(self, notification_id: str)\
+            -> Optional[NotificationSummary]:
+        """ Get notification status and counters,
+            None if nothing has happened to the notification yet """
+
+    @abc.abstractmethod
+    async def get_notification_delivery(self, notification_id: str,
+                                        tenant_id: Optional[str] = None)\
+            -> Optional[NotificationDelivery]:
+        """ Get notification delivery, None for the notifications created
+            before the deliveries were introduced """
+
+    @abc.abstractmethod
+    async def set_notification_status(self, notification_id: str,
+                                      status: str,
+                                      tenant_id: Optional[str] = None)\
+            -> None:
+        """ Update the delivery status, see NotificationStatus """
+
+    @abc.abstractmethod
+    async def create_acknowledge(self, notification_id: str,
+                                 account: ChannelAccount) -> Dict[str, Any]:
+        """ Add the first acknowledge of the notification.
+            Raises ItemExists if it's been acknowledged already. A backend
+            may buffer the write and return right away, then a conflicting
+            acknowledge is dropped instead, check has_acknowledge() first """
+
+    @abc.abstractmethod
+    async def has_acknowledge(self, notification_id: str) -> bool:
+        """ Has anybody acknowledged the notification """
+
+    @abc.abstractmethod
+    async def get_acknowledge_page(self, notification_id: str,
+                                   token: Optional[str] = None,
+                                   limit: int = 20)\
+            -> Tuple[List[Acknowledge], Optional[str]]:
+        """ Get one page of Acknowledge Items and the next page token """
+
+    @abc.abstractmethod
+    async def get_acknowledge_records(self, notification_id: str,
+                                      token: Optional[str] = None,
+                                      limit: int = 20)\
+            -> Tuple[List[AcknowledgeRecord], Optional[str]]:
+        """ Get one page of the acknowledges listing and the next page
+            token, only the listed fields are fetched """
+
+    @abc.abstractmethod
+    def iter_acknowledge_items(self, notification_id: str,
+                               page_size: Optional[int] = None)\
+            -> AsyncIterator[Acknowledge]:
+        """ Stream Acknowledge Items ordered by _ts """
+
+    async def get_acknowledge_items(self, notification_id)\
+            -> List[Acknowledge]:
+        """ Get Acknowledge Items """
+        return [ack async for ack in self.iter_acknowledge_items(
+            notification_id
+        )]
+
+    async def get_acknowledge(self, notification_id: str)\
+            -> Optional[Acknowledge]:
+        """ Get the first Acknowledge object or None """
+        async for ack in self.iter_acknowledge_items(notification_id, 1):
+            return ack
+        return None
+
+    @abc.abstractmethod
+    async def create_initiation(self, initiator: str,
+                                notification_id: str) -> None:
+        """ Save initiation """
+
+    @abc.abstractmethod
+    async def get_initiation_items(self, notification_id,
+                                   token=None) -> Tuple[List[Initiation], str]:
+        """ Get one page of Initiation Items and the next page token """
+
+    @abc.abstractmethod
+    async def get_initiation_records(self, notification_id: str,
+                                     token: Optional[str] = None,
+                                     limit: int = 20)\
+            -> Tuple[List[InitiationRecord], Optional[str]]:
+        """ Get one page of the initiations listing and the next page
+            token, only the listed fields are fetched """
+
+    @abc.abstractmethod
+    async def get_conversation(self, conversation_id: str,
+                               tenant_id: str = None)\
+            -> MSConversationReference:
+        """ Get Conversation Reference, raises ItemNotFound """
+
+    @abc.abstractmethod
+    async def create_conversation_reference(self, turn_context: TurnContext)\
+            -> Dict[str, Any]:
+        """ Save Conversation Reference """
+
+    @abc.abstractmethod
+    async def create_flow(self, cmd, url, tenant_id=None):
+        """ Create Flow """
+
+    @abc.abstractmethod
+    async def get_flow(self, cmd, tenant_id=None) -> Flow:
+        """ Get Flow, raises ItemNotFound """
+
+    async def find_flow(self, cmd, tenant_id=None) -> Optional[Flow]:
+        """ Get Flow or None if there is no such command """
+        try:
+            return await self.get_flow(cmd, tenant_id)
+        except ItemNotFound:
+            return None
+
+    @staticmethod
+    def make_acknowledge(notification_id: str,
+                         account: ChannelAccount) -> Dict[str, Any]:
+        """ Acknowledge document with the deterministic id """
+        return AcknowledgeSchema().dump(dict(
+            id=Acknowledge.make_id(notification_id),
+            notification_id=notification_id,
+            username=account.name,
+            user_aad_id=account.aad_object_id,
+            timestamp=timestamp_factory()
+        ))
+
+    @staticmethod
+    def make_initiation(initiator: str,
+                        notification_id: str) -> Dict[str, Any]:
+        """ Initiation document """
+        initiation = Initiation(initiator=initiator,
+                                timestamp=timestamp_factory(),
+                                notification_id=notification_id)
+        return Initiation.get_schema().dump(initiation)
+
+    @staticmethod
+    def make_delivery(notification_id: str, status: str,
+                      tenant_id: Optional[str] = None) -> Dict[str, Any]:
+        """ Notification delivery document """
+        from config import AppConfig
+
+        delivery = NotificationDelivery(
+            id=NotificationDelivery.make_id(notification_id),
+            notification_id=notification_id,
+            tenant_id=tenant_id or AppConfig.TENANT_ID,
+            status=status
+        )
+        return NotificationDelivery.get_schema().dump(delivery)
+
+    @staticmethod
+    def make_flow(cmd, url, tenant_id=None) -> Dict[str, Any]:
+        """ Flow document """
+        from config import AppConfig
+
+        flow = Flow(tenant_id=tenant_id or AppConfig.TENANT_ID, id=cmd,
+                    url=url)
+        return Flow.get_schema().dump(flow)
+
+    @staticmethod
+    def make_conversation_reference(turn_context: TurnContext)\
+            -> Tuple[Hashable, Dict[str, Any]]:
+        """ (tenant_id, conversation_id) key and the reference document """
+        from config import CosmosDBConfig
+
+        reference = TurnContext.get_conversation_reference(
+            turn_context.activity
+        )
+        reference_json = ConversationReference.get_schema().dump(reference)
+        reference_json.update({
+            CosmosDBConfig.Conversations.PK: reference.conversation.id
+        })
+        key = (reference.conversation.tenant_id, reference.conversation.id)
+        return key, reference_json
+
+    @staticmethod
+    def load_conversation(item: Dict[str, Any]) -> MSConversationReference:
+        """ Convert stored conversation reference """
+        return ConversationReference.get_schema(unknown=EXCLUDE)\
+                                    .load(item).to_ms_reference()
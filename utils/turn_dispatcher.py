@@ -0,0 +1,145 @@
+""" Inbound turn dispatcher """
+import asyncio
+import sys
+import time
+import zlib
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from utils.cosmos_metrics import Histogram, LATENCY_BUCKETS_MS
+from utils.log import Log
+
+
+TAG = __name__
+
+
+# runs the turn
+Job = Callable[[], Awaitable[Any]]
+# (enqueued at, job)
+Entry = Tuple[float, Job]
+
+
+class TurnQueueFull(Exception):
+    """ The shard is full or the dispatcher isn't accepting turns """
+    def __init__(self, message: str = "Turn queue is full"):
+        self.message = message
+
+
+class TurnDispatcher:
+    """ Runs the inbound turns after the HTTP request has been answered.
+
+        The turns are sharded by conversation id over `shards` bounded
+        queues with one worker each, so the turns of a conversation run
+        one at a time in the arrival order while the conversations of
+        different shards run concurrently. submit() waits up to
+        `put_timeout` seconds for a slot of a full shard, then raises
+        TurnQueueFull. stop() waits up to `drain_timeout` seconds for the
+        queued turns and drops the rest. """
+
+    def __init__(self, shards: int = 16, shard_max_size: int = 100,
+                 put_timeout: float = 5, drain_timeout: float = 30):
+        self.shards = max(shards, 1)
+        self.shard_max_size = shard_max_size
+        self.put_timeout = put_timeout
+        self.drain_timeout = drain_timeout
+        self.queues: List[asyncio.Queue] = []
+        self.tasks: List[asyncio.Task] = []
+        self.stopping = False
+        self.busy = 0
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.wait_ms = Histogram(LATENCY_BUCKETS_MS)
+        self.turn_ms = Histogram(LATENCY_BUCKETS_MS)
+
+    @property
+    def size(self) -> int:
+        """ Turns waiting for a worker """
+        return sum(queue.qsize() for queue in self.queues)
+
+    @property
+    def is_running(self) -> bool:
+        """ Does the dispatcher accept turns """
+        return bool(self.tasks) and not self.stopping
+
+    def get_queue(self, key: str) -> asyncio.Queue:
+        """ Shard of the conversation """
+        return self.queues[zlib.crc32(key.encode("utf-8")) % self.shards]
+
+    def start(self) -> None:
+        """ Start workers """
+        if self.tasks:
+            return
+        self.stopping = False
+        self.queues = [asyncio.Queue(self.shard_max_size)
+                       for _ in range(self.shards)]
+        loop = asyncio.get_event_loop()
+        self.tasks = [loop.create_task(self.worker(queue))
+                      for queue in self.queues]
+
+    async def stop(self) -> None:
+        """ Stop accepting turns and drain the queues """
+        if not self.tasks:
+            return
+        self.stopping = True
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*[queue.join() for queue in self.queues]),
+                self.drain_timeout
+            )
+        except asyncio.TimeoutError:
+            Log.w(TAG, f"stop::drain timeout, {self.size} turns left")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self.dropped += self.size
+        Log.i(TAG, f"stop::drained: {self.stats()}")
+
+    async def submit(self, key: str, job: Job) -> None:
+        """ Queue the turn of the conversation `key`.
+            Raises TurnQueueFull """
+        if not self.is_running:
+            raise TurnQueueFull("Turn dispatcher is not running")
+        try:
+            await asyncio.wait_for(
+                self.get_queue(key).put((time.perf_counter(), job)),
+                self.put_timeout
+            )
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise TurnQueueFull()
+        self.submitted += 1
+
+    async def worker(self, queue: asyncio.Queue) -> None:
+        """ Turn loop of the shard """
+        while True:
+            enqueued, job = await queue.get()
+            start = time.perf_counter()
+            self.wait_ms.observe((start - enqueued) * 1000)
+            self.busy += 1
+            # noinspection PyBroadException
+            try:
+                await job()
+                self.processed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failed += 1
+                Log.e(TAG, "worker::turn error", sys.exc_info())
+            finally:
+                self.busy -= 1
+                self.turn_ms.observe((time.perf_counter() - start) * 1000)
+                queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        """ Dispatcher counters """
+        sizes = [queue.qsize() for queue in self.queues]
+        return dict(shards=self.shards, shardMaxSize=self.shard_max_size,
+                    size=sum(sizes), maxShardSize=max(sizes or [0]),
+                    busy=self.busy, submitted=self.submitted,
+                    processed=self.processed, failed=self.failed,
+                    rejected=self.rejected, dropped=self.dropped,
+                    waitMs=self.wait_ms.snapshot(),
+                    turnMs=self.turn_ms.snapshot())
@@ -0,0 +1,180 @@
+""" Async write-behind buffer """
+import asyncio
+import random
+import sys
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, \
+    Set, Tuple
+
+from utils.log import Log
+
+
+TAG = __name__
+
+
+# (container name, partition key, body)
+Record = Tuple[str, Any, Dict[str, Any]]
+# writes records of one (container, partition key) group,
+# returns the records that have to be retried
+Writer = Callable[[str, Any, List[Dict[str, Any]]],
+                  Awaitable[List[Dict[str, Any]]]]
+
+
+class WriteBehindBuffer:
+    """ Accepts records immediately and flushes them in the background.
+
+        Records are grouped by (container, partition key) and every group is
+        flushed with one writer call. Failed records are retried with
+        exponential backoff, records still failing after `max_retries` are
+        logged and dropped. The records must carry their final id so that
+        retries are idempotent. """
+
+    def __init__(self, writer: Writer, max_size: int = 10000,
+                 batch_size: int = 100, flush_interval: float = 0.2,
+                 max_retries: int = 5, retry_delay: float = 0.5):
+        self.writer = writer
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        # (record, attempt)
+        self.records: Deque[Tuple[Record, int]] = deque()
+        # (container, id) of the records not written yet
+        self.pending: Set[Tuple[str, Any]] = set()
+        self.in_flight = 0
+        self.retrying = 0
+        self.task: Optional[asyncio.Task] = None
+        self.event: Optional[asyncio.Event] = None
+        self.stopping = False
+        self.submitted = 0
+        self.written = 0
+        self.retried = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    @property
+    def size(self) -> int:
+        """ Records not written yet """
+        return len(self.records) + self.in_flight + self.retrying
+
+    def start(self) -> None:
+        """ Start flushing """
+        if self.task is None:
+            self.stopping = False
+            self.event = asyncio.Event()
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        """ Stop accepting records and drain the buffer """
+        if self.task is None:
+            return
+        self.stopping = True
+        self.event.set()
+        await self.task
+        self.task = None
+        Log.i(TAG, f"stop::drained: {self.stats()}")
+
+    def submit(self, container: str, partition_key: Any,
+               body: Dict[str, Any]) -> bool:
+        """ Accept record, False if the buffer isn't running or is full
+            and the caller has to write the record by itself """
+        if self.task is None or self.stopping:
+            return False
+        if self.size >= self.max_size:
+            self.rejected += 1
+            return False
+        self.records.append(((container, partition_key, body), 0))
+        self.pending.add((container, body.get("id")))
+        self.submitted += 1
+        if len(self.records) >= self.batch_size:
+            self.event.set()
+        return True
+
+    def is_pending(self, container: str, item_id: Any) -> bool:
+        """ Is the record submitted but not written yet """
+        return (container, item_id) in self.pending
+
+    async def run(self) -> None:
+        """ Flush loop """
+        while True:
+            if not self.records:
+                if self.stopping and self.retrying == 0:
+                    return
+                self.event.clear()
+                try:
+                    await asyncio.wait_for(self.event.wait(),
+                                           self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # noinspection PyBroadException
+            try:
+                await self.flush()
+            except Exception:
+                Log.e(TAG, "run::flush error", sys.exc_info())
+
+    async def flush(self) -> None:
+        """ Write up to batch_size records grouped by partition """
+        groups: Dict[Tuple[str, Any], List[Tuple[Record, int]]] = {}
+        while self.records and self.in_flight < self.batch_size:
+            entry = self.records.popleft()
+            (container, partition_key, _), _ = entry
+            groups.setdefault((container, partition_key), []).append(entry)
+            self.in_flight += 1
+        await asyncio.gather(*[self.flush_group(key, entries)
+                               for key, entries in groups.items()])
+
+    async def flush_group(self, key: Tuple[str, Any],
+                          entries: List[Tuple[Record, int]]) -> None:
+        """ Write one partition group """
+        container, partition_key = key
+        bodies = [body for (_, _, body), _ in entries]
+        start = time.perf_counter()
+        # noinspection PyBroadException
+        try:
+            failed = await self.writer(container, partition_key, bodies)
+        except Exception:
+            Log.e(TAG, "flush_group::writer error", sys.exc_info())
+            failed = bodies
+        finally:
+            self.in_flight -= len(entries)
+        failed_ids = set(id(body) for body in failed)
+        self.written += len(entries) - len(failed_ids)
+        Log.d(TAG, f"flush_group::{container}/{partition_key}: "
+                   f"{len(entries)} records, {len(failed_ids)} failed, "
+                   f"took: {time.perf_counter() - start}")
+        for record, attempt in entries:
+            if id(record[2]) in failed_ids:
+                self.retry(record, attempt + 1)
+            else:
+                self.pending.discard((container, record[2].get("id")))
+
+    def retry(self, record: Record, attempt: int) -> None:
+        """ Schedule record retry or drop it """
+        if attempt > self.max_retries:
+            self.pending.discard((record[0], record[2].get("id")))
+            self.dropped += 1
+            Log.e(TAG, f"retry::dropping record after {attempt} attempts: "
+                       f"{record}")
+            return
+        self.retried += 1
+        self.retrying += 1
+        delay = self.retry_delay * (2 ** (attempt - 1))
+        delay = delay / 2 + random.uniform(0, delay / 2)
+
+        def requeue() -> None:
+            """ Put record back """
+            self.retrying -= 1
+            self.records.append((record, attempt))
+            self.event.set()
+
+        asyncio.get_event_loop().call_later(delay, requeue)
+
+    def stats(self) -> Dict[str, Any]:
+        """ Buffer counters """
+        return dict(size=self.size, maxSize=self.max_size,
+                    submitted=self.submitted, written=self.written,
+                    retried=self.retried, dropped=self.dropped,
+                    rejected=self.rejected)